@@ -5,7 +5,9 @@
 # This table was generated by the CrcTableGenerator program in the 
 # source distribution.
 
-import struct
+# cython: language_level=3, boundscheck=False, wraparound=False
+
+from libc.stdint cimport uint16_t, uint64_t
 import array
 
 Crc16Table0 = array.array('H',  # H is unsigned short
@@ -296,33 +298,114 @@ Crc16Table7 = array.array('H',
         0xe20e, 0x2ecf, 0x3b8f, 0xf74e, 0x110f, 0xddce, 0xc88e, 0x044f, 
 ])
 
-# This is a more convenient way of unpacking data, thanks to SO 17537071
-
-def unpack(stream, fmt):
-    size = struct.calcsize(fmt)
-    buf = stream.read(size)
-    return struct.unpack(fmt, buf)[0]
-
-def compute_crc(stream, stream_length):
-    crc = 0
-    pos = 0
-    while stream_length - pos > 7:
-        n = unpack(stream, 'Q')
-        crc = Crc16Table7[(n & 0xff) ^ (crc & 0xff)] ^ \
-              Crc16Table6[((n >> 8) & 0xff) ^ ((crc >> 8) & 0xff)] ^ \
-              Crc16Table5[(n >> 16) & 0xff] ^ \
-              Crc16Table4[(n >> 24) & 0xff] ^ \
-              Crc16Table3[(n >> 32) & 0xff] ^ \
-              Crc16Table2[(n >> 40) & 0xff] ^ \
-              Crc16Table1[(n >> 48) & 0xff] ^ \
-              Crc16Table0[n >> 56]
-        pos += 8
-
-    for i in range(stream_length - pos):
-        buf = stream.read(1)
-        val = int.from_bytes(buf, byteorder = 'little')
-        index = (crc ^ val) & 0xff
-        lookup = Crc16Table0[index]
-        crc = (lookup ^ (crc >> 8))
-
-    return crc
\ No newline at end of file
+# Copy the tables into a C array so that the inner loop can run without
+# touching any Python objects (and so without holding the GIL)
+
+cdef uint16_t _tables[8][256]
+
+for _i, _table in enumerate([Crc16Table0, Crc16Table1, Crc16Table2, Crc16Table3,
+                             Crc16Table4, Crc16Table5, Crc16Table6, Crc16Table7]):
+    for _j in range(256):
+        _tables[_i][_j] = _table[_j]
+
+# Buffers smaller than this are not worth the cost of releasing the GIL
+
+DEF _NOGIL_THRESHOLD = 4096
+
+# Continue a CRC16 computation over length bytes starting at data. The bulk
+# of the buffer is processed 8 bytes at a time using the slice-by-8 tables
+# and the remainder one byte at a time.
+
+cdef uint16_t _update(uint16_t crc, const unsigned char *data, Py_ssize_t length) noexcept nogil:
+    cdef uint64_t n
+
+    while length > 7:
+        n = (<uint64_t>data[0]) | (<uint64_t>data[1] << 8) | \
+            (<uint64_t>data[2] << 16) | (<uint64_t>data[3] << 24) | \
+            (<uint64_t>data[4] << 32) | (<uint64_t>data[5] << 40) | \
+            (<uint64_t>data[6] << 48) | (<uint64_t>data[7] << 56)
+        crc = _tables[7][(n & 0xff) ^ (crc & 0xff)] ^ \
+              _tables[6][((n >> 8) & 0xff) ^ ((crc >> 8) & 0xff)] ^ \
+              _tables[5][(n >> 16) & 0xff] ^ \
+              _tables[4][(n >> 24) & 0xff] ^ \
+              _tables[3][(n >> 32) & 0xff] ^ \
+              _tables[2][(n >> 40) & 0xff] ^ \
+              _tables[1][(n >> 48) & 0xff] ^ \
+              _tables[0][n >> 56]
+        data += 8
+        length -= 8
+
+    while length > 0:
+        crc = _tables[0][(crc ^ data[0]) & 0xff] ^ (crc >> 8)
+        data += 1
+        length -= 1
+
+    return crc
+
+cdef uint16_t _update_buffer(uint16_t crc, const unsigned char[::1] buffer):
+    cdef Py_ssize_t length = buffer.shape[0]
+    if length == 0:
+        return crc
+    if length < _NOGIL_THRESHOLD:
+        return _update(crc, &buffer[0], length)
+    with nogil:
+        crc = _update(crc, &buffer[0], length)
+    return crc
+
+def crc16(buffer, crc = 0):
+    """Compute the CRC16 of a buffer.
+
+    Parameters
+    ----------
+    buffer: bytes, bytearray, memoryview or mmap
+        The data to checksum
+    crc: int
+        The CRC of the data preceding buffer, to continue a running computation. Default is 0.
+
+    Returns
+    -------
+    int
+        The CRC16 of the data
+    """
+
+    return _update_buffer(crc, buffer)
+
+cdef class Crc16:
+    """Incremental CRC16 computation.
+
+    Examples
+    --------
+    >>> crc = Crc16()
+    >>> crc.update(b"1234")
+    >>> crc.update(b"56789")
+    >>> crc.digest()
+    47933
+    """
+
+    cdef uint16_t crc
+
+    def __init__(self, crc = 0):
+        self.crc = crc
+
+    def update(self, buffer):
+        self.crc = _update_buffer(self.crc, buffer)
+
+    def digest(self):
+        return self.crc
+
+# Compute the CRC16 of the next stream_length bytes of stream. The stream is
+# read in large blocks rather than 8 bytes at a time.
+
+def compute_crc(stream, Py_ssize_t stream_length):
+    cdef uint16_t crc = 0
+    cdef Py_ssize_t block_size
+
+    while stream_length > 0:
+        block_size = min(stream_length, 1 << 20)
+        block = stream.read(block_size)
+        if len(block) == 0:
+            break
+        crc = _update_buffer(crc, block)
+        stream_length -= len(block)
+
+    return crc
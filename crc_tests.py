@@ -1,5 +1,6 @@
-from crc import compute_crc
+from crc import Crc16, compute_crc, crc16
 import io
+import mmap
 import unittest
 
 class Crc16TestMethods(unittest.TestCase):
@@ -35,6 +36,33 @@ class Crc16TestMethods(unittest.TestCase):
             s = strings[i]
             crc = compute_crc(io.BytesIO(s), len(s))
             self.assertEqual(crc, crcs[i])
+            self.assertEqual(crc16(s), crcs[i])
+            self.assertEqual(crc16(memoryview(s)), crcs[i])
+
+    def test_incremental(self):
+        s = b"01234567890123456"
+        for split in range(len(s) + 1):
+            crc = Crc16()
+            crc.update(s[:split])
+            crc.update(s[split:])
+            self.assertEqual(crc.digest(), 0xad37)
+            self.assertEqual(crc16(s[split:], crc16(s[:split])), 0xad37)
+
+    def test_large_file(self):
+        filename = "large_file.fit"
+        with open(filename, "rb") as stream:
+            data = stream.read()
+
+        # The CRC of a .fit file including its trailing CRC is always zero
+        self.assertEqual(crc16(data), 0)
+
+        with open(filename, "rb") as stream:
+            with mmap.mmap(stream.fileno(), 0, access = mmap.ACCESS_READ) as mapping:
+                crc = Crc16()
+                for offset in range(0, len(data), 4096):
+                    with memoryview(mapping)[offset:offset + 4096] as block:
+                        crc.update(block)
+                self.assertEqual(crc.digest(), 0)
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,315 @@
+# Mean-maximal curves and other training analytics over record columns
+#
+# Everything here works on the decoded record arrays, resampled onto a 1 Hz
+# grid. The mean-maximal curve holds, for every duration from 1 s to the
+# whole activity, the best average of a channel (power, heart rate, speed)
+# over any window of that duration. With a prefix sum of the samples, the
+# average of every window of one duration is a single vectorized subtraction,
+# so the whole curve takes one NumPy pass per duration rather than a Python
+# loop per window.
+#
+# The summary of an activity can be cached on disk next to the FitCache
+# entries, keyed and evicted like them, and merged into SeasonBests incrementally, so that adding a ride
+# to a season does not recompute the rides that were already there.
+
+import io
+import os
+import numpy as np
+from fit_parser import RecordDecl
+from fit_parser_cache import FitCache, default_cache_size
+from fit_parser_dataframe import parse_fit_as_dataframe
+
+default_channels = (RecordDecl.power, RecordDecl.heart_rate, RecordDecl.speed)
+
+# Gaps in the recording up to this many seconds are interpolated. Longer gaps
+# are treated as stopped: the samples have no value there, so stopped time is
+# not counted in zones, while the power curve and normalized power count it as
+# zero watts.
+
+default_max_gap = 5
+
+def resample_1hz(timestamps, values, max_gap = default_max_gap, fill = 0.0):
+    """Resample a channel onto a 1 Hz grid.
+
+    Parameters
+    ----------
+    timestamps: numpy.ndarray
+        Sample times as integer seconds (raw FIT timestamps or Unix seconds) or datetime64 values,
+        in increasing order
+    values: numpy.ndarray
+        Sample values. NaN marks a missing value, e.g. a sensor dropout.
+    max_gap: int
+        Longest gap in seconds that is filled by linear interpolation. Default is 5.
+    fill: float
+        Value of the seconds in longer gaps. Default is 0, as for power; NaN leaves them missing.
+
+    Returns
+    -------
+    numpy.ndarray
+        float64 values, one per second from the first timestamp to the last. Samples that share a
+        second are averaged; missing values are filled with fill.
+    """
+
+    timestamps = np.asarray(timestamps)
+    if np.issubdtype(timestamps.dtype, np.datetime64):
+        timestamps = timestamps.astype('datetime64[s]').astype(np.int64)
+    values = np.asarray(values, dtype = np.float64)
+    if len(timestamps) == 0:
+        return np.zeros(0)
+
+    seconds = (timestamps - timestamps[0]).astype(np.int64)
+    length = int(seconds[-1]) + 1
+    valid = ~np.isnan(values)
+    counts = np.bincount(seconds[valid], minlength = length)
+    sums = np.bincount(seconds[valid], weights = values[valid], minlength = length)
+
+    has_sample = counts > 0
+    resampled = np.full(length, fill, dtype = np.float64)
+    resampled[has_sample] = sums[has_sample] / counts[has_sample]
+
+    # Interpolate the seconds that are missing from short gaps only. A gap is
+    # measured between the samples on either side of it.
+    missing = np.flatnonzero(~has_sample)
+    present = np.flatnonzero(has_sample)
+    if len(missing) > 0 and len(present) > 1:
+        after = np.searchsorted(present, missing)
+        inside = (after > 0) & (after < len(present))
+        gaps = np.full(len(missing), length)
+        gaps[inside] = present[after[inside]] - present[after[inside] - 1] - 1
+        short = missing[gaps <= max_gap]
+        resampled[short] = np.interp(short, present, resampled[present])
+
+    return resampled
+
+def mean_max_curve(values):
+    """Compute the mean-maximal curve of a 1 Hz channel.
+
+    Parameters
+    ----------
+    values: numpy.ndarray
+        One value per second, e.g. as returned by resample_1hz. Windows that contain a NaN are
+        left out.
+
+    Returns
+    -------
+    numpy.ndarray
+        curve[d - 1] is the highest average of values over any d consecutive seconds, for every
+        duration d from 1 to len(values), or NaN if every window of that duration has a gap.
+    """
+
+    values = np.asarray(values, dtype = np.float64)
+    length = len(values)
+    missing = np.isnan(values)
+    prefix = np.zeros(length + 1)
+    np.cumsum(np.where(missing, 0, values), out = prefix[1:])
+
+    # Count the missing values in every window the same way, only if there are any
+    missing_prefix = None
+    if missing.any():
+        missing_prefix = np.zeros(length + 1, dtype = np.int64)
+        np.cumsum(missing, out = missing_prefix[1:])
+
+    curve = np.full(length, np.nan)
+    window_sums = np.empty(length)
+    for duration in range(1, length + 1):
+        count = length - duration + 1
+        np.subtract(prefix[duration:], prefix[:count], out = window_sums[:count])
+        sums = window_sums[:count]
+        if missing_prefix is not None:
+            sums = sums[missing_prefix[duration:] == missing_prefix[:count]]
+            if len(sums) == 0:
+                continue
+        curve[duration - 1] = sums.max() / duration
+    return curve
+
+def normalized_power(power, window = 30):
+    """Compute the normalized power of a 1 Hz power channel.
+
+    The fourth root of the mean of the fourth power of the 30 second rolling average. Returns NaN
+    if there are fewer samples than the window.
+    """
+
+    power = np.asarray(power, dtype = np.float64)
+    if len(power) < window:
+        return np.nan
+
+    prefix = np.zeros(len(power) + 1)
+    np.cumsum(power, out = prefix[1:])
+    rolling = (prefix[window:] - prefix[:-window]) / window
+    return float(np.mean(rolling ** 4) ** 0.25)
+
+def time_in_zones(values, boundaries):
+    """Count the seconds that a 1 Hz channel spends in each zone.
+
+    Parameters
+    ----------
+    values: numpy.ndarray
+        One value per second. NaN values, e.g. while stopped, are not counted.
+    boundaries: list[float]
+        Ascending lower bounds of zones 2 and up, e.g. [0.55 * ftp, 0.75 * ftp, ...]. Values
+        below boundaries[0] are in zone 1.
+
+    Returns
+    -------
+    numpy.ndarray
+        Number of seconds in each of the len(boundaries) + 1 zones
+    """
+
+    values = np.asarray(values, dtype = np.float64)
+    zones = np.searchsorted(np.asarray(boundaries, dtype = np.float64), values[~np.isnan(values)], side = "right")
+    return np.bincount(zones, minlength = len(boundaries) + 1)
+
+# The analytics of a single activity: its start time, its channels resampled
+# to 1 Hz, their mean-maximal curves and its normalized power. Everything
+# that depends on the athlete, like zones, is computed on demand from the
+# samples, so a cached summary stays valid when those change.
+
+class ActivitySummary:
+    def __init__(self, start_time, samples, curves, normalized_power):
+        self.start_time = start_time
+        self.samples = samples
+        self.curves = curves
+        self.normalized_power = normalized_power
+
+    @property
+    def duration(self):
+        return max((len(values) for values in self.samples.values()), default = 0)
+
+    def time_in_zones(self, channel, boundaries):
+        return time_in_zones(self.samples[channel], boundaries)
+
+    def save(self, path):
+        arrays = {"start_time": np.array(self.start_time, dtype = 'datetime64[s]'),
+                  "normalized_power": np.array(self.normalized_power)}
+        for channel, values in self.samples.items():
+            arrays["samples_" + channel] = values
+        for channel, curve in self.curves.items():
+            arrays["curve_" + channel] = curve
+
+        # Write to a temporary file and rename it into place, so that a
+        # partially written summary is never read. Its name starts with a dot
+        # so that FitCache.evict leaves it alone.
+        directory, name = os.path.split(path)
+        temporary = os.path.join(directory, ".%s.tmp" % name)
+        with io.open(temporary, "wb") as stream:
+            np.savez(stream, **arrays)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            samples = {name[len("samples_"):]: arrays[name] for name in arrays.files if name.startswith("samples_")}
+            curves = {name[len("curve_"):]: arrays[name] for name in arrays.files if name.startswith("curve_")}
+            return cls(arrays["start_time"][()], samples, curves, float(arrays["normalized_power"]))
+
+def analyze_fit_file(path, channels = default_channels, max_gap = default_max_gap, cache_dir = None,
+                     cache_size = default_cache_size):
+    """Compute the analytics of a .fit activity.
+
+    Parameters
+    ----------
+    path: str
+        Path to the .fit file
+    channels: list[RecordDecl]
+        Record fields to resample and compute mean-maximal curves for. Speed is in m/s. Default is
+        power, heart rate and speed. Channels that the file does not record are left out.
+    max_gap: int
+        Longest gap in seconds that is interpolated, as for resample_1hz. Longer gaps are missing
+        from the samples, and count as zero in the power curve and normalized power. Default is 5.
+    cache_dir: str
+        FitCache directory where summaries are cached, keyed on the size, modification time and CRC
+        of the file and evicted with the other entries. Default is None, which always computes the
+        summary.
+    cache_size: int
+        Size in bytes above which the least recently used cache entries are evicted, as for
+        parse_fit_as_dataframe. Default is 1 GB.
+
+    Returns
+    -------
+    ActivitySummary
+        The summary of the activity. Its samples and curves are keyed on channel name.
+
+    Examples
+    --------
+    >>> summary = analyze_fit_file('fit_file.fit')
+    >>> best_20_minutes = summary.curves['power'][20 * 60 - 1]
+    >>> seconds_per_zone = summary.time_in_zones('heart_rate', [120, 140, 155, 170])
+    """
+
+    channels = list(channels)
+    if cache_dir is not None:
+        cache = FitCache(cache_dir, cache_size)
+        names = "-".join(channel.name for channel in channels)
+        entry = os.path.join(cache_dir, "%s-%s-%r.npz" % (cache.key(path), names, max_gap))
+        try:
+            summary = ActivitySummary.load(entry)
+            # Mark the summary as recently used
+            os.utime(entry)
+            return summary
+        except FileNotFoundError:
+            pass
+
+    frame = parse_fit_as_dataframe(path, [RecordDecl.time_stamp] + channels, convert_units = True)
+    frame = frame[frame.index.notna()]
+    timestamps = frame.index.values
+
+    samples = {}
+    curves = {}
+    for channel in channels:
+        values = frame[channel.name].to_numpy(dtype = np.float64, na_value = np.nan)
+        if np.isnan(values).all():
+            continue
+        samples[channel.name] = resample_1hz(timestamps, values, max_gap, np.nan)
+        curve_values = samples[channel.name]
+        if channel == RecordDecl.power:
+            curve_values = np.where(np.isnan(curve_values), 0.0, curve_values)
+        curves[channel.name] = mean_max_curve(curve_values)
+
+    power = samples.get(RecordDecl.power.name)
+    start_time = timestamps[0] if len(timestamps) > 0 else np.datetime64('NaT')
+    summary = ActivitySummary(np.datetime64(start_time, 's'), samples, curves,
+                              normalized_power(np.where(np.isnan(power), 0.0, power)) if power is not None else np.nan)
+
+    if cache_dir is not None:
+        summary.save(entry)
+        cache.evict()
+    return summary
+
+# The best mean-maximal values across many activities, per channel and
+# duration, together with the activity that each of them came from. Adding
+# an activity only compares its curves with the current bests.
+
+class SeasonBests:
+    def __init__(self):
+        self.curves = {}
+        self.source_indexes = {}
+        self.sources = []
+
+    def add(self, summary, source):
+        """Merge the curves of an ActivitySummary; source identifies it, e.g. its path."""
+
+        index = len(self.sources)
+        self.sources.append(source)
+
+        for channel, curve in summary.curves.items():
+            best = self.curves.get(channel, np.zeros(0))
+            best_sources = self.source_indexes.get(channel, np.zeros(0, dtype = np.intp))
+
+            if len(curve) > len(best):
+                best = np.concatenate([best, np.full(len(curve) - len(best), -np.inf)])
+                best_sources = np.concatenate([best_sources, np.full(len(curve) - len(best_sources), -1)])
+
+            better = np.flatnonzero(curve > best[:len(curve)])
+            best[better] = curve[better]
+            best_sources[better] = index
+            self.curves[channel] = best
+            self.source_indexes[channel] = best_sources
+
+    def best(self, channel, duration):
+        """Return the best average of channel over duration seconds and the source it came from."""
+
+        curve = self.curves[channel]
+        # No activity has a window of that duration without a gap
+        if duration > len(curve) or self.source_indexes[channel][duration - 1] < 0:
+            return None, None
+        return curve[duration - 1], self.sources[self.source_indexes[channel][duration - 1]]
@@ -0,0 +1,115 @@
+# FIT analytics tests
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fit_analytics
+from fit_analytics import ActivitySummary, SeasonBests, analyze_fit_file, mean_max_curve, normalized_power, resample_1hz, time_in_zones
+from fit_parser_cache import FitCache
+
+class FitAnalyticsTestMethods(unittest.TestCase):
+
+    def test_mean_max_curve(self):
+        values = np.random.default_rng(0).uniform(0, 400, 200)
+        curve = mean_max_curve(values)
+
+        self.assertEqual(len(curve), len(values))
+        for duration in [1, 2, 7, 30, 199, 200]:
+            expected = max(values[i:i + duration].mean() for i in range(len(values) - duration + 1))
+            self.assertAlmostEqual(curve[duration - 1], expected)
+
+        # Windows across a gap are left out
+        curve = mean_max_curve([100, 300, np.nan, 200, 200, 200])
+        self.assertEqual(curve[:3].tolist(), [300, 200, 200])
+        self.assertTrue(np.isnan(curve[3:]).all())
+
+    def test_normalized_power(self):
+        self.assertAlmostEqual(normalized_power(np.full(600, 200.0)), 200.0)
+        self.assertGreater(normalized_power(np.tile([0.0] * 60 + [400.0] * 60, 10)), 200.0)
+        self.assertTrue(np.isnan(normalized_power(np.full(29, 200.0))))
+
+    def test_time_in_zones(self):
+        zones = time_in_zones(np.array([50, 100, 149, 150, 200, 300, np.nan]), [100, 150, 250])
+        self.assertEqual(zones.tolist(), [1, 2, 2, 1])
+
+    def test_resample_1hz(self):
+        timestamps = np.array([0, 0, 1, 3, 4, 20, 21])
+        values = np.array([100, 200, 150, 250, np.nan, 300, 300])
+        resampled = resample_1hz(timestamps, values, max_gap = 5)
+
+        self.assertEqual(len(resampled), 22)
+        self.assertEqual(resampled[:5].tolist(), [150, 150, 200, 250, 0])
+        self.assertEqual(resampled[5:20].tolist(), [0] * 15)
+        self.assertEqual(resampled[20:].tolist(), [300, 300])
+
+        resampled = resample_1hz(timestamps, values, max_gap = 5, fill = np.nan)
+        self.assertEqual(resampled[:4].tolist(), [150, 150, 200, 250])
+        self.assertTrue(np.isnan(resampled[4:20]).all())
+
+    def test_analyze_fit_file(self):
+        summary = analyze_fit_file("large_file.fit")
+
+        self.assertEqual(sorted(summary.curves), ["heart_rate", "power", "speed"])
+        power = summary.samples["power"]
+        self.assertEqual(len(summary.curves["power"]), len(power))
+        # Stopped time counts as zero watts in the curve but not in the zones
+        self.assertAlmostEqual(summary.curves["power"][0], np.nanmax(power))
+        self.assertAlmostEqual(summary.curves["power"][-1], np.nansum(power) / len(power))
+        self.assertEqual(summary.time_in_zones("power", [100, 200]).sum(), np.count_nonzero(~np.isnan(power)))
+        heart_rate = summary.samples["heart_rate"]
+        self.assertEqual(summary.time_in_zones("heart_rate", [120, 160]).sum(), np.count_nonzero(~np.isnan(heart_rate)))
+
+    def test_summary_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            expected = analyze_fit_file("large_file.fit", cache_dir = cache_dir)
+
+            def fail(*args, **kwargs):
+                raise AssertionError("cache hit parsed the file")
+
+            parse = fit_analytics.parse_fit_as_dataframe
+            fit_analytics.parse_fit_as_dataframe = fail
+            try:
+                actual = analyze_fit_file("large_file.fit", cache_dir = cache_dir)
+            finally:
+                fit_analytics.parse_fit_as_dataframe = parse
+
+            self.assertEqual(actual.start_time, expected.start_time)
+            self.assertEqual(actual.normalized_power, expected.normalized_power)
+            for channel in expected.curves:
+                self.assertTrue(np.array_equal(actual.curves[channel], expected.curves[channel], equal_nan = True))
+                self.assertTrue(np.array_equal(actual.samples[channel], expected.samples[channel], equal_nan = True))
+
+            # Summaries count towards the size of the cache
+            FitCache(cache_dir, max_bytes = 0).evict()
+            self.assertEqual(os.listdir(cache_dir), [])
+
+            analyze_fit_file("large_file.fit", max_gap = 5, cache_dir = cache_dir)
+            analyze_fit_file("large_file.fit", max_gap = 5.5, cache_dir = cache_dir)
+            self.assertEqual(len([name for name in os.listdir(cache_dir) if name.endswith(".npz")]), 2)
+
+            analyze_fit_file("large_file.fit", max_gap = 6, cache_dir = cache_dir, cache_size = 0)
+            self.assertEqual(os.listdir(cache_dir), [])
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_season_bests(self):
+        short = ActivitySummary(None, {}, {"power": np.array([500.0, 400.0])}, np.nan)
+        long = ActivitySummary(None, {}, {"power": np.array([450.0, 420.0, 300.0]),
+                                          "heart_rate": np.array([150.0, np.nan])}, np.nan)
+
+        bests = SeasonBests()
+        bests.add(short, "short.fit")
+        bests.add(long, "long.fit")
+
+        self.assertEqual(bests.curves["power"].tolist(), [500.0, 420.0, 300.0])
+        self.assertEqual(bests.best("power", 1), (500.0, "short.fit"))
+        self.assertEqual(bests.best("power", 2), (420.0, "long.fit"))
+        self.assertEqual(bests.best("power", 4), (None, None))
+        self.assertEqual(bests.best("heart_rate", 1), (150.0, "long.fit"))
+        self.assertEqual(bests.best("heart_rate", 2), (None, None))
+
+if __name__ == '__main__':
+    unittest.main()
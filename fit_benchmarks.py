@@ -0,0 +1,419 @@
+# Benchmarks for the parser, CRC and DataFrame paths
+#
+# The benchmarks run over synthetic .fit files that are generated from a
+# fixed seed, so the same size always gives the same file and results scale
+# with the size of the input. Each scenario runs in a fresh process so that
+# the peak RSS it reports is its own. Results can be saved as a JSON baseline
+# and later runs compared against it:
+#
+#   python fit_benchmarks.py --sizes 1M,64M --save baseline.json
+#   python fit_benchmarks.py --sizes 1M,64M --compare baseline.json
+#
+# A comparison fails (exit status 1) when the throughput of any scenario
+# drops by more than the threshold.
+
+import argparse
+import io
+import json
+import mmap
+import os
+import platform
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from crc import Crc16, compute_crc, crc16
+from fit_parser import FieldType, GlobalMessageDecl, RecordDecl, parse_fit_file
+from fit_parser_columns import parse_fit_columns
+from fit_parser_dataframe import parse_fit_as_dataframe, parse_fit_files
+from fit_writer import write_fit
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, where peak RSS is not reported
+    resource = None
+
+default_threshold = 0.2
+
+# The record messages of the synthetic files, as (field, type, dtype) tuples
+
+_record_fields = [
+    (RecordDecl.time_stamp, FieldType.uint32, '<u4'),
+    (RecordDecl.position_lat, FieldType.int32, '<i4'),
+    (RecordDecl.position_long, FieldType.int32, '<i4'),
+    (RecordDecl.altitude, FieldType.uint16, '<u2'),
+    (RecordDecl.heart_rate, FieldType.uint8, 'u1'),
+    (RecordDecl.cadence, FieldType.uint8, 'u1'),
+    (RecordDecl.distance, FieldType.uint32, '<u4'),
+    (RecordDecl.speed, FieldType.uint16, '<u2'),
+    (RecordDecl.power, FieldType.uint16, '<u2'),
+    ]
+
+_record_dtype = np.dtype([('header', 'u1')] + [(str(int(field)), dtype) for field, _, dtype in _record_fields])
+
+_first_timestamp = 1000000000
+_block_records = 1 << 20
+
+def _definition(local_message_number, global_message_number, fields):
+    data = struct.pack("<BBBHB", 0x40 | local_message_number, 0, 0, global_message_number, len(fields))
+    for field, field_type, dtype in fields:
+        data += struct.pack("<BBB", field, np.dtype(dtype).itemsize, field_type)
+    return data
+
+def generate_fit_file(path, size, seed = 0):
+    """Write a synthetic .fit activity of about size bytes.
+
+    The file holds a file_id message, one record message per second and a lap message. Field
+    values follow a random walk drawn from seed, and about 1% of power values are invalid, so the
+    same size and seed always produce the same file.
+
+    Parameters
+    ----------
+    path: str
+        Path of the .fit file to write
+    size: int
+        Approximate size of the file in bytes
+    seed: int
+        Seed of the random values. Default is 0.
+
+    Returns
+    -------
+    int
+        The number of record messages in the file
+    """
+
+    prologue = _definition(0, GlobalMessageDecl.file_id, [(4, FieldType.uint32, '<u4')])
+    prologue += struct.pack("<BI", 0, _first_timestamp)
+    prologue += _definition(1, GlobalMessageDecl.record, _record_fields)
+    lap_fields = [(RecordDecl.time_stamp, FieldType.uint32, '<u4'), (254, FieldType.uint16, '<u2')]
+    epilogue = _definition(2, GlobalMessageDecl.lap, lap_fields)
+
+    record_count = max(0, (size - 14 - len(prologue) - len(epilogue) - 7) // _record_dtype.itemsize)
+    epilogue += struct.pack("<BIH", 2, _first_timestamp + record_count, 0)
+    data_size = len(prologue) + record_count * _record_dtype.itemsize + len(epilogue)
+
+    rng = np.random.default_rng(seed)
+    crc = Crc16()
+    with io.open(path, "wb") as stream:
+        def write(data):
+            crc.update(data)
+            stream.write(data)
+
+        write(struct.pack("<BBhI4s", 12, 16, 2132, data_size, b".FIT"))
+        write(prologue)
+
+        # Records are generated and written in blocks to bound memory
+        position = np.array([429496729, -1288490188], dtype = np.int64)
+        altitude = 2500.0
+        distance = 0
+        for start in range(0, record_count, _block_records):
+            count = min(_block_records, record_count - start)
+            records = np.zeros(count, dtype = _record_dtype)
+            records['header'] = 1
+            records['253'] = _first_timestamp + start + np.arange(count, dtype = np.uint32)
+
+            steps = np.cumsum(rng.integers(-200, 201, size = (count, 2)), axis = 0) + position
+            records['0'] = steps[:, 0]
+            records['1'] = steps[:, 1]
+            position = steps[-1]
+
+            altitudes = altitude + np.cumsum(rng.normal(0, 1, count))
+            records['2'] = np.clip(altitudes, 0, 65534)
+            altitude = altitudes[-1]
+
+            records['3'] = rng.integers(90, 190, count)
+            records['4'] = rng.integers(60, 110, count)
+            speeds = rng.integers(5000, 12000, count)
+            records['6'] = speeds
+            distances = distance + np.cumsum(speeds // 10)
+            records['5'] = distances
+            distance = int(distances[-1])
+
+            power = rng.integers(0, 400, count)
+            power[rng.random(count) < 0.01] = 0xffff
+            records['7'] = power
+
+            write(records.tobytes())
+
+        write(epilogue)
+        stream.write(struct.pack("<H", crc.digest()))
+
+    return record_count
+
+# Scenarios. Each one takes the path of a synthetic file and returns the
+# number of messages that it processed and the number of bytes it read.
+
+_dataframe_columns = {
+    1: [RecordDecl.power],
+    4: [RecordDecl.time_stamp, RecordDecl.power, RecordDecl.heart_rate, RecordDecl.cadence],
+    "all": [field for field, _, _ in _record_fields],
+    }
+
+_multi_file_count = 4
+
+def _parse(path):
+    count = 0
+    for message in parse_fit_file(path):
+        count += 1
+    return count, os.path.getsize(path)
+
+def _get(path):
+    count = 0
+    for message in parse_fit_file(path, use_mmap = True, reuse = True):
+        message.get(RecordDecl.heart_rate)
+        message.get(RecordDecl.power)
+        count += 1
+    return count, os.path.getsize(path)
+
+def _get_as_datetime(path):
+    count = 0
+    for message in parse_fit_file(path, use_mmap = True, reuse = True):
+        message.get_as_datetime(RecordDecl.time_stamp)
+        count += 1
+    return count, os.path.getsize(path)
+
+def _crc(path):
+    size = os.path.getsize(path)
+    with io.open(path, "rb") as stream:
+        compute_crc(stream, size - 2)
+    return None, size
+
+def _crc16(path):
+    with io.open(path, "rb") as stream:
+        data = stream.read()
+    crc16(data)
+    return None, len(data)
+
+# Crc16.update over a memory-mapped file in 4 KB blocks, as the push parser
+# sees a file that arrives in chunks
+
+def _crc_mmap_update(path):
+    with io.open(path, "rb") as stream:
+        with mmap.mmap(stream.fileno(), 0, access = mmap.ACCESS_READ) as mapping:
+            crc = Crc16()
+            for offset in range(0, len(mapping), 4096):
+                with memoryview(mapping)[offset:offset + 4096] as block:
+                    crc.update(block)
+            return None, len(mapping)
+
+def _dataframe(columns):
+    def run(path):
+        return len(parse_fit_as_dataframe(path, _dataframe_columns[columns])), os.path.getsize(path)
+    return run
+
+# Decode every field of every message into columns on a number of threads.
+# The index is built serially, so this shows how decoding scales with cores.
+
+def _columns(workers):
+    def run(path):
+        columns = parse_fit_columns(path, workers = workers)
+        return sum(len(message_columns.offsets) for message_columns in columns.values()), os.path.getsize(path)
+    return run
+
+def _multi_file(path):
+    frame = parse_fit_files([path] * _multi_file_count, _dataframe_columns[4], concat = True)
+    return len(frame), os.path.getsize(path) * _multi_file_count
+
+# Read every record field and write them back out with compressed timestamps
+
+def _round_trip(path):
+    frame = parse_fit_as_dataframe(path, "*")
+    with tempfile.TemporaryDirectory() as directory:
+        write_fit(os.path.join(directory, "round_trip.fit"), {GlobalMessageDecl.record: frame}, compressed_timestamps = True)
+    return len(frame), os.path.getsize(path)
+
+scenarios = {
+    "parse": _parse,
+    "get": _get,
+    "get_as_datetime": _get_as_datetime,
+    "crc": _crc,
+    "crc16": _crc16,
+    "crc_mmap_update": _crc_mmap_update,
+    "dataframe_1": _dataframe(1),
+    "dataframe_4": _dataframe(4),
+    "dataframe_all": _dataframe("all"),
+    "columns_1": _columns(1),
+    "columns_2": _columns(2),
+    "columns_4": _columns(4),
+    "multi_file": _multi_file,
+    "round_trip": _round_trip,
+    }
+
+# Run one scenario in this process, keeping the fastest of repeat runs
+
+def run_scenario(name, path, repeat = 1):
+    seconds = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        messages, size = scenarios[name](path)
+        elapsed = time.perf_counter() - start_time
+        seconds = elapsed if seconds is None else min(seconds, elapsed)
+
+    result = {
+        "seconds": seconds,
+        "messages_per_second": messages / seconds if messages is not None else None,
+        "megabytes_per_second": size / seconds / 1e6,
+        "peak_rss_megabytes": _peak_rss_megabytes(),
+        }
+    return result
+
+# Peak resident set size of this process and the processes it waited for
+
+def _peak_rss_megabytes():
+    if resource is None:
+        return None
+
+    # On Linux, ru_maxrss survives exec and so would include the peak of the
+    # process that launched the scenario. VmHWM is reset by exec.
+    try:
+        with io.open("/proc/self/status") as stream:
+            peak = max(int(line.split()[1]) for line in stream if line.startswith("VmHWM:")) * 1024
+    except (OSError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        if sys.platform != "darwin":
+            peak *= 1024
+
+    peak = max(peak, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024)
+    return peak / 1e6
+
+def run_benchmarks(sizes, names = None, repeat = 1, data_dir = None):
+    """Run benchmark scenarios over synthetic files of the given sizes.
+
+    Parameters
+    ----------
+    sizes: list[int]
+        Sizes in bytes of the synthetic files to benchmark
+    names: list[str]
+        Names of the scenarios to run, from the keys of scenarios. Default is None, which runs all.
+    repeat: int
+        Number of times each scenario is run; the fastest run is reported. Default is 1.
+    data_dir: str
+        Directory where the synthetic files are generated and kept between runs. Default is None,
+        which uses a fit_benchmarks directory in the temporary directory.
+
+    Returns
+    -------
+    dict
+        The results, keyed on "<scenario>/<size>", along with a description of the platform
+    """
+
+    if names is None:
+        names = list(scenarios)
+    if data_dir is None:
+        data_dir = os.path.join(tempfile.gettempdir(), "fit_benchmarks")
+    os.makedirs(data_dir, exist_ok = True)
+
+    results = {}
+    for size in sizes:
+        path = os.path.join(data_dir, "synthetic_%d.fit" % size)
+        if not os.path.exists(path):
+            generate_fit_file(path, size)
+
+        for name in names:
+            # A fresh interpreter per scenario, so that peak RSS is not
+            # inherited from the scenarios that ran before it
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--run-scenario", name,
+                                              path, "--repeat", str(repeat)],
+                                             cwd = os.path.dirname(os.path.abspath(__file__)))
+            results["%s/%s" % (name, format_size(size))] = json.loads(output)
+
+    return {"platform": platform.platform(), "python": platform.python_version(), "results": results}
+
+def compare_results(baseline, current, threshold = default_threshold):
+    """Compare benchmark results against a baseline.
+
+    Parameters
+    ----------
+    baseline, current: dict
+        Results returned by run_benchmarks
+    threshold: float
+        Largest tolerated relative drop in MB/s. Default is 0.2.
+
+    Returns
+    -------
+    list[str]
+        A description of every scenario that regressed past the threshold
+    """
+
+    regressions = []
+    for key, result in current["results"].items():
+        expected = baseline["results"].get(key)
+        if expected is None:
+            continue
+
+        ratio = result["megabytes_per_second"] / expected["megabytes_per_second"]
+        if ratio < 1 - threshold:
+            regressions.append("%s: %.1f MB/s, baseline %.1f MB/s (%.0f%% slower)" %
+                               (key, result["megabytes_per_second"], expected["megabytes_per_second"],
+                                (1 - ratio) * 100))
+    return regressions
+
+_size_suffixes = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+
+def parse_size(text):
+    text = text.strip().upper().rstrip("B")
+    if text[-1:] in _size_suffixes:
+        return int(float(text[:-1]) * _size_suffixes[text[-1]])
+    return int(text)
+
+def format_size(size):
+    for suffix in ["G", "M", "K"]:
+        if size >= _size_suffixes[suffix] and size % _size_suffixes[suffix] == 0:
+            return "%d%s" % (size // _size_suffixes[suffix], suffix)
+    return str(size)
+
+def _print_results(results):
+    print("%-28s %10s %14s %10s %12s" % ("scenario", "seconds", "messages/s", "MB/s", "peak RSS MB"))
+    for key, result in results["results"].items():
+        messages_per_second = result["messages_per_second"]
+        peak_rss = result["peak_rss_megabytes"]
+        print("%-28s %10.3f %14s %10.1f %12s" % (key, result["seconds"],
+                                                 "-" if messages_per_second is None else "%.0f" % messages_per_second,
+                                                 result["megabytes_per_second"],
+                                                 "-" if peak_rss is None else "%.1f" % peak_rss))
+
+def main(arguments = None):
+    parser = argparse.ArgumentParser(description = "Benchmark the .fit parser over synthetic files.")
+    parser.add_argument("--sizes", default = "1M,16M", help = "comma separated file sizes, e.g. 1M,64M,1G")
+    parser.add_argument("--scenarios", default = None, help = "comma separated scenarios, default all: %s" %
+                        ", ".join(scenarios))
+    parser.add_argument("--repeat", type = int, default = 1, help = "runs per scenario, the fastest is reported")
+    parser.add_argument("--data-dir", default = None, help = "where synthetic files are generated and kept")
+    parser.add_argument("--save", default = None, help = "write the results to this JSON file")
+    parser.add_argument("--compare", default = None, help = "compare the results with this JSON baseline")
+    parser.add_argument("--threshold", type = float, default = default_threshold,
+                        help = "largest tolerated relative drop in MB/s, default %g" % default_threshold)
+    parser.add_argument("--run-scenario", nargs = 2, metavar = ("SCENARIO", "PATH"), help = argparse.SUPPRESS)
+    arguments = parser.parse_args(arguments)
+
+    if arguments.run_scenario is not None:
+        name, path = arguments.run_scenario
+        print(json.dumps(run_scenario(name, path, arguments.repeat)))
+        return 0
+
+    sizes = [parse_size(size) for size in arguments.sizes.split(",")]
+    names = arguments.scenarios.split(",") if arguments.scenarios else None
+    results = run_benchmarks(sizes, names, arguments.repeat, arguments.data_dir)
+    _print_results(results)
+
+    if arguments.save is not None:
+        with io.open(arguments.save, "w") as stream:
+            json.dump(results, stream, indent = 2)
+
+    if arguments.compare is not None:
+        with io.open(arguments.compare) as stream:
+            regressions = compare_results(json.load(stream), results, arguments.threshold)
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        if regressions:
+            return 1
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,49 @@
+# Benchmark harness tests
+
+import os
+import tempfile
+import unittest
+from fit_benchmarks import compare_results, format_size, generate_fit_file, parse_size, run_scenario
+from fit_parser import GlobalMessageDecl, RecordDecl, parse_fit_file
+
+class FitBenchmarksTestMethods(unittest.TestCase):
+
+    def test_generated_file_is_valid_and_deterministic(self):
+        with tempfile.TemporaryDirectory() as directory:
+            paths = [os.path.join(directory, "%d.fit" % i) for i in range(2)]
+            record_counts = [generate_fit_file(path, 1 << 16) for path in paths]
+
+            with open(paths[0], "rb") as first, open(paths[1], "rb") as second:
+                self.assertEqual(first.read(), second.read())
+            self.assertLessEqual(abs(os.path.getsize(paths[0]) - (1 << 16)), 64)
+
+            messages = list(parse_fit_file(paths[0], validate_crc = True))
+            records = [message for message in messages
+                       if message.message_definition.global_message_number == GlobalMessageDecl.record]
+            self.assertEqual(len(records), record_counts[0])
+            self.assertEqual(len(messages), record_counts[0] + 2)
+            self.assertEqual(records[1].get(RecordDecl.time_stamp) - records[0].get(RecordDecl.time_stamp), 1)
+
+            result = run_scenario("dataframe_4", paths[0])
+            self.assertGreater(result["messages_per_second"], 0)
+            self.assertGreater(result["megabytes_per_second"], 0)
+
+    def test_compare_results(self):
+        baseline = {"results": {"parse/1M": {"megabytes_per_second": 100.0},
+                                "crc/1M": {"megabytes_per_second": 1000.0}}}
+        current = {"results": {"parse/1M": {"megabytes_per_second": 70.0},
+                               "crc/1M": {"megabytes_per_second": 900.0},
+                               "get/1M": {"megabytes_per_second": 1.0}}}
+
+        regressions = compare_results(baseline, current, threshold = 0.2)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith("parse/1M"))
+
+    def test_sizes(self):
+        self.assertEqual(parse_size("64M"), 64 << 20)
+        self.assertEqual(parse_size("1gb"), 1 << 30)
+        self.assertEqual(parse_size("1000"), 1000)
+        self.assertEqual(format_size(parse_size("16M")), "16M")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,311 @@
+# A searchable catalog of the .fit files in a directory
+#
+# Answering "which rides in March had power data over 3 hours" should not
+# mean parsing every record of every file. FitCatalog indexes each file by
+# walking only its record headers and definitions: it decodes the file_id,
+# session, lap and activity messages, and of the record messages keeps only
+# the field numbers of their definitions. Record payloads are stepped over by
+# definition size and never decoded.
+#
+# The results are kept in a SQLite database, one row per file plus one row
+# per record field, so queries by time range, sport, duration and field
+# availability are index lookups that return the paths to parse in full.
+# update() only rescans files whose size or modification time changed.
+
+from datetime import datetime, timezone
+import io
+import mmap
+import os
+import sqlite3
+import struct
+from fit_parser import ActivityDecl, FileIdDecl, GlobalMessageDecl, Message, SessionDecl, Sport, _to_fit_timestamp
+from fit_parser_columns import build_fit_index
+
+_schema = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    error TEXT,
+    protocol_version INTEGER,
+    profile_version INTEGER,
+    file_type INTEGER,
+    manufacturer INTEGER,
+    product INTEGER,
+    serial_number INTEGER,
+    time_created INTEGER,
+    start_time INTEGER,
+    duration REAL,
+    timer_time REAL,
+    distance REAL,
+    sport INTEGER,
+    sub_sport INTEGER,
+    session_count INTEGER,
+    lap_count INTEGER,
+    record_count INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_start_time ON files (start_time);
+CREATE TABLE IF NOT EXISTS record_fields (
+    field_number INTEGER NOT NULL,
+    path TEXT NOT NULL REFERENCES files (path) ON DELETE CASCADE,
+    PRIMARY KEY (field_number, path)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS record_fields_path ON record_fields (path);
+"""
+
+# The columns of files that are filled from the messages of a .fit file
+
+_summary_columns = ["protocol_version", "profile_version", "file_type", "manufacturer", "product",
+                    "serial_number", "time_created", "start_time", "duration", "timer_time", "distance",
+                    "sport", "sub_sport", "session_count", "lap_count", "record_count"]
+
+_summary_messages = {GlobalMessageDecl.file_id, GlobalMessageDecl.session, GlobalMessageDecl.lap,
+                     GlobalMessageDecl.activity}
+
+class FitCatalog:
+    """Catalog of the .fit files in one or more directories, stored in SQLite.
+
+    Parameters
+    ----------
+    database: str
+        Path of the SQLite database, which is created if it does not exist. ":memory:" keeps the
+        catalog in memory.
+
+    Examples
+    --------
+    >>> with FitCatalog('rides.sqlite') as catalog:
+            catalog.update('rides')
+            paths = catalog.find(start = datetime(2024, 3, 1), end = datetime(2024, 4, 1),
+                                 sport = Sport.cycling, fields = [RecordDecl.power],
+                                 min_duration = 3 * 3600)
+    """
+
+    def __init__(self, database):
+        self.connection = sqlite3.connect(database)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(_schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def update(self, directory):
+        """Bring the catalog up to date with the .fit files under a directory.
+
+        Files are scanned when they are new or their size or modification time changed. Files that
+        were removed from the directory are removed from the catalog. Files that cannot be read
+        are kept with their error and are not returned by find.
+
+        Returns
+        -------
+        tuple[int, int]
+            The number of files that were scanned and the number that were removed
+        """
+
+        directory = os.path.abspath(directory)
+        known = {path: (size, mtime_ns) for path, size, mtime_ns in self.connection.execute(
+            "SELECT path, size, mtime_ns FROM files WHERE path >= ? AND path < ?",
+            (directory + os.sep, directory + chr(ord(os.sep) + 1)))}
+
+        scanned = 0
+        with self.connection:
+            for path, stat in _walk_fit_files(directory):
+                if known.pop(path, None) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+                self._store(path, stat, *_scan(path))
+                scanned += 1
+
+            self.connection.executemany("DELETE FROM files WHERE path = ?", [(path,) for path in known])
+        return scanned, len(known)
+
+    def _store(self, path, stat, summary, record_fields, error):
+        self.connection.execute("DELETE FROM files WHERE path = ?", (path,))
+        self.connection.execute(
+            "INSERT INTO files (path, size, mtime_ns, error, %s) VALUES (?, ?, ?, ?, %s)" %
+            (", ".join(_summary_columns), ", ".join("?" * len(_summary_columns))),
+            [path, stat.st_size, stat.st_mtime_ns, error] + [summary.get(column) for column in _summary_columns])
+        self.connection.executemany("INSERT INTO record_fields (field_number, path) VALUES (?, ?)",
+                                    [(field_number, path) for field_number in sorted(record_fields)])
+
+    def find(self, start = None, end = None, fields = None, sport = None, min_duration = None, max_duration = None):
+        """Find the cataloged files that match every given condition.
+
+        Parameters
+        ----------
+        start: datetime or int
+            Only files whose activity starts at or after this time. A datetime or a raw FIT
+            timestamp, as for parse_fit_file. Default is None.
+        end: datetime or int
+            Only files whose activity starts before this time. Default is None.
+        fields: iterable of RecordDecl
+            Only files whose record messages have all of these fields. Default is None.
+        sport: Sport or iterable of Sport
+            Only files of this sport (or these sports). Default is None.
+        min_duration: float
+            Only files whose elapsed time is at least this many seconds. Default is None.
+        max_duration: float
+            Only files whose elapsed time is at most this many seconds. Default is None.
+
+        Returns
+        -------
+        list[str]
+            The paths of the matching files, ordered by start time
+        """
+
+        conditions = ["error IS NULL"]
+        parameters = []
+        if start is not None:
+            conditions.append("start_time >= ?")
+            parameters.append(_to_fit_timestamp(start))
+        if end is not None:
+            conditions.append("start_time < ?")
+            parameters.append(_to_fit_timestamp(end))
+        if sport is not None:
+            sports = [int(sport)] if isinstance(sport, int) else [int(value) for value in sport]
+            conditions.append("sport IN (%s)" % ", ".join("?" * len(sports)))
+            parameters.extend(sports)
+        if min_duration is not None:
+            conditions.append("duration >= ?")
+            parameters.append(min_duration)
+        if max_duration is not None:
+            conditions.append("duration <= ?")
+            parameters.append(max_duration)
+        if fields is not None:
+            field_numbers = sorted(set(int(field) for field in fields))
+            conditions.append("path IN (SELECT path FROM record_fields WHERE field_number IN (%s) "
+                              "GROUP BY path HAVING COUNT(*) = ?)" % ", ".join("?" * len(field_numbers)))
+            parameters.extend(field_numbers)
+            parameters.append(len(field_numbers))
+
+        query = "SELECT path FROM files WHERE %s ORDER BY start_time, path" % " AND ".join(conditions)
+        return [path for path, in self.connection.execute(query, parameters)]
+
+    def summary(self, path):
+        """Return the cataloged summary of a file as a dict, or None if it is not in the catalog.
+
+        start_time and time_created are returned as timezone-aware datetimes, and record_fields as
+        the sorted field numbers of the record messages.
+        """
+
+        cursor = self.connection.execute("SELECT * FROM files WHERE path = ?", (os.path.abspath(path),))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        summary = dict(zip([column[0] for column in cursor.description], row))
+        for column in ["start_time", "time_created"]:
+            if summary[column] is not None:
+                summary[column] = _to_datetime(summary[column])
+        summary["record_fields"] = [field_number for field_number, in self.connection.execute(
+            "SELECT field_number FROM record_fields WHERE path = ? ORDER BY field_number", (summary["path"],))]
+        return summary
+
+def _walk_fit_files(directory):
+    for root, _, names in os.walk(directory):
+        for name in names:
+            if name.lower().endswith(".fit"):
+                path = os.path.join(root, name)
+                yield path, os.stat(path)
+
+def _to_datetime(timestamp):
+    return datetime.fromtimestamp(timestamp + Message.offset_total_seconds, timezone.utc)
+
+# Scan one file. Returns the summary columns, the set of record field numbers
+# and an error message (None if the file was read).
+
+def _scan(path):
+    try:
+        with io.open(path, "rb") as stream:
+            buffer = mmap.mmap(stream.fileno(), 0, access = mmap.ACCESS_READ)
+        summary, record_fields = _summarize(buffer)
+        return summary, record_fields, None
+    except (AssertionError, ValueError, IndexError, KeyError, OSError, struct.error) as e:
+        return {}, set(), "%s: %s" % (type(e).__name__, e)
+
+# Build the summary of a file from its index. Only the messages in
+# _summary_messages are decoded; record messages are only counted.
+
+def _summarize(buffer):
+    index = build_fit_index(buffer)
+
+    summary = {
+        "protocol_version": index.file_header.protocol_version,
+        "profile_version": index.file_header.profile_version,
+        }
+    record_fields = set()
+    messages = {message: [] for message in _summary_messages}
+
+    for definition, positions in zip(index.definitions, index.messages_by_definition()):
+        global_message_number = definition.global_message_number
+        if global_message_number == GlobalMessageDecl.record:
+            if len(positions) > 0:
+                record_fields.update(field_definition.field_definition_number
+                                     for field_definition in definition.field_definitions)
+            summary["record_count"] = summary.get("record_count", 0) + len(positions)
+        elif global_message_number in messages:
+            messages[global_message_number].extend(
+                (index.offsets[position], Message(index.headers[position], definition, buffer, index.offsets[position]))
+                for position in positions)
+
+    # Messages of the same type can come from several definitions; put them
+    # back in file order
+    for message, found in messages.items():
+        messages[message] = [found_message for _, found_message in sorted(found, key = lambda item: item[0])]
+
+    file_ids = messages[GlobalMessageDecl.file_id]
+    if file_ids:
+        file_id = file_ids[0]
+        summary.update({
+            "file_type": file_id.get(FileIdDecl.type),
+            "manufacturer": file_id.get(FileIdDecl.manufacturer),
+            "product": file_id.get(FileIdDecl.product),
+            "serial_number": file_id.get(FileIdDecl.serial_number),
+            "time_created": _valid_timestamp(file_id.get(FileIdDecl.time_created)),
+            })
+
+    # A file with several sessions (e.g. a multisport race) starts with its
+    # first session and lasts for all of them together
+    sessions = messages[GlobalMessageDecl.session]
+    summary["session_count"] = len(sessions)
+    summary["lap_count"] = len(messages[GlobalMessageDecl.lap])
+    if sessions:
+        start_times = [_valid_timestamp(session.get(SessionDecl.start_time)) for session in sessions]
+        start_times = [start_time for start_time in start_times if start_time is not None]
+        sports = set(session.get(SessionDecl.sport) for session in sessions)
+        sub_sports = set(session.get(SessionDecl.sub_sport) for session in sessions)
+        summary.update({
+            "start_time": min(start_times) if start_times else None,
+            "duration": _total(sessions, SessionDecl.total_elapsed_time),
+            "timer_time": _total(sessions, SessionDecl.total_timer_time),
+            "distance": _total(sessions, SessionDecl.total_distance),
+            "sport": next(iter(sports)) if len(sports) == 1 else int(Sport.multisport),
+            "sub_sport": next(iter(sub_sports)) if len(sub_sports) == 1 else None,
+            })
+
+    activities = messages[GlobalMessageDecl.activity]
+    if activities:
+        if summary.get("timer_time") is None:
+            summary["timer_time"] = activities[0].get_converted(ActivityDecl.total_timer_time)
+        if summary.get("start_time") is None and summary.get("timer_time") is not None:
+            end_time = _valid_timestamp(activities[0].get(ActivityDecl.time_stamp))
+            if end_time is not None:
+                summary["start_time"] = end_time - int(summary["timer_time"])
+
+    if summary.get("start_time") is None:
+        summary["start_time"] = summary.get("time_created")
+    return summary, record_fields
+
+def _total(messages, field_decl):
+    values = [message.get_converted(field_decl) for message in messages]
+    values = [value for value in values if value is not None]
+    return sum(values) if values else None
+
+# Timestamps below 0x10000000 are relative to an unknown system time
+
+def _valid_timestamp(timestamp):
+    return timestamp if timestamp is not None and timestamp >= 0x10000000 else None
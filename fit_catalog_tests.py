@@ -0,0 +1,90 @@
+# FIT catalog tests
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime, timezone
+import numpy as np
+import pandas as pd
+from fit_catalog import FitCatalog
+from fit_parser import GlobalMessageDecl, Message, RecordDecl, Sport
+from fit_parser_tests import local_time_zone
+from fit_writer import write_fit
+
+class FitCatalogTestMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, "2014"))
+        self.ride = os.path.join(self.directory, "2014", "ride.fit")
+        shutil.copy("large_file.fit", self.ride)
+
+        # A one hour run in March 2024 without power
+        self.run = os.path.join(self.directory, "run.fit")
+        times = pd.date_range("2024-03-10", periods = 3600, freq = "s", tz = "UTC", name = RecordDecl.time_stamp.name)
+        start_time = int(times[0].timestamp() - Message.offset_total_seconds)
+        records = pd.DataFrame({"heart_rate": np.full(3600, 150, dtype = np.uint8)}, index = times)
+        session = pd.DataFrame({"start_time": np.array([start_time], dtype = np.uint32),
+                                "sport": np.array([Sport.running], dtype = np.uint8),
+                                "total_elapsed_time": np.array([3600000], dtype = np.uint32)})
+        write_fit(self.run, {GlobalMessageDecl.record: records, GlobalMessageDecl.session: session})
+
+        self.broken = os.path.join(self.directory, "broken.fit")
+        with open(self.broken, "wb") as stream:
+            stream.write(b"not a fit file")
+
+        self.catalog = FitCatalog(":memory:")
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.directory)
+
+    def test_summary(self):
+        self.assertEqual(self.catalog.update(self.directory), (3, 0))
+
+        summary = self.catalog.summary(self.ride)
+        self.assertEqual(summary["start_time"], datetime(2014, 6, 29, 12, 29, 19, tzinfo = timezone.utc))
+        self.assertAlmostEqual(summary["duration"], 22241.9)
+        self.assertEqual(summary["sport"], Sport.cycling)
+        self.assertEqual(summary["record_count"], 18456)
+        self.assertEqual((summary["session_count"], summary["lap_count"]), (1, 1))
+        self.assertIn(RecordDecl.power, summary["record_fields"])
+        self.assertIsNone(summary["error"])
+
+        self.assertEqual(self.catalog.summary(self.run)["record_fields"], [RecordDecl.heart_rate, RecordDecl.time_stamp])
+        self.assertIsNotNone(self.catalog.summary(self.broken)["error"])
+
+    def test_find(self):
+        self.catalog.update(self.directory)
+
+        self.assertEqual(self.catalog.find(), [self.ride, self.run])
+        self.assertEqual(self.catalog.find(fields = [RecordDecl.power, RecordDecl.heart_rate]), [self.ride])
+        self.assertEqual(self.catalog.find(fields = [RecordDecl.heart_rate]), [self.ride, self.run])
+        self.assertEqual(self.catalog.find(start = datetime(2024, 3, 1, tzinfo = timezone.utc),
+                                           end = datetime(2024, 4, 1, tzinfo = timezone.utc)), [self.run])
+
+        # Naive bounds are UTC: in any other time zone one of them would
+        # leave out the run, which starts at midnight UTC
+        for time_zone in ["Asia/Tokyo", "America/New_York"]:
+            with local_time_zone(time_zone):
+                self.assertEqual(self.catalog.find(start = datetime(2024, 3, 10), end = datetime(2024, 3, 10, 0, 0, 1)),
+                                 [self.run])
+        self.assertEqual(self.catalog.find(sport = Sport.cycling, min_duration = 3 * 3600), [self.ride])
+        self.assertEqual(self.catalog.find(sport = [Sport.running, Sport.walking]), [self.run])
+        self.assertEqual(self.catalog.find(max_duration = 3600), [self.run])
+
+    def test_incremental_update(self):
+        self.assertEqual(self.catalog.update(self.directory), (3, 0))
+        self.assertEqual(self.catalog.update(self.directory), (0, 0))
+
+        stat = os.stat(self.run)
+        os.utime(self.run, ns = (stat.st_atime_ns, stat.st_mtime_ns + 1))
+        self.assertEqual(self.catalog.update(self.directory), (1, 0))
+
+        os.remove(self.ride)
+        self.assertEqual(self.catalog.update(self.directory), (0, 1))
+        self.assertEqual(self.catalog.find(fields = [RecordDecl.heart_rate]), [self.run])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,14 +1,16 @@
 ﻿# Fast FIT parser written in Python
 # TODO: cythonize it
 
-from datetime import datetime, tzinfo
+from datetime import datetime, timezone, tzinfo
 import io
+import mmap
 import struct
+import time
 from enum import IntEnum
 
 # Import cythonized fast CRC16 computation algorithm
 
-from crc import compute_crc
+from crc import Crc16, crc16
 
 # FIT file declarations. This is a whole whack of static definitions
 # based on my reading of the .FIT specification. All of this makes
@@ -84,6 +86,32 @@ class EventType(IntEnum):
     stop_disableAll = 9,
     invalid = 0xFF
 
+# The sport of a session or lap
+
+class Sport(IntEnum):
+    generic = 0
+    running = 1
+    cycling = 2
+    transition = 3
+    fitness_equipment = 4
+    swimming = 5
+    basketball = 6
+    soccer = 7
+    tennis = 8
+    american_football = 9
+    training = 10
+    walking = 11
+    cross_country_skiing = 12
+    alpine_skiing = 13
+    snowboarding = 14
+    rowing = 15
+    mountaineering = 16
+    hiking = 17
+    multisport = 18
+    paddling = 19
+    all = 254
+    invalid = 0xFF
+
 # We need some more information than what is possible with Enums
 # alone for field definitions.
 
@@ -114,6 +142,91 @@ class FieldType(IntEnum):
     uint32z = 0x8c
     byte_array = 0x0d
 
+# Base type metadata used to compile the per-definition decoders. Each entry
+# maps a FieldType to the struct format character of a single element and the
+# value that the FIT specification reserves to mean "invalid" for that type.
+# Float invalid values are bit patterns (they unpack to NaN); strings and byte
+# arrays are decoded a whole field at a time.
+
+_base_types = {
+    FieldType.enum: ('B', 0xff),
+    FieldType.int8: ('b', 0x7f),
+    FieldType.uint8: ('B', 0xff),
+    FieldType.uint8z: ('B', 0x00),
+    FieldType.int16: ('h', 0x7fff),
+    FieldType.uint16: ('H', 0xffff),
+    FieldType.uint16z: ('H', 0x0000),
+    FieldType.int32: ('i', 0x7fffffff),
+    FieldType.uint32: ('I', 0xffffffff),
+    FieldType.uint32z: ('I', 0x00000000),
+    FieldType.float32: ('f', 0xffffffff),
+    FieldType.float64: ('d', 0xffffffffffffffff),
+    FieldType.string: ('s', 0x00),
+    FieldType.byte_array: ('s', 0xff),
+}
+
+# Converters applied by Message.get to the unpacked values of fields that are
+# not a single integer. Integer fields skip this step entirely.
+
+def _float_value(values, invalid):
+    value = values[0]
+    return None if value != value else value
+
+def _array_value(values, invalid):
+    if all(value == invalid for value in values):
+        return None
+    return tuple(None if value == invalid else value for value in values)
+
+def _float_array_value(values, invalid):
+    if all(value != value for value in values):
+        return None
+    return tuple(None if value != value else value for value in values)
+
+def _string_value(values, invalid):
+    value = values[0].split(b'\x00', 1)[0]
+    return value.decode('utf-8', 'replace') if value else None
+
+def _bytes_value(values, invalid):
+    value = values[0]
+    return None if value.count(invalid) == len(value) else value
+
+# Compile the decoder of one field: an (offset, Struct, invalid, converter)
+# tuple, or None if the field size does not fit its type
+
+def _compile_decoder(field_definition, byte_order):
+    base_type = _base_types.get(field_definition.field_type)
+    if base_type is None:
+        return None
+
+    format_char, invalid = base_type
+    offset = field_definition.field_offset
+    if format_char == 's':
+        converter = _string_value if field_definition.field_type == FieldType.string else _bytes_value
+        return offset, _element_struct('%ds' % field_definition.field_size), invalid, converter
+
+    element_size = struct.calcsize(format_char)
+    count, remainder = divmod(field_definition.field_size, element_size)
+    if count == 0 or remainder != 0:
+        return None
+
+    is_float = format_char in 'fd'
+    if count == 1:
+        return offset, _element_struct(byte_order + format_char), invalid, _float_value if is_float else None
+
+    converter = _float_array_value if is_float else _array_value
+    return offset, _element_struct('%s%d%s' % (byte_order, count, format_char)), invalid, converter
+
+# Single element Struct objects are shared by every compiled definition
+
+_element_structs = {}
+
+def _element_struct(struct_format):
+    element_struct = _element_structs.get(struct_format)
+    if element_struct is None:
+        element_struct = struct.Struct(struct_format)
+        _element_structs[struct_format] = element_struct
+    return element_struct
+
 # Record declarations for specific record types. This way, a user can
 # simply reference a field like RecordDecl.Speed to retrieve that field
 # from a record.
@@ -165,8 +278,133 @@ class RecordDecl(IntEnum):
     device_index = 62
     time_stamp = 253
 
+    # The scale, offset and units of the field from the FIT profile, or None
+
+    @property
+    def profile(self):
+        return record_profile.get(self)
+
+# Declarations of the summary messages of an activity: the file_id that
+# starts every file and the session, lap and activity messages that devices
+# write when a recording ends
+
+class FileIdDecl(IntEnum):
+    type = 0
+    manufacturer = 1
+    product = 2
+    serial_number = 3
+    time_created = 4
+    number = 5
+    product_name = 8
+
+class SessionDecl(IntEnum):
+    event = 0
+    event_type = 1
+    start_time = 2
+    start_position_lat = 3
+    start_position_long = 4
+    sport = 5
+    sub_sport = 6
+    total_elapsed_time = 7
+    total_timer_time = 8
+    total_distance = 9
+    total_cycles = 10
+    total_calories = 11
+    avg_speed = 14
+    max_speed = 15
+    avg_heart_rate = 16
+    max_heart_rate = 17
+    avg_cadence = 18
+    max_cadence = 19
+    avg_power = 20
+    max_power = 21
+    total_ascent = 22
+    total_descent = 23
+    first_lap_index = 25
+    num_laps = 26
+    message_index = 254
+    time_stamp = 253
+
+    @property
+    def profile(self):
+        return session_profile.get(self)
+
+class LapDecl(IntEnum):
+    event = 0
+    event_type = 1
+    start_time = 2
+    start_position_lat = 3
+    start_position_long = 4
+    end_position_lat = 5
+    end_position_long = 6
+    total_elapsed_time = 7
+    total_timer_time = 8
+    total_distance = 9
+    total_cycles = 10
+    total_calories = 11
+    avg_speed = 13
+    max_speed = 14
+    avg_heart_rate = 15
+    max_heart_rate = 16
+    avg_cadence = 17
+    max_cadence = 18
+    avg_power = 19
+    max_power = 20
+    total_ascent = 21
+    total_descent = 22
+    sport = 25
+    message_index = 254
+    time_stamp = 253
+
+    @property
+    def profile(self):
+        return lap_profile.get(self)
+
+class ActivityDecl(IntEnum):
+    total_timer_time = 0
+    num_sessions = 1
+    type = 2
+    event = 3
+    event_type = 4
+    local_timestamp = 5
+    time_stamp = 253
+
+    @property
+    def profile(self):
+        return activity_profile.get(self)
+
+# Declarations of the messages that describe developer fields
+
+class DeveloperDataIdDecl(IntEnum):
+    developer_id = 0
+    application_id = 1
+    manufacturer_id = 2
+    developer_data_index = 3
+    application_version = 4
+
+class FieldDescriptionDecl(IntEnum):
+    developer_data_index = 0
+    field_definition_number = 1
+    fit_base_type_id = 2
+    field_name = 3
+    array = 4
+    components = 5
+    scale = 6
+    offset = 7
+    units = 8
+    bits = 9
+    accumulate = 10
+    fit_base_unit_id = 13
+    native_mesg_num = 14
+    native_field_num = 15
+
 # TODO: other types
 
+# Field number 253 holds the timestamp in every message type that has one.
+# These timestamps also seed the compressed timestamp headers.
+
+timestamp_field_number = 253
+
 # Global message declarations - used to lookup up the type of a message
 
 class GlobalMessageDecl(IntEnum):
@@ -211,6 +449,123 @@ class GlobalMessageDecl(IntEnum):
     slave_device = 106
     cadence_zone = 131
     memo_glob = 145
+    field_description = 206
+    developer_data_id = 207
+
+    # The profiles of the fields of this message, keyed on field number
+
+    @property
+    def profile(self):
+        return field_profiles.get(self, {})
+
+# The FIT profile of a field: a stored value is converted into its units as
+# stored / scale - offset. Positions are converted from semicircles into
+# degrees the same way.
+
+class FieldProfile:
+    __slots__ = ('scale', 'offset', 'units')
+
+    def __init__(self, scale = 1, offset = 0, units = None):
+        self.scale = scale
+        self.offset = offset
+        self.units = units
+
+    # Whether converting changes the stored value at all
+
+    @property
+    def is_scaled(self):
+        return self.scale != 1 or self.offset != 0
+
+    def convert(self, value):
+        return value / self.scale - self.offset
+
+_semicircles_per_degree = 2 ** 31 / 180
+
+record_profile = {
+    RecordDecl.position_lat: FieldProfile(_semicircles_per_degree, 0, "degrees"),
+    RecordDecl.position_long: FieldProfile(_semicircles_per_degree, 0, "degrees"),
+    RecordDecl.altitude: FieldProfile(5, 500, "m"),
+    RecordDecl.heart_rate: FieldProfile(1, 0, "bpm"),
+    RecordDecl.cadence: FieldProfile(1, 0, "rpm"),
+    RecordDecl.distance: FieldProfile(100, 0, "m"),
+    RecordDecl.speed: FieldProfile(1000, 0, "m/s"),
+    RecordDecl.power: FieldProfile(1, 0, "watts"),
+    RecordDecl.grade: FieldProfile(100, 0, "%"),
+    RecordDecl.resistance: FieldProfile(),
+    RecordDecl.time_from_course: FieldProfile(1000, 0, "s"),
+    RecordDecl.cycle_length: FieldProfile(100, 0, "m"),
+    RecordDecl.temperature: FieldProfile(1, 0, "C"),
+    RecordDecl.speed_1s: FieldProfile(16, 0, "m/s"),
+    RecordDecl.cycles: FieldProfile(1, 0, "cycles"),
+    RecordDecl.total_cycles: FieldProfile(1, 0, "cycles"),
+    RecordDecl.compressed_accumulated_power: FieldProfile(1, 0, "watts"),
+    RecordDecl.accumulated_power: FieldProfile(1, 0, "watts"),
+    RecordDecl.gps_accuracy: FieldProfile(1, 0, "m"),
+    RecordDecl.vertical_speed: FieldProfile(1000, 0, "m/s"),
+    RecordDecl.calories: FieldProfile(1, 0, "kcal"),
+    RecordDecl.vertical_oscillation: FieldProfile(10, 0, "mm"),
+    RecordDecl.stance_time_percent: FieldProfile(100, 0, "percent"),
+    RecordDecl.stance_time: FieldProfile(10, 0, "ms"),
+    RecordDecl.left_torque_effectiveness: FieldProfile(2, 0, "percent"),
+    RecordDecl.right_torque_effectiveness: FieldProfile(2, 0, "percent"),
+    RecordDecl.left_pedal_smoothness: FieldProfile(2, 0, "percent"),
+    RecordDecl.right_pedal_smoothness: FieldProfile(2, 0, "percent"),
+    RecordDecl.combined_pedal_smoothness: FieldProfile(2, 0, "percent"),
+    RecordDecl.time_128: FieldProfile(128, 0, "s"),
+    RecordDecl.ball_speed: FieldProfile(100, 0, "m/s"),
+    RecordDecl.cadence_256: FieldProfile(256, 0, "rpm"),
+    RecordDecl.total_hemoglobin_conc: FieldProfile(100, 0, "g/dL"),
+    RecordDecl.total_hemoglobin_conc_min: FieldProfile(100, 0, "g/dL"),
+    RecordDecl.total_hemoglobin_conc_max: FieldProfile(100, 0, "g/dL"),
+    RecordDecl.saturated_hemoglobin_percent: FieldProfile(10, 0, "%"),
+    RecordDecl.saturated_hemoglobin_percent_min: FieldProfile(10, 0, "%"),
+    RecordDecl.saturated_hemoglobin_percent_max: FieldProfile(10, 0, "%"),
+    RecordDecl.time_stamp: FieldProfile(1, 0, "s"),
+}
+
+# Sessions and laps share the profiles of their summary fields
+
+def _summary_profile(decl):
+    return {
+        decl.start_position_lat: FieldProfile(_semicircles_per_degree, 0, "degrees"),
+        decl.start_position_long: FieldProfile(_semicircles_per_degree, 0, "degrees"),
+        decl.total_elapsed_time: FieldProfile(1000, 0, "s"),
+        decl.total_timer_time: FieldProfile(1000, 0, "s"),
+        decl.total_distance: FieldProfile(100, 0, "m"),
+        decl.total_cycles: FieldProfile(1, 0, "cycles"),
+        decl.total_calories: FieldProfile(1, 0, "kcal"),
+        decl.avg_speed: FieldProfile(1000, 0, "m/s"),
+        decl.max_speed: FieldProfile(1000, 0, "m/s"),
+        decl.avg_heart_rate: FieldProfile(1, 0, "bpm"),
+        decl.max_heart_rate: FieldProfile(1, 0, "bpm"),
+        decl.avg_cadence: FieldProfile(1, 0, "rpm"),
+        decl.max_cadence: FieldProfile(1, 0, "rpm"),
+        decl.avg_power: FieldProfile(1, 0, "watts"),
+        decl.max_power: FieldProfile(1, 0, "watts"),
+        decl.total_ascent: FieldProfile(1, 0, "m"),
+        decl.total_descent: FieldProfile(1, 0, "m"),
+        decl.time_stamp: FieldProfile(1, 0, "s"),
+    }
+
+session_profile = _summary_profile(SessionDecl)
+
+lap_profile = _summary_profile(LapDecl)
+lap_profile.update({
+    LapDecl.end_position_lat: FieldProfile(_semicircles_per_degree, 0, "degrees"),
+    LapDecl.end_position_long: FieldProfile(_semicircles_per_degree, 0, "degrees"),
+})
+
+activity_profile = {
+    ActivityDecl.total_timer_time: FieldProfile(1000, 0, "s"),
+    ActivityDecl.time_stamp: FieldProfile(1, 0, "s"),
+}
+
+field_profiles = {
+    GlobalMessageDecl.record: record_profile,
+    GlobalMessageDecl.session: session_profile,
+    GlobalMessageDecl.lap: lap_profile,
+    GlobalMessageDecl.activity: activity_profile,
+}
 
 # Internal helper methods for reading integers from streams
 # TODO: convert these methods into static class methods where we switch on a global
@@ -259,25 +614,39 @@ class FileHeader:
 # parsed.
 
 class FieldDefinition:
-    def __init__(self, stream, current_offset):
+    __slots__ = ('field_definition_number', 'field_size', 'field_offset', 'field_type', 'developer_data_index')
+
+    # Developer field definitions have the same layout, except that their
+    # third byte is the index of the developer whose field_description
+    # messages describe them. Their type comes from that description, and
+    # fields without one are read as byte arrays (see MessageDefinition).
+
+    def __init__(self, stream, current_offset, is_developer_field = False):
         self.field_definition_number = read_uint8(stream)
         self.field_size = read_uint8(stream)
         self.field_offset = current_offset
-        self.field_type = read_uint8(stream)
+        if is_developer_field:
+            self.developer_data_index = read_uint8(stream)
+            self.field_type = None
+        else:
+            self.developer_data_index = None
+            self.field_type = read_uint8(stream)
 
 class MessageDefinition:
-    def __init__(self, header, stream):
+    __slots__ = ('architecture', 'global_message_number', 'field_definitions', 'developer_field_definitions',
+                 'developer_fields', 'developer_profiles', 'size', 'field_decoders', 'record_struct', 'has_timestamp')
+
+    def __init__(self, header, stream, developer_data = None):
         reserved = read_uint8(stream)
 
         # 0 == Definition and Data messages are little-endian
         # 1 == Definition and Data messages are big-endian
-
-        # TODO: actually do something with this flag. right now everything
-        # that we see is little-endian
+        # The byte order is compiled into the decoders of the definition, so
+        # files that mix both byte orders are decoded at the same speed.
 
         self.architecture = read_uint8(stream)
 
-        self.global_message_number = read_uint16(stream)
+        self.global_message_number = int.from_bytes(stream.read(2), byteorder = "big" if self.architecture == 1 else "little")
 
         self.field_definitions = []
         field_count = read_uint8(stream)
@@ -288,114 +657,459 @@ class MessageDefinition:
             self.field_definitions.append(field_definition)
             current_offset += field_definition.field_size
 
+        # Bit 5 of the header flags developer fields, which follow the native
+        # fields in the definition and in every data message
+        self.developer_field_definitions = None
+        if header & 0x20:
+            self.developer_field_definitions = []
+            developer_field_count = read_uint8(stream)
+
+            for i in range(developer_field_count):
+                field_definition = FieldDefinition(stream, current_offset, True)
+                self.developer_field_definitions.append(field_definition)
+                current_offset += field_definition.field_size
+
         self.size = current_offset
+        self._compile(developer_data)
+
+    # Compile the lookup table used by Message.get. This happens once per
+    # definition rather than once per message: field_decoders maps a field
+    # number to an (offset, Struct, invalid, converter) tuple, and
+    # record_struct unpacks every field of a record in a single call. Both
+    # use the byte order of the definition. Integer fields have no converter;
+    # floats, arrays, strings and byte arrays are converted by Message.get.
+    # record_struct returns arrays, strings and byte arrays as raw bytes.
+    # Developer fields that developer_data describes are compiled the same
+    # way and keyed on their name; the others are only skipped over.
+
+    def _compile(self, developer_data):
+        byte_order = '>' if self.architecture == 1 else '<'
+        self.field_decoders = {}
+        self.developer_fields = []
+        self.developer_profiles = {}
+        record_format = byte_order
+
+        # Fields without a description are read as byte arrays, named after
+        # their developer data index and field number
+        for field_definition in self.developer_field_definitions or ():
+            description = developer_data.describe(field_definition) if developer_data is not None else None
+            if description is not None:
+                field_definition.field_type = description.field_type
+                self.developer_fields.append((description.name, field_definition))
+                self.developer_profiles[description.name] = description.profile
+            else:
+                field_definition.field_type = FieldType.byte_array
+                self.developer_fields.append((_developer_field_name(field_definition.developer_data_index,
+                                                                    field_definition.field_definition_number),
+                                              field_definition))
+
+        for field_key, field_definition in self.keyed_field_definitions():
+            decoder = _compile_decoder(field_definition, byte_order)
+            if decoder is not None and field_key not in self.field_decoders:
+                self.field_decoders[field_key] = decoder
+
+        for field_definition in self.field_definitions + (self.developer_field_definitions or []):
+            decoder = _compile_decoder(field_definition, byte_order)
+            if decoder is not None and decoder[3] in (None, _float_value):
+                record_format += decoder[1].format[1:]
+            else:
+                record_format += '%ds' % field_definition.field_size
+
+        self.record_struct = struct.Struct(record_format)
+        timestamp_decoder = self.field_decoders.get(timestamp_field_number)
+        self.has_timestamp = timestamp_decoder is not None and timestamp_decoder[3] is None
+
+    # The (key, FieldDefinition) pairs of every field that can be decoded:
+    # native fields keyed on their number, then developer fields keyed on
+    # their name
+
+    def keyed_field_definitions(self):
+        return [(field_definition.field_definition_number, field_definition)
+                for field_definition in self.field_definitions] + self.developer_fields
 
     def MessageDefinitionSize(self):
-        return len(self.field_definitions) * 3 + 5
+        size = len(self.field_definitions) * 3 + 5
+        if self.developer_field_definitions is not None:
+            size += 1 + len(self.developer_field_definitions) * 3
+        return size
 
 # A Message object represents one of the (many) message types 
-# that are defined in a .fit file. A Message object contains a 
-# byte array that contains the actual data from the file.
+# that are defined in a .fit file. A Message object references the
+# buffer that contains the actual data from the file, along with the
+# offset of the message within that buffer. When reading from a stream
+# the buffer is a bytes object holding just this message; in zero-copy
+# mode it is the whole file and no per-message copy is made. Messages
+# that were read with a compressed timestamp header carry the timestamp
+# that was reconstructed from the header. Messages are slotted, as a file
+# can contain hundreds of thousands of them.
 
 class Message:
+    __slots__ = ('header', 'message_definition', 'buffer', 'offset', 'timestamp')
 
     # Compute some constants that will be used in this class
 
     fit_zero_time = datetime(1989, 12, 31, 0, 0, 0, 0)
     posix_zero_time = datetime(1970, 1, 1, 0, 0, 0, 0)
     offset_seconds = fit_zero_time - posix_zero_time
+    offset_total_seconds = offset_seconds.total_seconds()
 
-    def __init__(self, header, message_definition, stream):
+    def __init__(self, header, message_definition, buffer, offset = 0, timestamp = None):
         self.header = header
         self.message_definition = message_definition
-        self.message_data = stream.read(message_definition.size)
-        self._is_initialized = False
-
-    # Linear search through a Message's FieldDefinitions 
-    # If found, will also guarantee that the internal BinaryReader
-    # over the Message is initialized, and pointing at the start
-    # of the field.
-    # Returns None if not found.
-
-    def _get_field_definition(self, field_number):
-        for field_definition in self.message_definition.field_definitions:
-            if field_definition.field_definition_number == field_number:
-                if not self._is_initialized:
-                    self._stream = io.BytesIO(self.message_data)
-                    self._is_initialized = True
-                self._stream.seek(field_definition.field_offset)
-                return field_definition
-        return None
-                    
+        self.buffer = buffer
+        self.offset = offset
+        self.timestamp = timestamp
+
+    # The raw bytes of the message. In zero-copy mode this copies the
+    # message out of the underlying buffer.
+
+    @property
+    def message_data(self):
+        return bytes(self.buffer[self.offset:self.offset + self.message_definition.size])
+
     # Retrieve a field from the message, given a field_decl enum whose value
-    # is an integer field number.
+    # is an integer field number. The offset and decoder for the field were
+    # compiled when the MessageDefinition was parsed, so this is a dict lookup
+    # followed by a single unpack_from over the buffer. Floats are returned
+    # as floats, strings as str, byte arrays as bytes and array fields as a
+    # tuple with None for invalid elements. Developer fields are retrieved
+    # by the name in their field_description, e.g. message.get("Form Power").
+    # Returns None if the field is not present or holds the invalid value.
 
     def get(self, field_decl):
+        decoder = self.message_definition.field_decoders.get(field_decl)
+        if decoder is not None:
+            offset, element_struct, invalid, converter = decoder
+            if converter is not None:
+                return converter(element_struct.unpack_from(self.buffer, self.offset + offset), invalid)
+            value = element_struct.unpack_from(self.buffer, self.offset + offset)[0]
+            if value != invalid:
+                return value
+        elif field_decl == timestamp_field_number:
+            return self.timestamp
+        return None
 
-        field_definition = self._get_field_definition(field_decl)
-        if field_definition is not None: 
-            field_type = FieldType(field_definition.field_type)
+    # Unpack every field of the message in a single call. Values are returned
+    # in the order of the MessageDefinition's field_definitions followed by
+    # its developer_field_definitions; arrays,
+    # strings, byte arrays and fields that cannot be decoded are returned as
+    # raw bytes.
+
+    def unpack(self):
+        return self.message_definition.record_struct.unpack_from(self.buffer, self.offset)
+
+    # Read a field converted into the units of its FIT profile, e.g. speed in
+    # m/s rather than mm/s. Fields without a profile are returned unchanged.
+
+    def get_converted(self, field_decl):
+        value = self.get(field_decl)
+        message_definition = self.message_definition
+        profile = field_profiles.get(message_definition.global_message_number, {}).get(field_decl)
+        if profile is None:
+            profile = message_definition.developer_profiles.get(field_decl)
+        if value is None or profile is None or not profile.is_scaled:
+            return value
+        if isinstance(value, tuple):
+            return tuple(None if element is None else profile.convert(element) for element in value)
+        return profile.convert(value)
 
-            if field_type is FieldType.int8:
-                return read_int8(self._stream)
+    # Read the field described by field_decl as a Python datetime object
 
-            elif field_type is FieldType.uint8:
-                return read_uint8(self._stream)
+    def get_as_datetime(self, field_decl):
+        timestamp = self.get(field_decl)
+        if timestamp is None:
+            return None
 
-            elif field_type is FieldType.uint8z:
-                value = read_uint8(self._stream)
-                return value if value != 0 else None
+        elif timestamp < 0x10000000:
 
-            elif field_type is FieldType.int16:
-                return read_int16(self._stream)
+            # The documentation claims that this is a "system time" value. I don't know what
+            # this is - what system? The local system? Right now I'm returning None here 
+            # since I don't understand how to compute this value given the information 
+            # available. It's entirely possible that this is just a datetime.fromtimestamp()
+            # call without the FIT offset computation.
 
-            elif field_type is FieldType.uint16:
-                return read_uint16(self._stream)
+            return None
+        else:
 
-            elif field_type is FieldType.uint16z:
-                value = read_uint16(self._stream)
-                return value if value != 0 else None 
+            # Need to add difference between UTC 00:00 Dec 31 1989 and UTC 00:00 Jan 01 1970
+            # to generate a legal Unix timestamp. This was pre-computed in the class
+
+            return datetime.fromtimestamp(timestamp + Message.offset_total_seconds)
+
+# Developer fields are described within the file itself: a developer_data_id
+# message assigns an index to an application, and field_description messages
+# give the name, base type, scale, offset and units of each of its fields.
+# Each parse keeps one registry for the file and feeds it these messages as
+# they go by, so that the definitions that follow can compile their developer
+# fields into ordinary decoders and dtypes. Nothing is looked up per record.
+
+developer_data_messages = frozenset([GlobalMessageDecl.developer_data_id, GlobalMessageDecl.field_description])
+
+class DeveloperFieldDescription:
+    __slots__ = ('developer_data_index', 'field_definition_number', 'field_type', 'name', 'profile')
+
+    def __init__(self, developer_data_index, field_definition_number, field_type, name, profile):
+        self.developer_data_index = developer_data_index
+        self.field_definition_number = field_definition_number
+        self.field_type = field_type
+        self.name = name
+        self.profile = profile
+
+# The name of a developer field that has no field_name, or no description
+
+def _developer_field_name(developer_data_index, field_definition_number):
+    return "developer_%d_%d" % (developer_data_index, field_definition_number)
+
+class DeveloperDataRegistry:
+    def __init__(self):
+        self.application_ids = {}
+        self.descriptions = {}
+
+    # Register a developer_data_id or field_description message. Messages
+    # of any other type are ignored.
+
+    def add(self, message):
+        global_message_number = message.message_definition.global_message_number
+        if global_message_number == GlobalMessageDecl.developer_data_id:
+            self._add_developer(message)
+        elif global_message_number == GlobalMessageDecl.field_description:
+            self._add_field(message)
+
+    # The description of a developer FieldDefinition, or None if it has none
+
+    def describe(self, field_definition):
+        return self.descriptions.get((field_definition.developer_data_index, field_definition.field_definition_number))
+
+    # A developer data index that is reassigned to another application loses
+    # the fields that were described for the previous one
+
+    def _add_developer(self, message):
+        developer_data_index = message.get(DeveloperDataIdDecl.developer_data_index)
+        if developer_data_index is None:
+            return
+
+        application_id = message.get(DeveloperDataIdDecl.application_id)
+        if self.application_ids.get(developer_data_index, application_id) != application_id:
+            self.descriptions = {key: description for key, description in self.descriptions.items()
+                                 if key[0] != developer_data_index}
+        self.application_ids[developer_data_index] = application_id
+
+    # Fields are named after their field_name. Unnamed fields, and fields
+    # whose name is already taken by another developer field, are named after
+    # their developer data index and field number instead.
+
+    def _add_field(self, message):
+        developer_data_index = message.get(FieldDescriptionDecl.developer_data_index)
+        field_definition_number = message.get(FieldDescriptionDecl.field_definition_number)
+        base_type = message.get(FieldDescriptionDecl.fit_base_type_id)
+        if developer_data_index is None or field_definition_number is None or base_type not in _base_types:
+            return
+
+        key = (developer_data_index, field_definition_number)
+        name = message.get(FieldDescriptionDecl.field_name)
+        if name is None:
+            name = _developer_field_name(*key)
+        elif any(description.name == name for other, description in self.descriptions.items() if other != key):
+            name += "_%d_%d" % key
+
+        scale = message.get(FieldDescriptionDecl.scale)
+        offset = message.get(FieldDescriptionDecl.offset)
+        profile = FieldProfile(scale or 1, offset or 0, message.get(FieldDescriptionDecl.units))
+        self.descriptions[key] = DeveloperFieldDescription(developer_data_index, field_definition_number,
+                                                           FieldType(base_type), name, profile)
+
+# Readers abstract over where the bytes of a .fit file come from, so that a
+# single parse loop can work over a file stream or over an in-memory buffer.
+# read() has the usual file semantics, read_header() returns the next record
+# header byte and read_record() returns a (buffer, offset) pair for the
+# Message that follows. skip() moves past a record without reading it and
+# read_at() reads bytes from an earlier position without moving. compute_crc()
+# returns the CRC16 of everything that has been read so far.
+
+class _StreamReader:
+    def __init__(self, stream):
+        self.stream = stream
 
-            elif field_type is FieldType.int32:
-                return read_int32(self._stream)
+    def read(self, size):
+        return self.stream.read(size)
 
-            elif field_type is FieldType.uint32:
-                return read_uint32(self._stream)
+    def read_header(self):
+        return self.stream.read(1)[0]
 
-            elif field_type is FieldType.uint32z:
-                value = read_uint32(self._stream)
-                return value if value != 0 else None
+    # This design reads the current message into an in-memory byte array.
+    # An alternate design would involve passing in the current binary reader
+    # and allowing the caller of Message to read fields using the binary
+    # reader directly instead of creating a MemoryStream over the byte array
+    # and using a different BinaryReader in the Message. I have done 
+    # exactly this and measured the performance, and it is actually SLOWER
+    # than this approach. I haven't root caused why, but would assume that
+    # Seek-ing arbitrarily using the BinaryReader over the FileStream is 
+    # slow vs. Seek-ing over a BinaryReader over a MemoryStream.
 
-        return None
+    def read_record(self, size):
+        return self.stream.read(size), 0
 
-    # Read the field described by field_decl as a Python datetime object
+    def skip(self, size):
+        self.stream.seek(size, io.SEEK_CUR)
 
-    def get_as_datetime(self, field_decl):
-        field_definition = self._get_field_definition(field_decl)
-        if field_definition is not None: 
-            field_type = FieldType(field_definition.field_type)
+    def read_at(self, position, size):
+        current_position = self.stream.tell()
+        self.stream.seek(position)
+        data = self.stream.read(size)
+        self.stream.seek(current_position)
+        return data
 
-        if field_type is FieldType.uint32:
-            timestamp = read_uint32(self._stream)
-            if timestamp < 0x10000000:
+# Stream reader that feeds everything it reads into a running CRC, so that
+# validating a file does not need a second pass over it
 
-                # The documentation claims that this is a "system time" value. I don't know what
-                # this is - what system? The local system? Right now I'm returning None here 
-                # since I don't understand how to compute this value given the information 
-                # available. It's entirely possible that this is just a datetime.fromtimestamp()
-                # call without the FIT offset computation.
+class _CrcStreamReader(_StreamReader):
+    def __init__(self, stream):
+        _StreamReader.__init__(self, stream)
+        self.crc = Crc16()
 
-                return None
-            else:
+    def read(self, size):
+        data = self.stream.read(size)
+        self.crc.update(data)
+        return data
 
-                # Need to add difference between UTC 00:00 Dec 31 1989 and UTC 00:00 Jan 01 1970
-                # to generate a legal Unix timestamp. This was pre-computed in the class
+    def read_header(self):
+        return self.read(1)[0]
 
-                return datetime.fromtimestamp(timestamp + Message.offset_seconds.total_seconds())
-        else:
-            return None
+    def read_record(self, size):
+        return self.read(size), 0
+
+    # Skipped records must still be read to be checksummed
+
+    def skip(self, size):
+        self.read(size)
+
+    def compute_crc(self):
+        return self.crc.digest()
+
+# Zero-copy reader over a bytes, bytearray, mmap or any other object that
+# supports the buffer protocol. Reads return memoryview slices and records
+# are returned as offsets into the one shared buffer.
+
+class _BufferReader:
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer).cast('B')
+        self.position = 0
+
+    def read(self, size):
+        start = self.position
+        self.position += size
+        return self.buffer[start:self.position]
+
+    def read_header(self):
+        header = self.buffer[self.position]
+        self.position += 1
+        return header
+
+    def read_record(self, size):
+        offset = self.position
+        self.position += size
+        return self.buffer, offset
 
-def parse_fit_file(path, validate_crc = False):
+    def skip(self, size):
+        self.position += size
+
+    def read_at(self, position, size):
+        return self.buffer[position:position + size]
+
+    # The whole buffer is checksummed in a single call once parsing is done
+
+    def compute_crc(self):
+        return crc16(self.buffer[:self.position])
+
+# Opt-in instrumentation of a parse. A ParseStats object that is passed as
+# stats= collects counts and cumulative times per phase and per global
+# message, the bytes that were decoded and skipped, and the definitions that
+# were found. The parsers only check whether stats is None in their inner
+# loops, so parsing without stats costs next to nothing extra.
+
+class ParseStats:
+    """Counts and timings collected while parsing a .fit file.
+
+    Pass an instance as the stats parameter of parse_fit_file, parse_fit_buffer,
+    parse_fit_columns or parse_fit_as_dataframe. A single instance can be passed to several
+    parses to accumulate their totals. Times measure the parser only, not the code that consumes
+    the messages it yields.
+
+    Examples
+    --------
+    >>> stats = ParseStats()
+    >>> frame = parse_fit_as_dataframe('fit_file.fit', [RecordDecl.power], stats = stats)
+    >>> metrics.send(stats.as_dict())
+    """
+
+    def __init__(self):
+        self.phases = {}
+        self.messages = {}
+        self.skipped = {}
+        self.definitions = {}
+        self.bytes_decoded = 0
+        self.bytes_skipped = 0
+
+    def add_phase(self, phase, seconds, count = 1):
+        totals = self.phases.setdefault(phase, [0, 0.0])
+        totals[0] += count
+        totals[1] += seconds
+
+    def add_definition(self, message_definition):
+        global_message_number = message_definition.global_message_number
+        self.definitions[global_message_number] = self.definitions.get(global_message_number, 0) + 1
+
+    # Records that were decoded into messages or columns
+
+    def add_message(self, global_message_number, size, seconds = 0.0, count = 1):
+        totals = self.messages.setdefault(global_message_number, [0, 0, 0.0])
+        totals[0] += count
+        totals[1] += size
+        totals[2] += seconds
+        self.bytes_decoded += size
+
+    # Records that were filtered out
+
+    def add_skipped(self, global_message_number, size, seconds = 0.0, count = 1):
+        totals = self.skipped.setdefault(global_message_number, [0, 0, 0.0])
+        totals[0] += count
+        totals[1] += size
+        totals[2] += seconds
+        self.bytes_skipped += size
+
+    def as_dict(self):
+        """Export the statistics as a dict of plain values.
+
+        Returns
+        -------
+        dict
+            phases maps a phase name to its count and seconds; messages and skipped map a global
+            message name to its count, bytes and seconds; definitions maps a global message name
+            to the number of definitions found for it. Unknown global messages are named by number.
+        """
+
+        def by_message(totals):
+            return {_message_name(global_message_number): {"count": count, "bytes": size, "seconds": seconds}
+                    for global_message_number, (count, size, seconds) in totals.items()}
+
+        return {
+            "phases": {phase: {"count": count, "seconds": seconds} for phase, (count, seconds) in self.phases.items()},
+            "messages": by_message(self.messages),
+            "skipped": by_message(self.skipped),
+            "definitions": {_message_name(global_message_number): count
+                            for global_message_number, count in self.definitions.items()},
+            "bytes_decoded": self.bytes_decoded,
+            "bytes_skipped": self.bytes_skipped,
+            }
+
+def _message_name(global_message_number):
+    try:
+        return GlobalMessageDecl(global_message_number).name
+    except ValueError:
+        return str(int(global_message_number))
+
+def parse_fit_file(path, validate_crc = False, use_mmap = False, messages = None, fields = None, start = None, end = None,
+                   reuse = False, stats = None):
     """Parse a fit file.
 
     Parameters
@@ -403,42 +1117,167 @@ def parse_fit_file(path, validate_crc = False):
     path: string
         Path to the .fit file
     validate_crc: bool
-        Compute the CRC16 of the file and compare with embedded CRC16. Default is False.
+        Compute the CRC16 of the file as it is read and compare with embedded CRC16. A ValueError
+        is raised after the last message if they differ. Default is False.
+    use_mmap: bool
+        Memory-map the file and parse it in zero-copy mode (see parse_fit_buffer). The mapping is
+        closed when the parse ends or the generator is closed, unless yielded Messages are still
+        held, which keep it open until they are garbage collected. With reuse, the Message is
+        unbound when the parse ends, so the mapping is always closed. Default is False.
+    messages: iterable of GlobalMessageDecl
+        Only yield messages of these global message types. Default is None, which yields all.
+    fields: iterable of int
+        Only yield messages whose definition contains at least one of these field numbers. Default
+        is None, which yields all.
+    start: datetime or int
+        Only yield messages whose timestamp is at or after start. A naive datetime is interpreted as
+        UTC, like the index of parse_fit_as_dataframe; an int is a raw FIT
+        timestamp. Messages without a timestamp are not yielded when start or end is given.
+        Default is None.
+    end: datetime or int
+        Only yield messages whose timestamp is before end. Default is None.
+    reuse: bool
+        Yield the same Message object for every record, rebound to each record in turn, instead of
+        creating a new one per record. A yielded Message is only valid until the next one is
+        yielded or the parse ends. Default is False.
+    stats: ParseStats
+        Collect counts and timings of the parse into this object. Default is None.
 
     Yields
     ------
     Message
-        Individual Message objects from the .fit file.
+        Individual Message objects from the .fit file. Records that are filtered out by messages or
+        fields are skipped over without being read, and records outside of the time range are
+        never turned into Message objects.
 
     Examples
     --------
     >>> for message in parse_fit_file('fit_file.fit'):
             pass
+    >>> laps = list(parse_fit_file('fit_file.fit', messages = [GlobalMessageDecl.lap]))
     """
 
-    stream = io.open(path, "rb")
-    file_header = FileHeader(stream)
+    if use_mmap:
+        with io.open(path, "rb") as stream:
+            buffer = mmap.mmap(stream.fileno(), 0, access = mmap.ACCESS_READ)
+
+        records = parse_fit_buffer(buffer, validate_crc, messages, fields, start, end, reuse, stats)
+        try:
+            yield from records
+        finally:
+            # Close the mapping once the parse is over, unless Messages that
+            # the caller still holds refer to it: it is then closed when the
+            # last of them is garbage collected
+            records.close()
+            del records
+            try:
+                buffer.close()
+            except BufferError:
+                pass
+    else:
+        with io.open(path, "rb") as stream:
+            reader = _CrcStreamReader(stream) if validate_crc else _StreamReader(stream)
+            yield from _parse_fit(reader, validate_crc, messages, fields, start, end, reuse, stats)
+
+def parse_fit_buffer(buffer, validate_crc = False, messages = None, fields = None, start = None, end = None, reuse = False,
+                     stats = None):
+    """Parse a .fit file that is already in memory, without copying it.
 
-    if validate_crc:
-        pos = stream.seek(0)
-        crc = compute_crc(stream, file_header.size + file_header.data_size)
-        file_crc = read_uint16(stream)
+    Parameters
+    ----------
+    buffer: bytes, bytearray, mmap or memoryview
+        The contents of the .fit file
+    validate_crc: bool
+        Compute the CRC16 of the buffer and compare with embedded CRC16. A ValueError is raised
+        after the last message if they differ. Default is False.
+    messages, fields, start, end:
+        Filters applied before messages are decoded, as for parse_fit_file.
+    reuse: bool
+        Rebind a single Message object to each record, as for parse_fit_file. Default is False.
+    stats: ParseStats
+        Collect counts and timings of the parse into this object. Default is None.
 
-        # TODO: debug why CRC is failing with real files
-        # print(pos, format(self.crc, "0x"), format(self.file_crc, "0x"))
+    Yields
+    ------
+    Message
+        Individual Message objects from the buffer. Each Message refers to the
+        buffer and its offset within it rather than holding a copy of its data,
+        so the buffer must not be modified while the messages are in use.
+
+    Examples
+    --------
+    >>> for message in parse_fit_buffer(upload.read()):
+            pass
+    """
 
-        # Seek to the start of the data (past the file header)
-        pos = stream.seek(file_header.size)
+    return _parse_fit(_BufferReader(buffer), validate_crc, messages, fields, start, end, reuse, stats)
+
+# Convert a start or end time to a raw FIT timestamp. Naive datetimes are in
+# UTC, so that the same bounds select the same rows whatever the time zone of
+# the machine.
+
+def _to_fit_timestamp(value):
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo = timezone.utc)
+        return int(value.timestamp() - Message.offset_total_seconds)
+    return value
+
+def _parse_fit(stream, validate_crc, messages = None, fields = None, start = None, end = None, reuse = False,
+               stats = None):
+    if stats is not None:
+        clock = time.perf_counter
+        started = clock()
+
+    file_header = FileHeader(stream)
+
+    if stats is not None:
+        stats.add_phase("file_header", clock() - started)
 
     bytes_to_read = file_header.data_size
     bytes_read = 0
 
+    # Whether a definition passes the messages and fields filters is decided
+    # once, when the definition is read
+    if messages is not None:
+        messages = set(messages)
+    if fields is not None:
+        fields = set(fields)
+
+    def is_selected(message_definition):
+        return (messages is None or message_definition.global_message_number in messages) and \
+               (fields is None or not fields.isdisjoint(message_definition.field_decoders))
+
+    is_time_filtered = start is not None or end is not None
+    start = _to_fit_timestamp(start) if start is not None else 0
+    end = _to_fit_timestamp(end) if end is not None else 1 << 32
+
     # Message definitions are parsed internally by the parser and not exposed to
-    # the caller. We store all of them in this dict:
+    # the caller. We store all of them, along with whether they are selected
+    # and whether their messages describe developer fields, in this dict:
     local_message_definitions = {}
 
+    # Developer fields are described by messages that are read even when the
+    # filters skip them
+    developer_data = DeveloperDataRegistry()
+
+    # Compressed timestamp headers carry a 5 bit offset from the most recent
+    # timestamp in the file. Rather than decoding the timestamp of every
+    # message as it goes by, we remember where the last one was in the file
+    # and only read it when a compressed timestamp header shows up. This
+    # works for records that were skipped, too.
+    last_timestamp = None
+    last_timestamp_position = None
+    last_timestamp_definition = None
+
+    # The Message that is rebound to every record when reuse is set
+    message = Message(None, None, None) if reuse else None
+
     while bytes_read < bytes_to_read:
-        header = read_uint8(stream)
+        if stats is not None:
+            started = clock()
+
+        header = stream.read_header()
 
         # Normal header (vs. timestamp offset header is indicated by bit 7)
         # Message type is indicated by bit 6 
@@ -446,28 +1285,304 @@ def parse_fit_file(path, validate_crc = False):
         #   0 == record
         local_message_number = header & 0xf
 
-        if (header & 0x80) == 0 and (header & 0x40) == 0x40:
+        if (header & 0x80) == 0x80:
+
+            # Compressed timestamp header: bits 5-6 are the local message type
+            # and bits 0-4 the time offset, which rolls over every 32 seconds
+            local_message_number = (header >> 5) & 0x3
+            current_message_definition, selected, describes_fields = local_message_definitions[local_message_number]
+
+            if last_timestamp_position is not None:
+                offset, element_struct, invalid, _ = last_timestamp_definition.field_decoders[timestamp_field_number]
+                data = stream.read_at(last_timestamp_position + offset, element_struct.size)
+                timestamp = element_struct.unpack(data)[0]
+                if timestamp != invalid:
+                    last_timestamp = timestamp
+                last_timestamp_position = None
+            if last_timestamp is not None:
+                last_timestamp += ((header & 0x1f) - last_timestamp) & 0x1f
+            timestamp = last_timestamp
+
+        elif (header & 0x40) == 0x40:
 
             # Parse the message definition and store the definition in our array
-            message_definition = MessageDefinition(header, stream)
-            local_message_definitions[local_message_number] = message_definition
+            message_definition = MessageDefinition(header, stream, developer_data)
+            local_message_definitions[local_message_number] = \
+                (message_definition, is_selected(message_definition),
+                 message_definition.global_message_number in developer_data_messages)
             bytes_read += message_definition.MessageDefinitionSize() + 1
 
-        elif (header & 0x80) == 0 and (header & 0x40) == 0:
+            if stats is not None:
+                stats.add_definition(message_definition)
+                stats.add_phase("definition", clock() - started)
+            continue
+
+        else:
+            current_message_definition, selected, describes_fields = local_message_definitions[local_message_number]
+            timestamp = None
+            if current_message_definition.has_timestamp:
+                last_timestamp_position = file_header.size + bytes_read + 1
+                last_timestamp_definition = current_message_definition
+
+        size = current_message_definition.size
+        bytes_read += size + 1
+
+        if not selected and not describes_fields:
+            stream.skip(size)
+            if stats is not None:
+                _add_skipped(stats, current_message_definition, clock() - started)
+            continue
+
+        buffer, offset = stream.read_record(size)
+
+        if describes_fields:
+            developer_data.add(Message(header, current_message_definition, buffer, offset))
+            if not selected:
+                if stats is not None:
+                    _add_skipped(stats, current_message_definition, clock() - started)
+                continue
+
+        # The time range is checked against the raw timestamp before anything
+        # else is decoded or a Message is created
+        if is_time_filtered:
+            if timestamp is None:
+                decoder = current_message_definition.field_decoders.get(timestamp_field_number)
+                if current_message_definition.has_timestamp:
+                    timestamp = decoder[1].unpack_from(buffer, offset + decoder[0])[0]
+                    if timestamp == decoder[2]:
+                        timestamp = None
+            if timestamp is None or timestamp < start or timestamp >= end:
+                if stats is not None:
+                    _add_skipped(stats, current_message_definition, clock() - started)
+                continue
+
+        if stats is not None:
+            seconds = clock() - started
+            stats.add_message(current_message_definition.global_message_number, size, seconds)
+            stats.add_phase("record", seconds)
+
+        if message is None:
+            yield Message(header, current_message_definition, buffer, offset, timestamp)
+        else:
+            message.header = header
+            message.message_definition = current_message_definition
+            message.buffer = buffer
+            message.offset = offset
+            message.timestamp = timestamp
+            try:
+                yield message
+            except GeneratorExit:
+                message.buffer = None
+                raise
+
+    # The reused Message no longer refers to the buffer once the parse is over
+    if message is not None:
+        message.buffer = None
+
+    # The file CRC covers the file header and the data section and follows
+    # immediately after the data
+
+    if validate_crc:
+        if stats is not None:
+            started = clock()
+
+        crc = stream.compute_crc()
+        file_crc = read_uint16(stream)
+
+        if stats is not None:
+            stats.add_phase("crc", clock() - started)
+
+        if crc != file_crc:
+            raise ValueError("CRC mismatch: computed 0x%04x, file contains 0x%04x" % (crc, file_crc))
+
+# Record a data message that was skipped by the filters of _parse_fit
+
+def _add_skipped(stats, message_definition, seconds):
+    stats.add_skipped(message_definition.global_message_number, message_definition.size, seconds)
+    stats.add_phase("skip", seconds)
+
+# Incremental parser for .fit data that arrives in chunks, e.g. from a network
+# upload, a device sync or a file that is still being written. This is the
+# same header/definition/data logic as _parse_fit, written as a state machine
+# that stops at the first incomplete header, definition or record and resumes
+# there when more data is fed. Each chunk is parsed in zero-copy mode: the
+# Messages it returns refer to the chunk, and only the incomplete tail of a
+# chunk is carried over into the next one, so the cost of a feed is one pass
+# of Python code per message, not per byte.
+
+class FitPushParser:
+    """Parse a .fit file that is pushed to the parser in chunks.
+
+    Parameters
+    ----------
+    validate_crc: bool
+        Compute the CRC16 of the data as it is fed and compare with embedded CRC16. A ValueError
+        is raised by the feed (or close) that completes the file if they differ. Default is False.
+
+    Examples
+    --------
+    >>> parser = FitPushParser()
+    >>> for chunk in chunks:
+            for message in parser.feed(chunk):
+                pass
+    >>> parser.close()
+    """
+
+    def __init__(self, validate_crc = False):
+        self.crc = Crc16() if validate_crc else None
+        self.pending = b''
+        self.file_header = None
+        self.bytes_to_read = None
+        self.bytes_read = 0
+        self.local_message_definitions = {}
+        self.developer_data = DeveloperDataRegistry()
+
+        # The most recent message with a timestamp field. Its timestamp is
+        # only decoded when a compressed timestamp header needs it.
+        self.last_timestamp = None
+        self.last_timestamp_message = None
+
+        self.finished = False
+
+    def feed(self, data):
+        """Parse the next chunk of the file.
+
+        Parameters
+        ----------
+        data: bytes, bytearray or memoryview
+            The bytes that follow the previously fed chunk. The data is copied if it is not a bytes
+            object, so the caller may reuse its buffer.
+
+        Returns
+        -------
+        list[Message]
+            The messages completed by this chunk, which may be none. Headers, definitions and
+            records that are split across chunks are returned once their last byte has been fed.
+            When the file header has no data size, the last two bytes fed may be the file CRC, so
+            a record ending in them is returned by the next feed (or not at all, if it was the CRC).
+        """
+
+        if self.finished:
+            return []
+
+        data = b''.join((self.pending, data)) if self.pending else bytes(data)
+        reader = _BufferReader(data)
+        buffer = reader.buffer
+        length = len(buffer)
+        messages = []
+
+        if self.file_header is None:
+            if length == 0 or length < buffer[0]:
+                self.pending = data
+                return messages
+            self.file_header = FileHeader(reader)
+            reader.position = self.file_header.size
+
+            # Files that are still being written may not have their data
+            # size filled in yet, in which case we parse until close()
+            self.bytes_to_read = self.file_header.data_size or (1 << 64)
+
+        # Without a data size, the last two bytes fed so far may be the file
+        # CRC, so they are held back until more data arrives
+        if self.file_header.data_size == 0:
+            length -= 2
+
+        local_message_definitions = self.local_message_definitions
+        while self.bytes_read < self.bytes_to_read:
+            position = reader.position
+            if position >= length:
+                break
+            header = buffer[position]
+
+            if (header & 0xc0) == 0x40:
+
+                # A definition is 5 bytes followed by 3 bytes per field, so
+                # its size is known once the field count is available. With
+                # developer fields, a count of those and 3 bytes per developer
+                # field follow.
+                if length - position < 6:
+                    break
+                size = 6 + 3 * buffer[position + 5]
+                if header & 0x20:
+                    if length - position < size + 1:
+                        break
+                    size += 1 + 3 * buffer[position + size]
+                if length - position < size:
+                    break
+
+                reader.position = position + 1
+                local_message_definitions[header & 0xf] = MessageDefinition(header, reader, self.developer_data)
+                self.bytes_read += size
+                continue
+
+            if (header & 0x80) == 0x80:
+                local_message_number = (header >> 5) & 0x3
+            else:
+                local_message_number = header & 0xf
+
             current_message_definition = local_message_definitions[local_message_number]
-            assert current_message_definition is not None
-
-            # This design reads the current message into an in-memory byte array.
-            # An alternate design would involve passing in the current binary reader
-            # and allowing the caller of Message to read fields using the binary
-            # reader directly instead of creating a MemoryStream over the byte array
-            # and using a different BinaryReader in the Message. I have done 
-            # exactly this and measured the performance, and it is actually SLOWER
-            # than this approach. I haven't root caused why, but would assume that
-            # Seek-ing arbitrarily using the BinaryReader over the FileStream is 
-            # slow vs. Seek-ing over a BinaryReader over a MemoryStream.
-
-            message = Message(header, current_message_definition, stream)
-            yield message 
-
-            bytes_read += current_message_definition.size + 1
\ No newline at end of file
+
+            size = current_message_definition.size + 1
+            if length - position < size:
+                break
+
+            timestamp = None
+            if (header & 0x80) == 0x80:
+                if self.last_timestamp_message is not None:
+                    timestamp = self.last_timestamp_message.get(timestamp_field_number)
+                    if timestamp is not None:
+                        self.last_timestamp = timestamp
+                    self.last_timestamp_message = None
+                if self.last_timestamp is not None:
+                    self.last_timestamp += ((header & 0x1f) - self.last_timestamp) & 0x1f
+                timestamp = self.last_timestamp
+
+            message = Message(header, current_message_definition, buffer, position + 1, timestamp)
+            if (header & 0x80) == 0 and current_message_definition.has_timestamp:
+                self.last_timestamp_message = message
+            if current_message_definition.global_message_number in developer_data_messages:
+                self.developer_data.add(message)
+            messages.append(message)
+
+            reader.position = position + size
+            self.bytes_read += size
+
+        consumed = reader.position
+        if self.crc is not None:
+            self.crc.update(buffer[:consumed])
+
+        # The file CRC follows immediately after the data section
+        if self.bytes_read >= self.bytes_to_read and length - consumed >= 2:
+            if self.crc is not None:
+                crc = self.crc.digest()
+                file_crc = int.from_bytes(buffer[consumed:consumed + 2], byteorder = "little")
+                if crc != file_crc:
+                    raise ValueError("CRC mismatch: computed 0x%04x, file contains 0x%04x" % (crc, file_crc))
+            consumed += 2
+            self.finished = True
+
+        self.pending = data[consumed:]
+        return messages
+
+    def close(self):
+        """Signal the end of the data.
+
+        Raises a ValueError if the file is incomplete. For a file whose header has no data size,
+        which is what a file that was still being written looks like, the last two bytes that were
+        fed are its CRC.
+        """
+
+        if self.finished:
+            return
+
+        if self.file_header is not None and self.file_header.data_size == 0 and len(self.pending) == 2:
+            if self.crc is not None:
+                crc = self.crc.digest()
+                file_crc = int.from_bytes(self.pending, byteorder = "little")
+                if crc != file_crc:
+                    raise ValueError("CRC mismatch: computed 0x%04x, file contains 0x%04x" % (crc, file_crc))
+            self.pending = b''
+            self.finished = True
+            return
+
+        raise ValueError("Incomplete .fit data: %d bytes of data section read" % self.bytes_read)
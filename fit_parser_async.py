@@ -0,0 +1,86 @@
+# asyncio front-end for the parser
+#
+# aparse_fit parses a .fit file while it is still being received, e.g. from
+# an HTTP upload. Bytes are fed to the incremental parser as they arrive and
+# the next chunk is already being read while the current one is parsed, so
+# parsing overlaps with the network instead of waiting for the whole upload.
+# Chunks of more than a few KB are parsed (and checksummed) on an executor so
+# that the event loop is not blocked.
+
+import asyncio
+from fit_parser import FitPushParser
+
+default_chunk_size = 1 << 16
+
+# Chunks at least this large are parsed on the executor; smaller ones are
+# cheaper to parse inline than to hand off to another thread. This is well
+# below default_chunk_size because StreamReader.read returns whatever has
+# arrived, which on a network connection is usually much less than requested.
+_offload_threshold = 1 << 12
+
+async def aparse_fit(source, validate_crc = False, chunk_size = default_chunk_size, executor = None):
+    """Parse a .fit file from an asynchronous byte source as the bytes arrive.
+
+    Parameters
+    ----------
+    source: asyncio.StreamReader or async iterable of bytes
+        Where the .fit file is read from. Any object with an async read(n) method is read in chunks
+        of chunk_size bytes; anything else is iterated with async for.
+    validate_crc: bool
+        Compute the CRC16 of the data as it arrives and compare with embedded CRC16. A ValueError
+        is raised after the last message if they differ. Default is False.
+    chunk_size: int
+        Number of bytes requested from source per read. Default is 64 KB.
+    executor: concurrent.futures.Executor
+        Executor that chunks of 4 KB or more are parsed on. Default is None, which uses the default
+        executor of the running loop.
+
+    Yields
+    ------
+    Message
+        Individual Message objects, as soon as the chunk that completes them has been received.
+        A ValueError is raised if the source ends before the end of the .fit file.
+
+    Examples
+    --------
+    >>> async for message in aparse_fit(reader):
+            pass
+    """
+
+    loop = asyncio.get_running_loop()
+    parser = FitPushParser(validate_crc)
+    chunks = _read_chunks(source, chunk_size).__aiter__()
+
+    # Read one chunk ahead of the parser
+    next_chunk = asyncio.ensure_future(chunks.__anext__())
+    try:
+        while True:
+            try:
+                chunk = await next_chunk
+            except StopAsyncIteration:
+                break
+            next_chunk = asyncio.ensure_future(chunks.__anext__())
+
+            if len(chunk) >= _offload_threshold:
+                messages = await loop.run_in_executor(executor, parser.feed, chunk)
+            else:
+                messages = parser.feed(chunk)
+
+            for message in messages:
+                yield message
+
+        parser.close()
+    finally:
+        if not next_chunk.done():
+            next_chunk.cancel()
+
+async def _read_chunks(source, chunk_size):
+    if hasattr(source, "read"):
+        while True:
+            chunk = await source.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    else:
+        async for chunk in source:
+            yield chunk
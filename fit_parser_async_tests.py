@@ -0,0 +1,101 @@
+# asyncio FIT parser tests
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import io
+import unittest
+from fit_parser import parse_fit_file
+from fit_parser_async import aparse_fit
+from fit_parser_tests import build_compressed_timestamp_file, compressed_timestamp_expected
+
+def read_file(path):
+    with io.open(path, "rb") as stream:
+        return stream.read()
+
+# Yield data in chunks of the given size, handing control back to the event
+# loop between chunks like a network connection would
+
+async def iterate_chunks(data, chunk_size):
+    for position in range(0, len(data), chunk_size):
+        await asyncio.sleep(0)
+        yield data[position:position + chunk_size]
+
+async def collect(source, **kwargs):
+    return [(message.message_definition.global_message_number, message.message_data, message.timestamp)
+            async for message in aparse_fit(source, **kwargs)]
+
+class FitAsyncParserTestMethods(unittest.TestCase):
+
+    def test_matches_parse_fit_file(self):
+        filename = "large_file.fit"
+        expected = [(message.message_definition.global_message_number, message.message_data, message.timestamp)
+                    for message in parse_fit_file(filename)]
+        data = read_file(filename)
+
+        # Chunks that split headers, definitions and records, and chunks large
+        # enough to be parsed on the executor
+        for chunk_size in [1, 7, 4096, 1 << 20]:
+            actual = asyncio.run(collect(iterate_chunks(data, chunk_size), validate_crc = True))
+            self.assertEqual(actual, expected)
+
+    def test_stream_reader(self):
+        data = read_file("large_file.fit")
+
+        async def parse():
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            return await collect(reader, chunk_size = 1000)
+
+        self.assertEqual(len(asyncio.run(parse())), len(list(parse_fit_file("large_file.fit"))))
+
+    def test_stream_reader_uses_executor(self):
+        data = read_file("large_file.fit")
+
+        # Count the chunks handed to the executor
+        class CountingExecutor(ThreadPoolExecutor):
+            submitted = 0
+
+            def submit(self, *args, **kwargs):
+                CountingExecutor.submitted += 1
+                return ThreadPoolExecutor.submit(self, *args, **kwargs)
+
+        # Data arrives in segments smaller than the chunk size, as it does
+        # from a network connection
+        async def parse():
+            reader = asyncio.StreamReader()
+
+            async def receive():
+                for position in range(0, len(data), 8192):
+                    reader.feed_data(data[position:position + 8192])
+                    await asyncio.sleep(0)
+                reader.feed_eof()
+
+            receiving = asyncio.ensure_future(receive())
+            with CountingExecutor(max_workers = 1) as executor:
+                messages = await collect(reader, executor = executor, validate_crc = True)
+            await receiving
+            return messages
+
+        self.assertEqual(len(asyncio.run(parse())), len(list(parse_fit_file("large_file.fit"))))
+        self.assertGreater(CountingExecutor.submitted, 0)
+
+    def test_compressed_timestamps(self):
+        async def parse():
+            return [message.get(253) async for message in aparse_fit(iterate_chunks(build_compressed_timestamp_file(), 3))]
+
+        self.assertEqual(asyncio.run(parse()), compressed_timestamp_expected)
+
+    def test_truncated_upload(self):
+        data = read_file("large_file.fit")
+        with self.assertRaises(ValueError):
+            asyncio.run(collect(iterate_chunks(data[:len(data) // 2], 4096)))
+
+    def test_crc_mismatch(self):
+        data = bytearray(read_file("large_file.fit"))
+        data[-1] ^= 0xff
+        with self.assertRaises(ValueError):
+            asyncio.run(collect(iterate_chunks(bytes(data), 4096), validate_crc = True))
+
+if __name__ == '__main__':
+    unittest.main()
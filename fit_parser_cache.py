@@ -0,0 +1,292 @@
+# Persistent on-disk cache of decoded .fit columns
+#
+# Decoding a file with parse_fit_columns is fast, but dashboards that read
+# the same activities over and over still pay for it every time. FitCache
+# keeps the decoded columns of every global message in a cache directory as
+# one .npy file per column, which is read back memory-mapped. Entries are
+# keyed on the size, modification time and trailing CRC16 of the .fit file,
+# so a file that changes gets a new entry, and the least recently used
+# entries are evicted once the cache grows past its size limit. Fields with a
+# scaled profile are also stored converted into their units (see
+# MessageColumns.get_converted), so converted columns are read back for free.
+# Other files that are kept in the cache directory, like the summaries of
+# fit_analytics, count towards the size limit and are evicted the same way.
+#
+# Layout of an entry:
+#
+#   <cache_dir>/<size>-<mtime>-<crc>/<global message number>/offsets.npy
+#   <cache_dir>/<size>-<mtime>-<crc>/<global message number>/<field number>.npy
+#   <cache_dir>/<size>-<mtime>-<crc>/<global message number>/<field number>.mask.npy
+#   <cache_dir>/<size>-<mtime>-<crc>/<global message number>/<field number>.converted.npy
+#
+# Object columns, which hold the fields whose type changes between
+# definitions, are stored without pickling as the bytes of every row, their
+# offsets and their types, in place of <field number>.npy:
+#
+#   <cache_dir>/<size>-<mtime>-<crc>/<global message number>/<field number>.objects.npy
+#   <cache_dir>/<size>-<mtime>-<crc>/<global message number>/<field number>.object_offsets.npy
+#   <cache_dir>/<size>-<mtime>-<crc>/<global message number>/<field number>.object_types.npy
+#
+# Entries are always loaded with allow_pickle = False, and an entry that
+# cannot be loaded that way is a miss that is replaced.
+
+import io
+import os
+import shutil
+import tempfile
+import time
+import urllib.parse
+import numpy as np
+from fit_parser import GlobalMessageDecl
+from fit_parser_columns import MessageColumns, parse_fit_columns
+
+default_cache_size = 1 << 30
+
+class FitCache:
+    def __init__(self, cache_dir, max_bytes = default_cache_size):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok = True)
+
+    # The key of a .fit file: its size, modification time and the CRC16 that
+    # is stored in its last two bytes. Only the trailer is read, not the data.
+
+    def key(self, path):
+        stat = os.stat(path)
+        with io.open(path, "rb") as stream:
+            stream.seek(-2, os.SEEK_END)
+            crc = int.from_bytes(stream.read(2), byteorder = "little")
+        return "%d-%d-%04x" % (stat.st_size, stat.st_mtime_ns, crc)
+
+    def parse_fit_columns(self, path, messages = None, fields = None, workers = None, stats = None):
+        """Parse a .fit file into typed NumPy columns, using the cache when possible.
+
+        Takes the same parameters and returns the same result as fit_parser_columns.parse_fit_columns.
+        On a miss every message in the file is decoded and stored, so that any later request for the
+        same file, whatever its messages and fields, is served from the cache without parsing. Cached
+        columns are memory-mapped read-only. With stats, a hit is recorded as a cache_load phase and a
+        miss as the phases of the parse followed by a cache_store phase.
+        """
+
+        if stats is not None:
+            started = time.perf_counter()
+
+        entry = os.path.join(self.cache_dir, self.key(path))
+        try:
+            result = self._load(entry, messages, fields)
+            if result is not None:
+                # Mark the entry as recently used
+                os.utime(entry)
+                if stats is not None:
+                    stats.add_phase("cache_load", time.perf_counter() - started)
+                return result
+        except FileNotFoundError:
+            # The entry was evicted while we were reading it
+            pass
+        except ValueError:
+            # The entry holds something other than plain arrays
+            shutil.rmtree(entry, ignore_errors = True)
+
+        columns_by_message = parse_fit_columns(path, workers = workers, stats = stats)
+
+        if stats is not None:
+            started = time.perf_counter()
+
+        self._store(entry, columns_by_message)
+
+        if stats is not None:
+            stats.add_phase("cache_store", time.perf_counter() - started)
+
+        return _select(columns_by_message, messages, fields)
+
+    def _load(self, entry, messages, fields):
+        if not os.path.isdir(entry):
+            return None
+
+        if messages is None:
+            messages = [int(name) for name in os.listdir(entry)]
+        if fields is not None:
+            fields = set(fields)
+
+        result = {}
+        for global_message_number in messages:
+            directory = os.path.join(entry, str(int(global_message_number)))
+            if not os.path.isdir(directory):
+                continue
+
+            try:
+                global_message_number = GlobalMessageDecl(global_message_number)
+            except ValueError:
+                pass
+
+            offsets = np.load(os.path.join(directory, "offsets.npy"), mmap_mode = "r")
+            columns = MessageColumns(global_message_number, offsets)
+            for name in sorted(os.listdir(directory)):
+                file_name, extension = name.split(".", 1)
+                if extension not in ("npy", "objects.npy") or file_name == "offsets":
+                    continue
+                field_number = _field_key(file_name)
+                if fields is not None and field_number not in fields:
+                    continue
+
+                if extension == "npy":
+                    values = np.load(os.path.join(directory, name), mmap_mode = "r")
+                else:
+                    values = _load_objects(os.path.join(directory, file_name))
+                mask_path = os.path.join(directory, "%s.mask.npy" % file_name)
+                mask = np.load(mask_path, mmap_mode = "r") if os.path.exists(mask_path) else np.ma.nomask
+                columns[field_number] = np.ma.MaskedArray(values, mask = mask, copy = False)
+
+                converted_path = os.path.join(directory, "%s.converted.npy" % file_name)
+                if os.path.exists(converted_path):
+                    converted = np.load(converted_path, mmap_mode = "r")
+                    columns.converted[field_number] = np.ma.MaskedArray(converted, mask = mask, copy = False)
+
+            result[global_message_number] = columns
+
+        return result
+
+    # Write the entry to a temporary directory and then rename it into place,
+    # so that readers (and other processes) never see a partial entry
+
+    def _store(self, entry, columns_by_message):
+        temporary = tempfile.mkdtemp(dir = self.cache_dir, prefix = ".tmp-")
+        try:
+            for global_message_number, columns in columns_by_message.items():
+                directory = os.path.join(temporary, str(int(global_message_number)))
+                os.mkdir(directory)
+                np.save(os.path.join(directory, "offsets.npy"), columns.offsets)
+                for field_number, values in columns.items():
+                    file_name = _file_name(field_number)
+                    if values.dtype.kind == 'O':
+                        _save_objects(os.path.join(directory, file_name), np.ma.getdata(values))
+                    else:
+                        np.save(os.path.join(directory, "%s.npy" % file_name), np.ma.getdata(values))
+                    if np.ma.is_masked(values):
+                        np.save(os.path.join(directory, "%s.mask.npy" % file_name), np.ma.getmaskarray(values))
+                    converted = columns.get_converted(field_number)
+                    if converted is not values:
+                        np.save(os.path.join(directory, "%s.converted.npy" % file_name), np.ma.getdata(converted))
+            os.rename(temporary, entry)
+        except OSError:
+            # Another process stored the same entry first
+            shutil.rmtree(temporary, ignore_errors = True)
+            if not os.path.isdir(entry):
+                raise
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries and files until the cache fits in max_bytes.
+
+        Every entry directory and every file in the cache directory counts, except those whose name
+        starts with a dot, which are being written. Files are used by touching them.
+        """
+
+        entries = []
+        total_bytes = 0
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith("."):
+                continue
+            try:
+                if os.path.isdir(entry):
+                    size = 0
+                    for directory, _, filenames in os.walk(entry):
+                        for filename in filenames:
+                            size += os.path.getsize(os.path.join(directory, filename))
+                else:
+                    size = os.path.getsize(entry)
+                entries.append((os.path.getmtime(entry), size, entry))
+                total_bytes += size
+            except FileNotFoundError:
+                # Evicted by another process
+                pass
+
+        entries.sort()
+        while total_bytes > self.max_bytes and len(entries) > 0:
+            _, size, entry = entries.pop(0)
+            if os.path.isdir(entry):
+                shutil.rmtree(entry, ignore_errors = True)
+            else:
+                try:
+                    os.remove(entry)
+                except FileNotFoundError:
+                    pass
+            total_bytes -= size
+
+# Store an object column as the bytes of every row, their offsets and their
+# types: "bytes" for bytes, a NumPy type string for a number and the same
+# followed by "[]" for an array. Missing rows have an empty type.
+
+def _save_objects(path, values):
+    payloads = []
+    types = []
+    for value in values:
+        if value is None:
+            payloads.append(b"")
+            types.append("")
+        elif isinstance(value, bytes):
+            payloads.append(value)
+            types.append("bytes")
+        else:
+            array = np.asarray(value)
+            payloads.append(array.tobytes())
+            types.append(array.dtype.str + ("[]" if array.ndim == 1 else ""))
+
+    offsets = np.zeros(len(payloads) + 1, dtype = np.int64)
+    np.cumsum([len(payload) for payload in payloads], out = offsets[1:])
+    np.save(path + ".objects.npy", np.frombuffer(b"".join(payloads), dtype = np.uint8), allow_pickle = False)
+    np.save(path + ".object_offsets.npy", offsets, allow_pickle = False)
+    np.save(path + ".object_types.npy", np.array(types, dtype = str), allow_pickle = False)
+
+def _load_objects(path):
+    payload = np.load(path + ".objects.npy").tobytes()
+    offsets = np.load(path + ".object_offsets.npy")
+    types = np.load(path + ".object_types.npy")
+
+    values = np.empty(len(types), dtype = object)
+    for row, value_type in enumerate(types.tolist()):
+        data = payload[offsets[row]:offsets[row + 1]]
+        if value_type == "bytes":
+            values[row] = data
+        elif value_type.endswith("[]"):
+            values[row] = np.frombuffer(data, dtype = value_type[:-2]).copy()
+        elif value_type != "":
+            values[row] = np.frombuffer(data, dtype = value_type)[0].item()
+    return values
+
+# Columns are stored as <field number>.npy, and developer fields as @<name>.npy
+# with the name percent-encoded so that it is a valid file name without dots
+
+def _file_name(field_number):
+    if isinstance(field_number, str):
+        return "@" + urllib.parse.quote(field_number, safe = "").replace(".", "%2E")
+    return "%d" % field_number
+
+def _field_key(file_name):
+    if file_name.startswith("@"):
+        return urllib.parse.unquote(file_name[1:])
+    return int(file_name)
+
+# Restrict the result of a full parse to the requested messages and fields
+
+def _select(columns_by_message, messages, fields):
+    if messages is not None:
+        messages = set(messages)
+        columns_by_message = {global_message_number: columns
+                              for global_message_number, columns in columns_by_message.items()
+                              if global_message_number in messages}
+    if fields is None:
+        return columns_by_message
+
+    fields = set(fields)
+    result = {}
+    for global_message_number, columns in columns_by_message.items():
+        selected = MessageColumns(global_message_number, columns.offsets)
+        selected.profiles = columns.profiles
+        selected.update((field_number, values) for field_number, values in columns.items() if field_number in fields)
+        selected.converted.update((field_number, values) for field_number, values in columns.converted.items()
+                                  if field_number in fields)
+        result[global_message_number] = selected
+    return result
@@ -0,0 +1,109 @@
+# FIT column cache tests
+
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+import fit_parser_cache
+from fit_parser import GlobalMessageDecl, RecordDecl
+from fit_parser_cache import FitCache
+from fit_parser_columns import parse_fit_columns
+from fit_parser_dataframe import parse_fit_as_dataframe
+
+class Unpickleable:
+    def __reduce__(self):
+        return (_fail_unpickling, ())
+
+def _fail_unpickling():
+    raise AssertionError("the cache unpickled a column")
+
+class FitCacheTestMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_hit_does_not_parse(self):
+        filename = "large_file.fit"
+        fields = [RecordDecl.power, RecordDecl.heart_rate]
+        expected = parse_fit_columns(filename, [GlobalMessageDecl.record], fields)[GlobalMessageDecl.record]
+
+        cache = FitCache(self.cache_dir)
+        cache.parse_fit_columns(filename, [GlobalMessageDecl.record], fields)
+
+        def fail(*args, **kwargs):
+            raise AssertionError("cache hit parsed the file")
+
+        parse = fit_parser_cache.parse_fit_columns
+        fit_parser_cache.parse_fit_columns = fail
+        try:
+            actual = cache.parse_fit_columns(filename, [GlobalMessageDecl.record], fields)[GlobalMessageDecl.record]
+            frame = parse_fit_as_dataframe(filename, [RecordDecl.time_stamp, RecordDecl.cadence], cache_dir = self.cache_dir)
+        finally:
+            fit_parser_cache.parse_fit_columns = parse
+
+        self.assertEqual(sorted(actual), sorted(fields))
+        self.assertTrue(isinstance(np.ma.getdata(actual[RecordDecl.power]), np.memmap))
+        for field in fields:
+            self.assertEqual(actual[field].tolist(), expected[field].tolist())
+        self.assertTrue(frame.equals(parse_fit_as_dataframe(filename, [RecordDecl.time_stamp, RecordDecl.cadence])))
+
+    def test_eviction(self):
+        directory = tempfile.mkdtemp()
+        try:
+            filenames = [os.path.join(directory, "%d.fit" % i) for i in range(3)]
+            for i, filename in enumerate(filenames):
+                shutil.copy("large_file.fit", filename)
+                os.utime(filename, ns = (i, i))
+
+            cache = FitCache(self.cache_dir, max_bytes = 1)
+            for filename in filenames:
+                columns = cache.parse_fit_columns(filename, [GlobalMessageDecl.record], [RecordDecl.power])
+                self.assertEqual(len(columns[GlobalMessageDecl.record][RecordDecl.power]), 18456)
+            self.assertEqual([name for name in os.listdir(self.cache_dir) if not name.startswith(".")], [])
+
+            cache = FitCache(self.cache_dir)
+            for filename in filenames:
+                cache.parse_fit_columns(filename)
+            self.assertEqual(len(os.listdir(self.cache_dir)), 3)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_pickled_entry_is_a_miss(self):
+        filename = "large_file.fit"
+        cache = FitCache(self.cache_dir)
+        expected = cache.parse_fit_columns(filename, [GlobalMessageDecl.record], [RecordDecl.power])
+
+        # A column that can only be loaded by unpickling it
+        entry = os.path.join(self.cache_dir, cache.key(filename), str(int(GlobalMessageDecl.record)))
+        np.save(os.path.join(entry, "%d.npy" % RecordDecl.power), np.array([Unpickleable()], dtype = object))
+
+        actual = cache.parse_fit_columns(filename, [GlobalMessageDecl.record], [RecordDecl.power])
+        self.assertEqual(actual[GlobalMessageDecl.record][RecordDecl.power].tolist(),
+                         expected[GlobalMessageDecl.record][RecordDecl.power].tolist())
+
+        # The entry was replaced
+        power = np.load(os.path.join(entry, "%d.npy" % RecordDecl.power), allow_pickle = False)
+        self.assertEqual(power.tolist(), np.ma.getdata(actual[GlobalMessageDecl.record][RecordDecl.power]).tolist())
+
+    def test_converted_columns_are_cached(self):
+        filename = "large_file.fit"
+        fields = [RecordDecl.speed, RecordDecl.power]
+        expected = parse_fit_columns(filename, [GlobalMessageDecl.record], fields)[GlobalMessageDecl.record]
+
+        cache = FitCache(self.cache_dir)
+        cache.parse_fit_columns(filename, [GlobalMessageDecl.record], fields)
+        actual = cache.parse_fit_columns(filename, [GlobalMessageDecl.record], fields)[GlobalMessageDecl.record]
+
+        # Only scaled fields are stored converted
+        self.assertEqual(list(actual.converted), [RecordDecl.speed])
+        self.assertTrue(isinstance(np.ma.getdata(actual.converted[RecordDecl.speed]), np.memmap))
+        self.assertEqual(actual.get_converted(RecordDecl.speed).tolist(),
+                         expected.get_converted(RecordDecl.speed).tolist())
+        self.assertIs(actual.get_converted(RecordDecl.power), actual[RecordDecl.power])
+
+if __name__ == '__main__':
+    unittest.main()
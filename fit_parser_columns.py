@@ -0,0 +1,624 @@
+# Columnar bulk decoding of .fit files with NumPy
+#
+# Instead of yielding one Message object per record, this engine makes one
+# pass over the data section to find the offset of every data message and
+# the MessageDefinition that was in effect for it. All of the records that
+# share a definition are then gathered into a contiguous buffer and decoded
+# with a single numpy.frombuffer call using a structured dtype compiled from
+# that definition. Invalid values (0xFF, 0xFFFF, 0 for the z types, ...) come
+# back masked. Timestamps of messages with compressed timestamp headers are
+# rebuilt for the whole file at once with a cumulative sum.
+#
+# The first pass produces a FitIndex. Because every data message in the index
+# already knows its definition, the second pass can be split into chunks that
+# are decoded in parallel and stitched back together in file order. NumPy
+# releases the GIL while it gathers and copies the records, so the chunks are
+# decoded on a thread pool.
+
+from concurrent.futures import ThreadPoolExecutor
+import io
+import time
+import numpy as np
+from fit_parser import DeveloperDataRegistry, FieldType, FileHeader, GlobalMessageDecl, Message, MessageDefinition, \
+    _BufferReader, _base_types, developer_data_messages, field_profiles, timestamp_field_number
+
+# NumPy equivalents of the FIT base types, with the value that marks an
+# invalid field, derived from the base types of the parser so that the two
+# always agree. Floats are compared by their bit pattern, strings are invalid
+# when empty and byte arrays when every byte is 0xff. Strings and byte arrays
+# span the whole field; array fields of other types become 2-D columns.
+
+def _column_type(field_type, format_char, invalid):
+    if format_char == 's':
+        return ('S', b'') if field_type == FieldType.string else ('V', invalid)
+    return np.dtype(format_char).str[1:], invalid
+
+_column_types = {field_type: _column_type(field_type, *base_type) for field_type, base_type in _base_types.items()}
+
+# The decoded columns of a single global message. This is a dict that maps a
+# field number (or the name of a developer field) to a numpy.ma.MaskedArray
+# with one element per data message, in file order. The file offsets of
+# those data messages are kept alongside, as are the columns that have been
+# converted into the units of their profile, so that each column is
+# converted at most once, and the profiles of the developer fields.
+
+class MessageColumns(dict):
+    def __init__(self, global_message_number, offsets):
+        dict.__init__(self)
+        self.global_message_number = global_message_number
+        self.offsets = offsets
+        self.converted = {}
+        self.profiles = {}
+
+    def get_converted(self, field_number):
+        """Return the column of a field in the units of its FIT profile.
+
+        The stored values are scaled and offset in bulk into float32 when they fit in 16 bits,
+        which float32 holds with room to spare, and into float64 otherwise. Positions become
+        degrees. Fields without a scaled profile are returned unchanged. The converted column is
+        kept, so later calls are free.
+        """
+
+        values = self.converted.get(field_number)
+        if values is None:
+            values = convert_column(self.global_message_number, field_number, self[field_number],
+                                    self.profiles.get(field_number))
+            self.converted[field_number] = values
+        return values
+
+# Convert a decoded column into the units of its profile, which is looked up
+# in field_profiles unless it is given
+
+def convert_column(global_message_number, field_number, values, profile = None):
+    if profile is None:
+        profile = field_profiles.get(global_message_number, {}).get(field_number)
+    if profile is None or not profile.is_scaled or values.dtype.kind not in 'iuf':
+        return values
+
+    dtype = np.float32 if values.dtype.itemsize <= 2 else np.float64
+    data = np.ma.getdata(values).astype(dtype)
+    data /= dtype(profile.scale)
+    data -= dtype(profile.offset)
+    return np.ma.MaskedArray(data, mask = np.ma.getmask(values))
+
+# Compile a structured dtype that overlays a MessageDefinition's record
+# layout, in the byte order of the definition. Only the requested fields (or
+# all of them if fields is None) that the engine knows how to decode are
+# included, native fields named by number and developer fields by name.
+# Returns the dtype and a dict mapping each included field to its invalid
+# value.
+
+def _compile_dtype(message_definition, fields):
+    byte_order = '>' if message_definition.architecture == 1 else '<'
+    names = []
+    formats = []
+    offsets = []
+    invalid_values = {}
+
+    for field_number, field_definition in message_definition.keyed_field_definitions():
+        if field_number in invalid_values:
+            continue
+        if fields is not None and field_number not in fields:
+            continue
+
+        column_type = _column_types.get(field_definition.field_type)
+        if column_type is None:
+            continue
+
+        numpy_type, invalid = column_type
+        if numpy_type in ('S', 'V'):
+            numpy_type = np.dtype('%s%d' % (numpy_type, field_definition.field_size))
+        else:
+            numpy_type = np.dtype(byte_order + numpy_type)
+            count, remainder = divmod(field_definition.field_size, numpy_type.itemsize)
+            if count == 0 or remainder != 0:
+                continue
+            if count > 1:
+                numpy_type = np.dtype((numpy_type, (count,)))
+
+        names.append(_dtype_name(field_number))
+        formats.append(numpy_type)
+        offsets.append(field_definition.field_offset)
+        invalid_values[field_number] = invalid
+
+    dtype = np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                      'itemsize': message_definition.size})
+    return dtype, invalid_values
+
+# The name of a field in a compiled dtype. Developer field names are prefixed
+# with "@" so that a developer field named "7" does not clash with field 7.
+
+def _dtype_name(field_number):
+    if isinstance(field_number, str):
+        return "@" + field_number
+    return str(field_number)
+
+# An index of the data messages in a .fit file, built by walking only the
+# record headers and message definitions. For the i-th data message in the
+# file, offsets[i] is its position in the file, headers[i] its record header
+# and definitions[definition_ids[i]] the MessageDefinition in effect for it.
+# developer_data holds the developer fields that the file describes.
+
+class FitIndex:
+    def __init__(self, file_header, definitions, offsets, headers, definition_ids, developer_data = None):
+        self.file_header = file_header
+        self.definitions = definitions
+        self.offsets = offsets
+        self.headers = headers
+        self.definition_ids = definition_ids
+        self.developer_data = developer_data
+
+    # Positions within the index of the data messages of each definition, in
+    # file order. The list is aligned with definitions.
+
+    def messages_by_definition(self):
+        order = np.argsort(self.definition_ids, kind = 'stable')
+        counts = np.bincount(self.definition_ids, minlength = len(self.definitions))
+        return np.split(order, np.cumsum(counts)[:-1])
+
+def build_fit_index(buffer):
+    """Index the data messages of a .fit file without decoding them.
+
+    Parameters
+    ----------
+    buffer: bytes, bytearray, mmap or memoryview
+        The contents of the .fit file
+
+    Returns
+    -------
+    FitIndex
+        The offset, record header and definition of every data message in the file.
+    """
+
+    reader = _BufferReader(buffer)
+    file_header = FileHeader(reader)
+    view = reader.buffer
+    data = np.frombuffer(view, dtype = np.uint8)
+    position = file_header.size
+    end = position + file_header.data_size
+
+    local_message_definitions = {}
+    definitions = []
+    offsets = []
+    definition_ids = []
+
+    # The messages that describe developer fields are decoded as they are
+    # indexed, so that the definitions after them compile their fields
+    developer_data = DeveloperDataRegistry()
+
+    while position < end:
+        header = view[position]
+
+        if (header & 0x80) == 0x80:
+            # Compressed timestamp header: always a data message
+            local_message_number = (header >> 5) & 0x3
+        else:
+            local_message_number = header & 0xf
+
+        if (header & 0xc0) == 0x40:
+            reader.position = position + 1
+            message_definition = MessageDefinition(header, reader, developer_data)
+            local_message_definitions[local_message_number] = (len(definitions), message_definition)
+            definitions.append(message_definition)
+            position = reader.position
+            continue
+
+        definition_id, message_definition = local_message_definitions[local_message_number]
+        stride = message_definition.size + 1
+        if message_definition.global_message_number in developer_data_messages:
+            developer_data.add(Message(header, message_definition, view, position + 1))
+            count = 1
+        else:
+            count = _run_length(data, position, stride, local_message_number, end)
+        offsets.append(np.arange(position + 1, position + 1 + count * stride, stride, dtype = np.intp))
+        definition_ids.append(np.full(count, definition_id, dtype = np.intp))
+        position += count * stride
+
+    offsets = np.concatenate(offsets) if offsets else np.zeros(0, dtype = np.intp)
+    definition_ids = np.concatenate(definition_ids) if definition_ids else np.zeros(0, dtype = np.intp)
+    return FitIndex(file_header, definitions, offsets, data[offsets - 1], definition_ids, developer_data)
+
+# The number of consecutive data messages from the record header at start
+# that use the definition of local_message_number. Each of them is stride
+# bytes long, so their headers are found with a strided view of the data,
+# which is checked in blocks that double in size. The first message is
+# always counted; the others must end before end.
+
+def _run_length(data, start, stride, local_message_number, end):
+    limit = max(1, (end - start) // stride)
+    count = 1
+    block = 16
+    while count < limit:
+        stop = min(limit, count + block)
+        headers = data[start + count * stride:start + stop * stride:stride]
+        same = np.where(headers & 0x80, (headers >> 5) & 0x3, np.where(headers & 0x40, 0x10, headers & 0xf)) \
+            == local_message_number
+        if not same.all():
+            return count + int(np.argmin(same))
+        count = stop
+        block = min(block * 2, 1 << 16)
+    return count
+
+# Decode every field of the compiled dtype for the records at the given
+# offsets. A run of evenly spaced records (the usual case: one definition,
+# each record after a one byte header) is overlaid in place with a strided
+# view and nothing is copied. Otherwise the records are gathered into one
+# contiguous buffer through a view of every size byte window of the data, so
+# that the only index array has one entry per record.
+
+def _decode_records(data, offsets, size, dtype):
+    if size == 0 or len(offsets) == 0:
+        return np.zeros(len(offsets), dtype = dtype)
+
+    stride = int(offsets[1] - offsets[0]) if len(offsets) > 1 else size
+    if stride >= size and (len(offsets) == 2 or (np.diff(offsets) == stride).all()):
+        return np.ndarray(len(offsets), dtype = dtype, buffer = data, offset = int(offsets[0]), strides = (stride,))
+
+    rows = np.lib.stride_tricks.sliding_window_view(data, size)[offsets]
+    return np.frombuffer(rows, dtype = dtype)
+
+# Decode the records at the given offsets into a dict that maps each field
+# of invalid_values to a contiguous copy of its values and the mask of its
+# invalid values. This is where the bytes of the records are actually read.
+
+def _decode_fields(data, offsets, size, dtype, invalid_values):
+    records = _decode_records(data, offsets, size, dtype)
+    fields = {}
+    for field_number, invalid in invalid_values.items():
+        values = np.ascontiguousarray(records[_dtype_name(field_number)])
+        fields[field_number] = (values, _invalid_mask(values, invalid))
+    return fields
+
+# Chunks smaller than this are not worth handing to another thread
+
+_min_chunk_rows = 16384
+
+# Decode a list of (offsets, size, dtype, invalid_values) jobs, one per
+# definition, with _decode_fields. With more than one worker the jobs are
+# split into chunks that are decoded on a thread pool, then concatenated back
+# together in order.
+
+def _decode_all(data, jobs, workers):
+    if workers is None or workers <= 1:
+        return [_decode_fields(data, *job) for job in jobs]
+
+    total_rows = sum(len(offsets) for offsets, _, _, _ in jobs)
+    chunk_rows = max(_min_chunk_rows, -(-total_rows // workers))
+
+    chunks = []
+    chunk_counts = []
+    for offsets, size, dtype, invalid_values in jobs:
+        starts = range(0, max(len(offsets), 1), chunk_rows)
+        chunks.extend((offsets[start:start + chunk_rows], size, dtype, invalid_values) for start in starts)
+        chunk_counts.append(len(starts))
+
+    with ThreadPoolExecutor(max_workers = workers) as executor:
+        decoded = list(executor.map(lambda chunk: _decode_fields(data, *chunk), chunks))
+
+    results = []
+    position = 0
+    for count in chunk_counts:
+        parts = decoded[position:position + count]
+        if count > 1:
+            parts = [{field_number: (np.concatenate([part[field_number][0] for part in parts]),
+                                     np.concatenate([part[field_number][1] for part in parts]))
+                      for field_number in parts[0]}]
+        results.append(parts[0])
+        position += count
+    return results
+
+def parse_fit_columns(path, messages = None, fields = None, workers = None, stats = None):
+    """Parse a .fit file into typed NumPy columns, one set per global message.
+
+    Parameters
+    ----------
+    path: str
+        Path to the .fit file
+    messages: iterable of GlobalMessageDecl
+        The global messages to decode. Default is None, which decodes every message in the file.
+    fields: iterable of int
+        The field numbers to decode, e.g. RecordDecl.heart_rate. Default is None, which decodes
+        every field that the engine understands.
+    workers: int
+        Number of threads used to decode the records once they have been indexed. Default is None,
+        which decodes on the calling thread.
+    stats: ParseStats
+        Collect counts and timings of the parse into this object. Default is None.
+
+    Returns
+    -------
+    dict[GlobalMessageDecl, MessageColumns]
+        For each global message found, a dict mapping field number to a numpy.ma.MaskedArray.
+        Invalid values are masked, as are rows whose definition does not contain the field.
+
+    Examples
+    --------
+    >>> columns = parse_fit_columns('fit_file.fit', [GlobalMessageDecl.record], [RecordDecl.power])
+    >>> power = columns[GlobalMessageDecl.record][RecordDecl.power]
+    """
+
+    if stats is not None:
+        started = time.perf_counter()
+
+    with io.open(path, "rb") as stream:
+        buffer = stream.read()
+
+    if stats is not None:
+        started = _add_phase(stats, "read", started)
+
+    index = build_fit_index(buffer)
+    data = np.frombuffer(buffer, dtype = np.uint8)
+
+    if stats is not None:
+        started = _add_phase(stats, "index", started)
+        for message_definition in index.definitions:
+            stats.add_definition(message_definition)
+
+    if messages is not None:
+        messages = set(messages)
+    if fields is not None:
+        fields = set(fields)
+
+    # Compile a dtype for every definition of the requested messages, decode
+    # all of them and then group the results by the global message they
+    # describe, since a global message can be redefined any number of times
+    # within a file
+
+    messages_by_definition = index.messages_by_definition()
+    selected = []
+    jobs = []
+    for message_definition, positions in zip(index.definitions, messages_by_definition):
+        global_message_number = message_definition.global_message_number
+        if len(positions) == 0:
+            continue
+        if messages is not None and global_message_number not in messages:
+            if stats is not None:
+                stats.add_skipped(global_message_number, len(positions) * message_definition.size,
+                                  count = len(positions))
+            continue
+        if stats is not None:
+            stats.add_message(global_message_number, len(positions) * message_definition.size, count = len(positions))
+
+        dtype, invalid_values = _compile_dtype(message_definition, fields)
+        offsets = index.offsets[positions]
+        selected.append((global_message_number, offsets, message_definition.developer_profiles))
+        jobs.append((offsets, message_definition.size, dtype, invalid_values))
+
+    decoded = _decode_all(data, jobs, workers)
+
+    if stats is not None:
+        started = _add_phase(stats, "decode", started, len(jobs))
+
+    parts_by_message = {}
+    profiles_by_message = {}
+    for (global_message_number, offsets, profiles), fields_by_number in zip(selected, decoded):
+        parts_by_message.setdefault(global_message_number, []).append((offsets, fields_by_number))
+        profiles_by_message.setdefault(global_message_number, {}).update(profiles)
+
+    compressed = None
+    if (index.headers & 0x80).any() and (fields is None or timestamp_field_number in fields):
+        compressed = _reconstruct_timestamps(data, index, messages_by_definition)
+
+        if stats is not None:
+            started = _add_phase(stats, "timestamps", started)
+
+    result = {}
+    for global_message_number, parts in parts_by_message.items():
+        profiles = profiles_by_message[global_message_number]
+        try:
+            global_message_number = GlobalMessageDecl(global_message_number)
+        except ValueError:
+            pass
+        columns = _merge_parts(global_message_number, parts)
+        columns.profiles.update(profiles)
+        if compressed is not None:
+            _apply_compressed_timestamps(columns, *compressed)
+        result[global_message_number] = columns
+
+    if stats is not None:
+        _add_phase(stats, "merge", started, len(result))
+
+    return result
+
+# Add the time since started to a phase and return the current time
+
+def _add_phase(stats, phase, started, count = 1):
+    now = time.perf_counter()
+    stats.add_phase(phase, now - started, count)
+    return now
+
+# Decode the data messages of one global message, given as a list of
+# (MessageDefinition, offsets) groups, into MessageColumns in file order
+
+def _decode_message_columns(data, global_message_number, groups, fields = None):
+    if fields is not None:
+        fields = set(fields)
+    parts = []
+    for message_definition, offsets in groups:
+        dtype, invalid_values = _compile_dtype(message_definition, fields)
+        parts.append((offsets, _decode_fields(data, offsets, message_definition.size, dtype, invalid_values)))
+    columns = _merge_parts(global_message_number, parts)
+    for message_definition, _ in groups:
+        columns.profiles.update(message_definition.developer_profiles)
+    return columns
+
+# Rebuild the absolute timestamps of every message with a compressed
+# timestamp header. Each such message is a 5 bit rolling offset from the
+# previous timestamp in the file, so in between two messages with a full
+# timestamp (the anchors) the timestamps are the anchor plus a cumulative
+# sum of the rollover-corrected deltas between consecutive time offsets.
+# Returns the offsets of the compressed messages and a masked uint32 array
+# of their timestamps.
+
+def _reconstruct_timestamps(data, index, messages_by_definition):
+    is_compressed = (index.headers & 0x80) != 0
+    is_anchor = np.zeros(len(index.offsets), dtype = bool)
+    values = (index.headers & 0x1f).astype(np.int64)
+
+    for message_definition, positions in zip(index.definitions, messages_by_definition):
+        if not message_definition.has_timestamp:
+            continue
+        positions = positions[~is_compressed[positions]]
+        dtype, invalid_values = _compile_dtype(message_definition, [timestamp_field_number])
+        timestamps = _decode_records(data, index.offsets[positions], message_definition.size, dtype)
+        timestamps = timestamps[_dtype_name(timestamp_field_number)]
+        valid = timestamps != invalid_values[timestamp_field_number]
+        is_anchor[positions[valid]] = True
+        values[positions[valid]] = timestamps[valid]
+
+    # Only the anchors and compressed messages take part, already in file order
+    events = is_anchor | is_compressed
+    values = values[events]
+    is_anchor = is_anchor[events]
+
+    low_bits = np.where(is_anchor, values & 0x1f, values)
+    deltas = np.zeros(len(values), dtype = np.int64)
+    deltas[1:] = (low_bits[1:] - low_bits[:-1]) & 0x1f
+    deltas[is_anchor] = 0
+    elapsed = np.cumsum(deltas)
+
+    # Index of the most recent anchor at or before each event, -1 if none
+    anchors = np.maximum.accumulate(np.where(is_anchor, np.arange(len(values)), -1))
+    has_anchor = anchors >= 0
+    anchors = np.maximum(anchors, 0)
+    timestamps = values[anchors] + elapsed - elapsed[anchors]
+
+    compressed = ~is_anchor
+    return index.offsets[is_compressed], \
+        np.ma.MaskedArray(timestamps[compressed].astype(np.uint32), mask = ~has_anchor[compressed])
+
+# Fill in the timestamp column for the rows of a global message that were
+# read with a compressed timestamp header
+
+def _apply_compressed_timestamps(columns, compressed_offsets, timestamps):
+    rows = np.minimum(np.searchsorted(compressed_offsets, columns.offsets), len(compressed_offsets) - 1)
+    is_compressed = compressed_offsets[rows] == columns.offsets
+    if not is_compressed.any():
+        return
+
+    column = columns.get(timestamp_field_number)
+    if column is None:
+        column = np.ma.MaskedArray(np.zeros(len(columns.offsets), dtype = np.uint32), mask = True)
+    else:
+        column = column.astype(np.uint32)
+    column[is_compressed] = timestamps[rows[is_compressed]]
+    columns[timestamp_field_number] = column
+
+# Stitch the columns decoded for each definition of a global message back
+# into file order. Each part is the offsets of the records of one definition
+# and their fields, as returned by _decode_fields. Rows from definitions that
+# lack a field are masked.
+
+def _merge_parts(global_message_number, parts):
+    offsets = np.concatenate([part_offsets for part_offsets, _ in parts])
+    order = None
+    if len(parts) > 1:
+        order = np.argsort(offsets, kind = 'stable')
+        offsets = offsets[order]
+
+    field_numbers = []
+    for _, fields_by_number in parts:
+        for field_number in fields_by_number:
+            if field_number not in field_numbers:
+                field_numbers.append(field_number)
+
+    columns = MessageColumns(global_message_number, offsets)
+    for field_number in field_numbers:
+        values = []
+        masks = []
+        for _, fields_by_number in parts:
+            part_values, part_mask = fields_by_number.get(field_number, (None, None))
+            values.append(part_values)
+            masks.append(part_mask)
+
+        present = [part_values for part_values in values if part_values is not None]
+        dtype = _merged_dtype([part_values.dtype for part_values in present])
+        if dtype is None:
+            # The definitions disagree on the type of the field, or on the
+            # size of a byte array: keep every row as it was decoded
+            values, masks = zip(*[_to_objects(part_values, mask, len(part_offsets))
+                                  for part_values, mask, (part_offsets, _) in zip(values, masks, parts)])
+        else:
+            # An array field in any of the definitions makes the column 2-D,
+            # as wide as the widest definition of the field
+            shape = ()
+            if any(part_values.ndim == 2 for part_values in present):
+                shape = (max(part_values.shape[1] if part_values.ndim == 2 else 1 for part_values in present),)
+
+            values, masks = zip(*[_widen(part_values, mask, len(part_offsets), dtype, shape)
+                                  for part_values, mask, (part_offsets, _) in zip(values, masks, parts)])
+        values = np.concatenate(values) if len(values) > 1 else values[0]
+        mask = np.concatenate(masks) if len(masks) > 1 else masks[0]
+        if order is not None:
+            values = values[order]
+            mask = mask[order]
+
+        columns[field_number] = np.ma.MaskedArray(values, mask = mask)
+
+    return columns
+
+# The dtype that the parts of a column are merged into, or None if they have
+# to be merged into an object column. Numbers are promoted to a type that
+# holds them all and strings to the longest. Byte arrays are only merged when
+# they all have the same size, since padding would add bytes to the data.
+
+def _merged_dtype(dtypes):
+    kinds = set(dtype.kind for dtype in dtypes)
+    if 'V' in kinds:
+        return dtypes[0] if len(set(dtypes)) == 1 else None
+    if 'S' in kinds and kinds != {'S'}:
+        return None
+    try:
+        return np.result_type(*dtypes)
+    except TypeError:
+        return None
+
+# Convert the values of one part of a column to the dtype and row shape of
+# the merged column. Missing values and the padding of narrower array fields
+# are masked.
+
+def _widen(values, mask, row_count, dtype, shape):
+    if values is None:
+        return np.zeros((row_count,) + shape, dtype = dtype), np.ones((row_count,) + shape, dtype = bool)
+
+    values = values.astype(dtype, copy = False)
+    if shape == () or values.shape[1:] == shape:
+        return values, mask
+
+    if values.ndim == 1:
+        values = values[:, np.newaxis]
+        mask = mask[:, np.newaxis]
+    padding = shape[0] - values.shape[1]
+    values = np.concatenate([values, np.zeros((row_count, padding), dtype = dtype)], axis = 1)
+    mask = np.concatenate([mask, np.ones((row_count, padding), dtype = bool)], axis = 1)
+    return values, mask
+
+# Convert the values of one part of a column to an object array with a
+# Python value per row: bytes for strings and byte arrays (at their own
+# size), a 1-D array for array fields and a number otherwise. Array fields
+# are masked when all of their values are invalid.
+
+def _to_objects(values, mask, row_count):
+    objects = np.empty(row_count, dtype = object)
+    if values is None:
+        return objects, np.ones(row_count, dtype = bool)
+
+    if values.dtype.kind in 'SV':
+        objects[:] = [bytes(value) for value in values]
+    elif values.ndim == 2:
+        for row, row_values in enumerate(values):
+            objects[row] = row_values
+        mask = mask.all(axis = 1)
+    else:
+        objects[:] = values.tolist()
+    return objects, mask
+
+# Which of the values of a decoded field hold its invalid value
+
+def _invalid_mask(values, invalid):
+    if values.dtype.kind == 'f':
+        return values.view(values.dtype.str.replace('f', 'u')) == invalid
+    if values.dtype.kind == 'V':
+        raw = np.ascontiguousarray(values).view(np.uint8).reshape(len(values), values.dtype.itemsize)
+        return (raw == invalid).all(axis = 1)
+    return values == invalid
@@ -0,0 +1,103 @@
+# Columnar FIT parser tests
+
+import os
+import tempfile
+import unittest
+import numpy as np
+import fit_parser_columns
+from fit_parser import GlobalMessageDecl, RecordDecl, parse_fit_file
+from fit_parser_columns import parse_fit_columns
+from fit_parser_tests import build_compressed_timestamp_file, build_developer_data_file, build_mixed_endian_file, \
+    compressed_timestamp_expected, developer_data_base, mixed_endian_base
+
+class FitColumnsParserTestMethods(unittest.TestCase):
+
+    def test_columns_match_messages(self):
+        filename = "large_file.fit"
+        fields = [RecordDecl.time_stamp, RecordDecl.power, RecordDecl.heart_rate, RecordDecl.left_right_balance]
+
+        columns = parse_fit_columns(filename, [GlobalMessageDecl.record], fields)
+        self.assertEqual(list(columns), [GlobalMessageDecl.record])
+        record_columns = columns[GlobalMessageDecl.record]
+
+        messages = [message for message in parse_fit_file(filename)
+                    if message.message_definition.global_message_number == GlobalMessageDecl.record]
+        self.assertEqual(len(record_columns.offsets), len(messages))
+
+        for field in fields:
+            expected = [message.get(field) for message in messages]
+            actual = [None if value is np.ma.masked else int(value) for value in record_columns[field]]
+            self.assertEqual(actual, expected)
+
+    def test_parallel_decode_matches_serial(self):
+        filename = "large_file.fit"
+        expected = parse_fit_columns(filename)
+
+        # Force the records to be split into several chunks per definition
+        min_chunk_rows = fit_parser_columns._min_chunk_rows
+        fit_parser_columns._min_chunk_rows = 1000
+        try:
+            actual = parse_fit_columns(filename, workers = 4)
+        finally:
+            fit_parser_columns._min_chunk_rows = min_chunk_rows
+
+        self.assertEqual(list(actual), list(expected))
+        for global_message_number, columns in expected.items():
+            self.assertTrue(np.array_equal(actual[global_message_number].offsets, columns.offsets))
+            for field_number, values in columns.items():
+                self.assertTrue(np.ma.allequal(actual[global_message_number][field_number], values))
+                self.assertTrue(np.array_equal(np.ma.getmaskarray(actual[global_message_number][field_number]),
+                                               np.ma.getmaskarray(values)))
+
+    def test_compressed_timestamp_headers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "compressed.fit")
+            with open(filename, "wb") as stream:
+                stream.write(build_compressed_timestamp_file())
+
+            columns = parse_fit_columns(filename, [GlobalMessageDecl.record])[GlobalMessageDecl.record]
+            self.assertEqual(columns[RecordDecl.heart_rate].tolist(), list(range(120, 126)))
+            self.assertEqual(columns[RecordDecl.time_stamp].tolist(), compressed_timestamp_expected)
+
+    def test_mixed_endian_and_base_types(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "mixed.fit")
+            with open(filename, "wb") as stream:
+                stream.write(build_mixed_endian_file())
+            columns = parse_fit_columns(filename)[250]
+
+        self.assertEqual((columns[253] - mixed_endian_base).tolist(), [0, 1, 2])
+        self.assertEqual(columns[0].tolist(), [513, 513, None])
+        self.assertEqual(columns[1].shape, (3, 3))
+        self.assertEqual(columns[1].tolist(), [[1, None, None], [7, 8, 9], [None, None, None]])
+        self.assertEqual(columns[2].tolist(), [1.25, 2.5, None])
+        self.assertEqual(columns[3].tolist(), [b"abc", "\u00e9t\u00e9".encode(), None])
+        self.assertEqual(columns[4].tolist(), [-5, -6, None])
+
+    def test_developer_fields(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "developer.fit")
+            with open(filename, "wb") as stream:
+                stream.write(build_developer_data_file())
+            columns = parse_fit_columns(filename, [GlobalMessageDecl.record])[GlobalMessageDecl.record]
+
+        self.assertEqual(list(columns), [253, RecordDecl.power, "Form Power", "core_temperature", "developer_0_5"])
+        self.assertEqual((columns[253] - developer_data_base).tolist(), [0, 1])
+        self.assertEqual(columns["Form Power"].tolist(), [60, None])
+        self.assertEqual(columns["core_temperature"].dtype, np.int16)
+        self.assertEqual(columns.get_converted("core_temperature").tolist(), [np.float32(37.12), np.float32(37.25)])
+        self.assertIs(columns.get_converted("Form Power"), columns["Form Power"])
+        self.assertEqual([bytes(value) for value in columns["developer_0_5"]], [b"xyz", b"xyz"])
+
+    def test_developer_field_named_like_a_native_field(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "developer.fit")
+            with open(filename, "wb") as stream:
+                stream.write(build_developer_data_file(temperature_name = "7"))
+            columns = parse_fit_columns(filename, [GlobalMessageDecl.record])[GlobalMessageDecl.record]
+
+        self.assertEqual(columns[RecordDecl.power].tolist(), [250, 260])
+        self.assertEqual(columns["7"].tolist(), [3712, 3725])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,46 +1,471 @@
 ﻿
 # Integration with pandas
 
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import os
+import time
+import numpy as np
 import pandas as pd
-from fit_parser import GlobalMessageDecl, RecordDecl, parse_fit_file
+from fit_parser import ActivityDecl, FileIdDecl, GlobalMessageDecl, LapDecl, Message, RecordDecl, SessionDecl, parse_fit_file, \
+    timestamp_field_number
+from fit_parser_cache import FitCache, default_cache_size
+from fit_parser_columns import _decode_message_columns, parse_fit_columns
 
 # TODO: handle missing columns by raising the appropriate Error object
-# TODO: handle wildcarding all available columns
 
-def parse_fit_as_dataframe(path, columns):
+def parse_fit_as_dataframe(path, columns, cache_dir = None, cache_size = default_cache_size, stats = None,
+                           message = GlobalMessageDecl.record, convert_units = False):
     """Parse a .fit file and return a Pandas DataFrame object with the specified columns.
 
     Parameters
     ----------
     path: str
         Path to the .fit file
-    columns: list[int]
+    columns: list[int] or "*"
         A list of field ids to include in the data frame. The field ids are typically in the form of enums for
         the record type. For example, if you want to read the heart rate from a Record message, you will
         typically use RecordDecl.heart_rate. In the end, it is just an integer that is used.
+        "*" includes every field of every definition of the message in the file. These columns keep
+        their FIT type: integers become nullable integer columns, strings become string columns and
+        byte arrays hold bytes objects, with missing values for invalid or absent fields. A field
+        whose type changes between definitions becomes an object column of the values as decoded.
+        Fields without a declaration are named field_<n>. Developer fields are included by the name in
+        their field_description, e.g. "Form Power", and are named after it.
+    cache_dir: str
+        Directory of an on-disk cache of decoded columns (see FitCache). Default is None, which
+        always parses the file.
+    cache_size: int
+        Size in bytes above which the least recently used cache entries are evicted. Default is 1 GB.
+    stats: ParseStats
+        Collect counts and timings of the parse, including the conversion to NumPy columns (arrays)
+        and the assembly of the DataFrame (dataframe), into this object. Default is None.
+    message: GlobalMessageDecl
+        The global message whose data messages become the rows of the data frame. Default is
+        GlobalMessageDecl.record.
+    convert_units: bool
+        Convert fields with a scaled FIT profile into its units in bulk, e.g. positions into degrees,
+        speed into m/s and altitude and distance into metres. Converted columns are float32 when
+        the stored values fit in 16 bits and float64 otherwise. With cache_dir, the converted
+        columns are cached too. Default is False, which returns the stored values.
 
     Returns
     -------
     pandas.DataFrame
-        A Pandas dataframe object that contains the requested columns from the .fit file.
+        A Pandas dataframe object that contains the requested columns from the .fit file. If
+        the time stamp (field 253, e.g. RecordDecl.time_stamp or LapDecl.time_stamp) is
+        requested, it becomes the index of the data frame as a datetime64[ns, UTC] DatetimeIndex
+        rather than a column.
 
     Examples
     --------
     >>> fit_file = parse_fit_as_dataframe('fit_file.fit', [RecordDecl.heart_rate, RecordDecl.power])
+    >>> laps = parse_fit_as_dataframe('fit_file.fit', "*", message = GlobalMessageDecl.lap)
+    >>> track = parse_fit_as_dataframe('fit_file.fit', [RecordDecl.position_lat, RecordDecl.position_long],
+                                       convert_units = True)
     """
 
-    # Initialize a dictionary containing names of columns names and empty lists
+    arrays = _decode_record_arrays(path, columns, cache_dir, cache_size, stats, message, convert_units)
+    if stats is None:
+        return _build_dataframe(*arrays)
+
+    started = time.perf_counter()
+    frame = _build_dataframe(*arrays)
+    stats.add_phase("dataframe", time.perf_counter() - started)
+    return frame
+
+# Decode the requested fields of every record (or other) message in bulk.
+# Returns a dict of column name to array, plus the time_stamp column as a
+# datetime64 array if it was requested (None otherwise). Only NumPy and
+# pandas arrays are returned so that the result is cheap to send back from a
+# worker process.
+
+def _decode_record_arrays(path, columns, cache_dir = None, cache_size = default_cache_size, stats = None,
+                          message = GlobalMessageDecl.record, convert_units = False):
+    is_wildcard = isinstance(columns, str) and columns == "*"
+    fields = None if is_wildcard else columns
+
+    if cache_dir is None:
+        columns_by_message = parse_fit_columns(path, [message], fields, stats = stats)
+    else:
+        columns_by_message = FitCache(cache_dir, cache_size).parse_fit_columns(path, [message], fields, stats = stats)
+
+    if stats is not None:
+        started = time.perf_counter()
+
+    if is_wildcard:
+        arrays = _all_arrays(columns_by_message.get(message), message, convert_units)
+    else:
+        arrays = _record_arrays(columns_by_message.get(message), columns, convert_units)
+
+    if stats is not None:
+        stats.add_phase("arrays", time.perf_counter() - started)
+    return arrays
+
+# Convert the decoded columns of the record messages (None if there are no
+# record messages) into the arrays returned by _decode_record_arrays
+
+def _record_arrays(record_columns, columns, convert_units = False):
+    row_count = len(record_columns.offsets) if record_columns is not None else 0
+
     data = {}
+    timestamps = None
     for column in columns:
-        data[column.name] = []
-
-    for message in parse_fit_file(path, validate_crc = False):
-        if message.message_definition.global_message_number == GlobalMessageDecl.record:
-            for column in columns:
-                # Special case time stamp
-                if column is RecordDecl.time_stamp:
-                    data[column.name].append(message.get_as_datetime(column))
-                else:
-                    data[column.name].append(message.get(column))
-
-    return pd.DataFrame(data)
\ No newline at end of file
+        values = record_columns.get(column) if record_columns is not None else None
+
+        # Special case time stamp, which has the same number in every message
+        if not isinstance(column, str) and int(column) == timestamp_field_number:
+            if values is None:
+                values = np.ma.MaskedArray(np.zeros(row_count, dtype = np.uint32), mask = True)
+            timestamps = _to_datetime64(values)
+        elif values is None:
+            data[_column_name(column)] = np.full(row_count, np.nan)
+        else:
+            if convert_units:
+                values = record_columns.get_converted(column)
+            data[_column_name(column)] = _to_column(values)
+
+    return data, timestamps
+
+# The field declarations used to name the columns of each global message
+
+_field_decls = {
+    GlobalMessageDecl.file_id: FileIdDecl,
+    GlobalMessageDecl.session: SessionDecl,
+    GlobalMessageDecl.lap: LapDecl,
+    GlobalMessageDecl.record: RecordDecl,
+    GlobalMessageDecl.activity: ActivityDecl,
+    }
+
+def _column_name(field_number, field_decl = None):
+    if isinstance(field_number, str):
+        return field_number
+    if hasattr(field_number, "name"):
+        return field_number.name
+    if field_decl is not None:
+        try:
+            return field_decl(field_number).name
+        except ValueError:
+            pass
+    return "field_%d" % field_number
+
+# Convert every decoded column of a message into a typed column, in field
+# number order so that files with the same fields get the same schema, with
+# developer fields last in name order. The columns were discovered by the
+# columnar engine from the union of the message's definitions.
+
+def _all_arrays(message_columns, global_message_number, convert_units = False):
+    data = {}
+    timestamps = None
+    if message_columns is None:
+        return data, timestamps
+
+    field_decl = _field_decls.get(global_message_number)
+    for field_number, values in sorted(message_columns.items(), key = _field_order):
+        if field_number == timestamp_field_number:
+            timestamps = _to_datetime64(values)
+        else:
+            if convert_units:
+                values = message_columns.get_converted(field_number)
+            data[_column_name(field_number, field_decl)] = _to_typed_column(values)
+
+    return data, timestamps
+
+def _field_order(item):
+    field_number = item[0]
+    if isinstance(field_number, str):
+        return 1, 0, field_number
+    return 0, field_number, ""
+
+# Hand the decoded arrays to pandas, indexing the frame by time stamp when
+# one was requested
+
+def _build_dataframe(data, timestamps):
+    index = None
+    if timestamps is not None:
+        index = pd.DatetimeIndex(timestamps, name = RecordDecl.time_stamp.name).tz_localize('UTC')
+    return pd.DataFrame(data, index = index)
+
+def iter_fit_dataframes(path, columns, chunk_rows = 65536, message = GlobalMessageDecl.record, convert_units = False):
+    """Parse a .fit file into a sequence of data frames of at most chunk_rows rows each.
+
+    Peak memory is proportional to chunk_rows rather than to the size of the file, which makes
+    this suitable for long monitoring files and for feeding rolling aggregations or writers.
+
+    Parameters
+    ----------
+    path: str
+        Path to the .fit file
+    columns: list[int] or "*"
+        The field ids to include in each data frame, as for parse_fit_as_dataframe. With "*", each
+        chunk has the fields of the definitions that its messages use.
+    chunk_rows: int
+        Number of messages per data frame. Default is 65536.
+    message: GlobalMessageDecl
+        The global message to read, as for parse_fit_as_dataframe. Default is GlobalMessageDecl.record.
+    convert_units: bool
+        Convert fields into the units of their FIT profile, as for parse_fit_as_dataframe. Default
+        is False.
+
+    Yields
+    ------
+    pandas.DataFrame
+        Consecutive chunks of the data frame that parse_fit_as_dataframe would return for the same
+        arguments. The dtype rules of parse_fit_as_dataframe are applied to each chunk on its own.
+
+    Examples
+    --------
+    >>> for chunk in iter_fit_dataframes('fit_file.fit', [RecordDecl.time_stamp, RecordDecl.power]):
+            total += chunk['power'].sum()
+    """
+
+    is_wildcard = isinstance(columns, str) and columns == "*"
+    if not is_wildcard:
+        columns = list(columns)
+
+    # The messages are walked in zero-copy mode, so all that needs to be kept
+    # per message is its offset into the mapped file and its definition.
+    # These buffers are allocated once and reused for every chunk.
+    offsets = np.empty(chunk_rows, dtype = np.intp)
+    definition_ids = np.empty(chunk_rows, dtype = np.intp)
+    compressed_timestamps = np.zeros(chunk_rows, dtype = np.uint32)
+    definitions = {}
+    data = None
+    row = 0
+
+    for fit_message in parse_fit_file(path, use_mmap = True, messages = [message]):
+        if data is None:
+            data = np.frombuffer(fit_message.buffer, dtype = np.uint8)
+
+        definition_id = definitions.get(fit_message.message_definition)
+        if definition_id is None:
+            definition_id = len(definitions)
+            definitions[fit_message.message_definition] = definition_id
+
+        offsets[row] = fit_message.offset
+        definition_ids[row] = definition_id
+        if fit_message.timestamp is not None:
+            compressed_timestamps[row] = fit_message.timestamp
+        row += 1
+
+        if row == chunk_rows:
+            yield _build_dataframe(*_chunk_arrays(data, offsets, definition_ids, definitions,
+                                                  compressed_timestamps, columns, message, convert_units))
+            definitions = {}
+            compressed_timestamps[:] = 0
+            row = 0
+
+    if row > 0:
+        yield _build_dataframe(*_chunk_arrays(data, offsets[:row], definition_ids[:row], definitions,
+                                              compressed_timestamps[:row], columns, message, convert_units))
+
+# Decode one chunk of iter_fit_dataframes with the columnar engine, and turn
+# it into arrays with the same helpers as parse_fit_as_dataframe
+
+def _chunk_arrays(data, offsets, definition_ids, definitions, compressed_timestamps, columns, message,
+                  convert_units):
+    is_wildcard = isinstance(columns, str) and columns == "*"
+    groups = [(message_definition, offsets[definition_ids == definition_id])
+              for message_definition, definition_id in definitions.items()]
+    message_columns = _decode_message_columns(data, message, groups, None if is_wildcard else columns)
+
+    is_compressed = compressed_timestamps != 0
+    if (is_wildcard or timestamp_field_number in columns) and is_compressed.any():
+        values = message_columns.get(timestamp_field_number)
+        if values is None:
+            values = np.ma.MaskedArray(np.zeros(len(offsets), dtype = np.uint32), mask = True)
+        else:
+            values = values.astype(np.uint32)
+        values[is_compressed] = compressed_timestamps[is_compressed]
+        message_columns[timestamp_field_number] = values
+
+    if is_wildcard:
+        return _all_arrays(message_columns, message, convert_units)
+    return _record_arrays(message_columns, columns, convert_units)
+
+# Worker process entry point for parse_fit_files: decode a chunk of files
+
+def _decode_record_arrays_chunk(paths, columns, cache_dir, cache_size):
+    return [_decode_record_arrays(path, columns, cache_dir, cache_size) for path in paths]
+
+def parse_fit_files(paths, columns, workers = None, chunksize = 8, max_in_flight = None, concat = False, key = "file",
+                    cache_dir = None, cache_size = default_cache_size):
+    """Parse many .fit files in parallel over a pool of worker processes.
+
+    Parameters
+    ----------
+    paths: iterable of str
+        Paths to the .fit files. The iterable is consumed lazily, so it may be a generator.
+    columns: list[int] or "*"
+        The field ids to include in each data frame, as for parse_fit_as_dataframe.
+    workers: int
+        Number of worker processes. Default is None, which uses os.cpu_count(). With 0 or 1 the
+        files are parsed in the calling process.
+    chunksize: int
+        Number of files sent to a worker at a time. Default is 8.
+    max_in_flight: int
+        Maximum number of chunks submitted but not yet consumed, which bounds the memory held by
+        finished results waiting to be consumed. Default is twice the number of workers.
+    concat: bool
+        Return a single data frame with a key column identifying the file of each row, instead of
+        an iterator. Default is False.
+    key: str
+        Name of the key column when concat is True. Default is "file".
+    cache_dir: str
+        Directory of an on-disk cache of decoded columns shared by the workers, as for
+        parse_fit_as_dataframe. Default is None.
+    cache_size: int
+        Size in bytes above which the least recently used cache entries are evicted. Default is 1 GB.
+
+    Returns
+    -------
+    iterator of (str, pandas.DataFrame), or pandas.DataFrame
+        (path, data frame) pairs in the same order as paths, or a single concatenated data frame
+        if concat is True.
+
+    Examples
+    --------
+    >>> for path, fit_file in parse_fit_files(glob.glob('*.fit'), [RecordDecl.power], workers = 4):
+            pass
+    """
+
+    if workers is None:
+        workers = os.cpu_count()
+
+    frames = _parse_fit_files(paths, columns, workers, chunksize, max_in_flight, cache_dir, cache_size)
+    if not concat:
+        return frames
+
+    parts = []
+    for path, frame in frames:
+        frame[key] = path
+        parts.append(frame)
+    if len(parts) == 0:
+        return pd.DataFrame()
+
+    result = pd.concat(parts)
+    result[key] = result[key].astype("category")
+    return result
+
+def _parse_fit_files(paths, columns, workers, chunksize, max_in_flight, cache_dir, cache_size):
+    paths = iter(paths)
+    if columns != "*":
+        columns = list(columns)
+
+    if workers <= 1:
+        for path in paths:
+            yield path, _build_dataframe(*_decode_record_arrays(path, columns, cache_dir, cache_size))
+        return
+
+    if max_in_flight is None:
+        max_in_flight = 2 * workers
+
+    def next_chunk():
+        chunk = []
+        for path in paths:
+            chunk.append(path)
+            if len(chunk) == chunksize:
+                break
+        return chunk
+
+    # Keep a bounded queue of submitted chunks and consume them in order, so
+    # that results are yielded in the order of paths and at most
+    # max_in_flight chunks of results are held in memory at any time
+    with ProcessPoolExecutor(max_workers = workers) as executor:
+        in_flight = deque()
+        try:
+            chunk = next_chunk()
+            while len(chunk) > 0 or len(in_flight) > 0:
+                while len(chunk) > 0 and len(in_flight) < max_in_flight:
+                    future = executor.submit(_decode_record_arrays_chunk, chunk, columns, cache_dir, cache_size)
+                    in_flight.append((chunk, future))
+                    chunk = next_chunk()
+
+                chunk_paths, future = in_flight.popleft()
+                for path, arrays in zip(chunk_paths, future.result()):
+                    yield path, _build_dataframe(*arrays)
+        finally:
+            # Don't wait for work nobody will consume if the caller stops early
+            for _, future in in_flight:
+                future.cancel()
+
+# Convert a masked column into something pandas can hold. Columns without any
+# invalid values keep their integer dtype; otherwise they become float64 with
+# NaN in place of the invalid values. Strings, byte arrays and fields whose
+# type changes between definitions are converted as for wildcard columns.
+
+def _to_column(values):
+    if values.dtype.kind in 'SVO':
+        return _to_typed_column(values)
+    if values.ndim == 2:
+        return _to_array_column(values)
+    if not np.ma.is_masked(values):
+        return np.ma.getdata(values)
+    if values.dtype.kind == 'f':
+        return values.filled(np.nan)
+    return values.astype(np.float64).filled(np.nan)
+
+# Convert a masked column into a pandas column that keeps its FIT type.
+# Integers become nullable integer arrays that share the decoded values,
+# floats use NaN, strings are cut at their terminating NUL and decoded as
+# UTF-8, and byte arrays become bytes objects. Fields whose type changes
+# between definitions are already object columns. Invalid values are missing.
+
+def _to_typed_column(values):
+    if values.ndim == 2:
+        return _to_array_column(values)
+
+    data = np.ma.getdata(values)
+    mask = np.ma.getmaskarray(values)
+    kind = data.dtype.kind
+
+    if kind in 'iu':
+        return pd.arrays.IntegerArray(np.asarray(data), np.array(mask))
+    if kind == 'f':
+        return np.where(mask, np.nan, data)
+
+    if kind == 'S':
+        # Clear everything from the first NUL onwards, which NumPy then strips
+        raw = np.ascontiguousarray(data).view(np.uint8).reshape(len(data), data.dtype.itemsize)
+        raw = np.where(np.cumsum(raw == 0, axis = 1) > 0, 0, raw)
+        column = np.char.decode(raw.view(data.dtype).ravel(), 'utf-8', 'replace').astype(object)
+        column[mask] = None
+        return pd.array(column, dtype = "string")
+
+    if kind == 'O':
+        column = data.copy()
+        column[mask] = None
+        return column
+
+    column = np.empty(len(data), dtype = object)
+    column[:] = [value.tobytes() for value in data]
+    column[mask] = None
+    return column
+
+# Array fields are decoded as 2-D columns. pandas holds them as an object
+# column with one 1-D array per row, converted like a scalar column: float64
+# with NaN if any element is invalid.
+
+def _to_array_column(values):
+    if np.ma.is_masked(values):
+        data = values.astype(np.float64).filled(np.nan)
+    else:
+        data = np.ma.getdata(values)
+
+    column = np.empty(len(data), dtype = object)
+    for row, row_values in enumerate(data):
+        column[row] = row_values
+    return column
+
+# Convert a masked column of raw FIT timestamps into datetime64 values in one
+# step by shifting the whole array from the FIT epoch to the Unix epoch.
+# Invalid values and "system time" values below 0x10000000 become NaT.
+
+_fit_epoch_offset = np.int64(Message.offset_total_seconds)
+
+def _to_datetime64(values):
+    seconds = values.filled(0).astype(np.int64)
+    valid = seconds >= 0x10000000
+    timestamps = (seconds + _fit_epoch_offset).astype('datetime64[s]').astype('datetime64[ns]')
+    timestamps[~valid] = np.datetime64('NaT')
+    return timestamps
@@ -1,9 +1,15 @@
 # DataFrame FIT parser tests
 
+import os
+import struct
+import tempfile
 import time
 import unittest
-from fit_parser import RecordDecl
-from fit_parser_dataframe import parse_fit_as_dataframe
+import numpy as np
+import pandas as pd
+from fit_parser import FieldType, GlobalMessageDecl, LapDecl, ParseStats, RecordDecl
+from fit_parser_dataframe import iter_fit_dataframes, parse_fit_as_dataframe, parse_fit_files
+from fit_parser_tests import build_compressed_timestamp_file, build_developer_data_file, build_fit_file
 
 class FitPandaParserTestMethods(unittest.TestCase):
     
@@ -19,5 +25,181 @@ class FitPandaParserTestMethods(unittest.TestCase):
         end_time = time.time()
         print("Elapsed time was %g seconds" % (end_time - start_time))
 
+    def test_time_stamp_index(self):
+        fit = parse_fit_as_dataframe("large_file.fit", [RecordDecl.time_stamp, RecordDecl.power])
+
+        self.assertEqual(list(fit.columns), ["power"])
+        self.assertEqual(fit.index.name, "time_stamp")
+        self.assertEqual(str(fit.index.dtype), "datetime64[ns, UTC]")
+        self.assertEqual(str(fit.index[0]), "2014-06-29 12:29:19+00:00")
+        self.assertTrue(fit.index.is_monotonic_increasing)
+
+        # By field number, and for other messages
+        self.assertTrue(parse_fit_as_dataframe("large_file.fit", [253, RecordDecl.power]).equals(fit))
+        laps = parse_fit_as_dataframe("large_file.fit", [LapDecl.time_stamp, LapDecl.start_time],
+                                      message = GlobalMessageDecl.lap)
+        self.assertEqual(list(laps.columns), ["start_time"])
+        self.assertEqual(str(laps.index.dtype), "datetime64[ns, UTC]")
+
+    def test_read_multiple_fit_files(self):
+        filenames = ["large_file.fit"] * 4
+        columns = [RecordDecl.time_stamp, RecordDecl.power, RecordDecl.heart_rate]
+        expected = parse_fit_as_dataframe(filenames[0], columns)
+
+        frames = list(parse_fit_files(filenames, columns, workers = 2, chunksize = 1))
+
+        self.assertEqual([path for path, frame in frames], filenames)
+        for path, frame in frames:
+            self.assertTrue(frame.equals(expected))
+
+        combined = parse_fit_files(filenames, columns, workers = 1, concat = True)
+        self.assertEqual(len(combined), len(expected) * len(filenames))
+        self.assertEqual(list(combined.columns), ["power", "heart_rate", "file"])
+
+    def test_iter_fit_dataframes(self):
+        filename = "large_file.fit"
+        columns = [RecordDecl.time_stamp, RecordDecl.power, RecordDecl.heart_rate, RecordDecl.cadence]
+        expected = parse_fit_as_dataframe(filename, columns)
+
+        chunks = list(iter_fit_dataframes(filename, columns, chunk_rows = 5000))
+        self.assertEqual([len(chunk) for chunk in chunks], [5000, 5000, 5000, 3456])
+        pd.testing.assert_frame_equal(pd.concat(chunks), expected, check_dtype = False)
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "compressed.fit")
+            with open(filename, "wb") as stream:
+                stream.write(build_compressed_timestamp_file())
+
+            columns = [RecordDecl.time_stamp, RecordDecl.heart_rate]
+            expected = parse_fit_as_dataframe(filename, columns)
+            chunks = list(iter_fit_dataframes(filename, columns, chunk_rows = 4))
+            self.assertEqual([len(chunk) for chunk in chunks], [4, 2])
+            pd.testing.assert_frame_equal(pd.concat(chunks), expected)
+
+            expected = parse_fit_as_dataframe(filename, "*")
+            pd.testing.assert_frame_equal(pd.concat(iter_fit_dataframes(filename, "*", chunk_rows = 4)), expected)
+
+        # Wildcard columns, unit conversion and other messages as for parse_fit_as_dataframe
+        filename = "large_file.fit"
+        expected = parse_fit_as_dataframe(filename, "*", convert_units = True)
+        chunks = list(iter_fit_dataframes(filename, "*", chunk_rows = 5000, convert_units = True))
+        pd.testing.assert_frame_equal(pd.concat(chunks), expected)
+
+        columns = [LapDecl.time_stamp, LapDecl.total_elapsed_time]
+        expected = parse_fit_as_dataframe(filename, columns, message = GlobalMessageDecl.lap, convert_units = True)
+        chunks = list(iter_fit_dataframes(filename, columns, message = GlobalMessageDecl.lap, convert_units = True))
+        pd.testing.assert_frame_equal(pd.concat(chunks), expected)
+
+    def test_parse_stats(self):
+        stats = ParseStats()
+        fit = parse_fit_as_dataframe("large_file.fit", [RecordDecl.time_stamp, RecordDecl.power], stats = stats)
+        result = stats.as_dict()
+
+        self.assertEqual(result["messages"]["record"]["count"], len(fit))
+        self.assertGreater(result["bytes_skipped"], 0)
+        for phase in ["read", "index", "decode", "merge", "arrays", "dataframe"]:
+            self.assertIn(phase, result["phases"])
+
+    def test_wildcard_columns(self):
+        filename = "large_file.fit"
+        expected = parse_fit_as_dataframe(filename, [RecordDecl.time_stamp, RecordDecl.power, RecordDecl.heart_rate])
+        fit = parse_fit_as_dataframe(filename, "*")
+
+        self.assertEqual(fit.index.name, "time_stamp")
+        self.assertIn("left_right_balance", fit.columns)
+        self.assertEqual(str(fit["heart_rate"].dtype), "UInt8")
+        pd.testing.assert_series_equal(fit["power"].astype("float64"), expected["power"].astype("float64"))
+
+        with tempfile.TemporaryDirectory() as directory:
+            cached = parse_fit_as_dataframe(filename, "*", cache_dir = directory)
+            cached = parse_fit_as_dataframe(filename, "*", cache_dir = directory)
+            pd.testing.assert_frame_equal(cached, fit)
+
+    def test_wildcard_typed_columns(self):
+        # A message that is redefined mid-file with different fields, sizes
+        # and types, including a field number without a declaration
+        data = build_fit_file([
+            struct.pack("<BBBHB3B3B3B", 0x40, 0, 0, 250, 3, 0, 2, FieldType.uint16, 1, 4, FieldType.string,
+                        2, 2, FieldType.byte_array),
+            struct.pack("<BH4s2s", 0x00, 7, b"ab\x00\x00", b"\x01\x02"),
+            struct.pack("<BH4s2s", 0x00, 0xffff, b"\x00" * 4, b"\xff\xff"),
+            struct.pack("<BBBHB3B3B3B", 0x40, 0, 0, 250, 3, 1, 8, FieldType.string, 3, 4, FieldType.float32,
+                        2, 3, FieldType.byte_array),
+            struct.pack("<B8sf3s", 0x00, "\u00e9t\u00e9".encode(), 1.5, b"\x03\x04\x05"),
+            ])
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "typed.fit")
+            with open(filename, "wb") as stream:
+                stream.write(data)
+            fit = parse_fit_as_dataframe(filename, "*", message = 250)
+
+        self.assertEqual(list(fit.columns), ["field_0", "field_1", "field_2", "field_3"])
+        self.assertEqual(str(fit["field_0"].dtype), "UInt16")
+        self.assertEqual(fit["field_0"].tolist(), [7, pd.NA, pd.NA])
+        self.assertEqual(fit["field_1"].tolist(), ["ab", pd.NA, "\u00e9t\u00e9"])
+        self.assertEqual(fit["field_2"].tolist(), [b"\x01\x02", None, b"\x03\x04\x05"])
+        self.assertTrue(fit["field_3"].isna().tolist()[:2] == [True, True])
+        self.assertEqual(fit["field_3"].iloc[2], 1.5)
+
+    def test_wildcard_field_changes_type(self):
+        data = build_fit_file([
+            struct.pack("<BBBHB3B", 0x40, 0, 0, 250, 1, 0, 2, FieldType.uint16),
+            struct.pack("<BH", 0x00, 7),
+            struct.pack("<BBBHB3B", 0x40, 0, 0, 250, 1, 0, 2, FieldType.byte_array),
+            struct.pack("<B2s", 0x00, b"\x01\x02"),
+            struct.pack("<B2s", 0x00, b"\xff\xff"),
+            ])
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "retyped.fit")
+            with open(filename, "wb") as stream:
+                stream.write(data)
+            fit = parse_fit_as_dataframe(filename, "*", message = 250)
+            parse_fit_as_dataframe(filename, "*", message = 250, cache_dir = directory)
+            cached = parse_fit_as_dataframe(filename, "*", message = 250, cache_dir = directory)
+
+        self.assertEqual(fit["field_0"].tolist(), [7, b"\x01\x02", None])
+        pd.testing.assert_frame_equal(cached, fit)
+
+    def test_convert_units(self):
+        filename = "large_file.fit"
+        columns = [RecordDecl.time_stamp, RecordDecl.position_lat, RecordDecl.altitude, RecordDecl.speed, RecordDecl.power]
+        raw = parse_fit_as_dataframe(filename, columns)
+        fit = parse_fit_as_dataframe(filename, columns, convert_units = True)
+
+        self.assertEqual(str(fit["position_lat"].dtype), "float64")
+        self.assertEqual(str(fit["speed"].dtype), "float32")
+        self.assertTrue(fit["power"].equals(raw["power"]))
+        self.assertAlmostEqual(fit["position_lat"].iloc[0], raw["position_lat"].iloc[0] * 180 / 2 ** 31)
+        self.assertAlmostEqual(fit["altitude"].iloc[0], raw["altitude"].iloc[0] / 5 - 500, places = 3)
+        self.assertAlmostEqual(fit["speed"].iloc[0], raw["speed"].iloc[0] / 1000, places = 5)
+
+        with tempfile.TemporaryDirectory() as directory:
+            parse_fit_as_dataframe(filename, columns, cache_dir = directory, convert_units = True)
+            cached = parse_fit_as_dataframe(filename, columns, cache_dir = directory, convert_units = True)
+            pd.testing.assert_frame_equal(cached, fit)
+
+    def test_developer_fields(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "developer.fit")
+            with open(filename, "wb") as stream:
+                stream.write(build_developer_data_file())
+
+            fit = parse_fit_as_dataframe(filename, "*", convert_units = True)
+            named = parse_fit_as_dataframe(filename, [RecordDecl.time_stamp, "core_temperature"])
+            chunks = list(iter_fit_dataframes(filename, [RecordDecl.time_stamp, "Form Power"], chunk_rows = 1))
+
+            parse_fit_as_dataframe(filename, "*", cache_dir = directory, convert_units = True)
+            cached = parse_fit_as_dataframe(filename, "*", cache_dir = directory, convert_units = True)
+
+        self.assertEqual(list(fit.columns), ["power", "Form Power", "core_temperature", "developer_0_5"])
+        self.assertEqual(fit["developer_0_5"].tolist(), [b"xyz", b"xyz"])
+        self.assertEqual(fit["Form Power"].tolist(), [60, pd.NA])
+        np.testing.assert_allclose(fit["core_temperature"].tolist(), [37.12, 37.25], rtol = 1e-6)
+        self.assertEqual(named["core_temperature"].tolist(), [3712, 3725])
+        self.assertEqual([chunk["Form Power"].iloc[0] for chunk in chunks[:1]], [60])
+        pd.testing.assert_frame_equal(cached, fit)
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
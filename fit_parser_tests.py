@@ -0,0 +1,335 @@
+# FIT parser tests
+
+from contextlib import contextmanager
+from datetime import datetime, timezone
+import mmap
+import os
+import struct
+import tempfile
+import time
+import unittest
+from crc import crc16
+from fit_parser import FieldType, FitPushParser, GlobalMessageDecl, ParseStats, RecordDecl, parse_fit_buffer, parse_fit_file
+
+# Run a block with the local time zone of the process set to name. Time zones
+# cannot be changed on Windows, where the block runs in the system time zone.
+
+@contextmanager
+def local_time_zone(name):
+    if not hasattr(time, "tzset"):
+        yield
+        return
+
+    previous = os.environ.get("TZ")
+    os.environ["TZ"] = name
+    time.tzset()
+    try:
+        yield
+    finally:
+        if previous is None:
+            del os.environ["TZ"]
+        else:
+            os.environ["TZ"] = previous
+        time.tzset()
+
+# Wrap already encoded definition and data messages in a file header and CRC
+
+def build_fit_file(messages):
+    data = b"".join(messages)
+    body = struct.pack("<BBhI4s", 12, 16, 152, len(data), b".FIT") + data
+    return body + struct.pack("<H", crc16(body))
+
+# A small file that mixes normal record messages with records that have a
+# compressed timestamp header, including a rollover of the 5 bit offset
+
+compressed_timestamp_base = 1000000030
+
+def build_compressed_timestamp_file():
+    base = compressed_timestamp_base
+    return build_fit_file([
+        struct.pack("<BBBHB3B3B", 0x40, 0, 0, GlobalMessageDecl.record, 2, 253, 4, 0x86, 3, 1, 0x02),
+        struct.pack("<BIB", 0x00, base, 120),
+        struct.pack("<BBBHB3B", 0x41, 0, 0, GlobalMessageDecl.record, 1, 3, 1, 0x02),
+        struct.pack("<BB", 0x80 | (1 << 5) | 31, 121),
+        struct.pack("<BB", 0x80 | (1 << 5) | 2, 122),
+        struct.pack("<BB", 0x80 | (1 << 5) | 2, 123),
+        struct.pack("<BIB", 0x00, base + 100, 124),
+        struct.pack("<BB", 0x80 | (1 << 5) | (((base + 100) & 0x1f) + 5), 125),
+        ])
+
+compressed_timestamp_expected = [compressed_timestamp_base + delta for delta in [0, 1, 4, 4, 100, 105]]
+
+# A file with a little-endian and a big-endian definition of the same
+# message, with floats, strings and array fields of different widths
+
+mixed_endian_base = 1000000000
+
+def build_mixed_endian_file():
+    def definition(header, byte_order, array_size):
+        return struct.pack(byte_order + "BBBHB", header, 0, 1 if byte_order == ">" else 0, 250, 6) + \
+            bytes([253, 4, FieldType.uint32, 0, 2, FieldType.uint16, 1, array_size, FieldType.uint16,
+                   2, 4, FieldType.float32, 3, 6, FieldType.string, 4, 4, FieldType.int32])
+
+    return build_fit_file([
+        definition(0x40, "<", 4),
+        struct.pack("<BIH2Hf6si", 0x00, mixed_endian_base, 513, 1, 0xffff, 1.25, b"abc", -5),
+        definition(0x41, ">", 6),
+        struct.pack(">BIH3Hf6si", 0x01, mixed_endian_base + 1, 513, 7, 8, 9, 2.5, "\u00e9t\u00e9".encode(), -6),
+        struct.pack("<BIH2HI6si", 0x00, mixed_endian_base + 2, 0xffff, 0xffff, 0xffff, 0xffffffff, b"", 0x7fffffff),
+        ])
+
+# A file with developer fields: a developer_data_id, the field_description
+# of two fields and record messages that carry them after their native
+# fields, along with a third developer field that has no description
+
+developer_data_base = 1000000000
+
+def build_developer_data_file(temperature_name = "core_temperature"):
+    def field_description(field_number, base_type, name, scale, offset, units):
+        return struct.pack("<BBBB16sBb8s", 0x01, 0, field_number, base_type, name.encode(), scale, offset, units.encode())
+
+    return build_fit_file([
+        struct.pack("<BBBHB", 0x40, 0, 0, GlobalMessageDecl.developer_data_id, 2) +
+            bytes([1, 16, FieldType.byte_array, 3, 1, FieldType.uint8]),
+        struct.pack("<B16sB", 0x00, bytes(range(16)), 0),
+        struct.pack("<BBBHB", 0x41, 0, 0, GlobalMessageDecl.field_description, 7) +
+            bytes([0, 1, FieldType.uint8, 1, 1, FieldType.uint8, 2, 1, FieldType.uint8, 3, 16, FieldType.string,
+                   6, 1, FieldType.uint8, 7, 1, FieldType.int8, 8, 8, FieldType.string]),
+        field_description(0, FieldType.uint16, "Form Power", 0xff, 0x7f, "watts"),
+        field_description(1, FieldType.int16, temperature_name, 100, 0, "C"),
+        struct.pack("<BBBHB", 0x62, 0, 0, GlobalMessageDecl.record, 2) +
+            bytes([253, 4, FieldType.uint32, 7, 2, FieldType.uint16]) +
+            bytes([3, 0, 2, 0, 1, 2, 0, 5, 3, 0]),
+        struct.pack("<BIHHh3s", 0x02, developer_data_base, 250, 60, 3712, b"xyz"),
+        struct.pack("<BIHHh3s", 0x02, developer_data_base + 1, 260, 0xffff, 3725, b"xyz"),
+        ])
+
+class FitParserTestMethods(unittest.TestCase):
+
+    def test_compiled_decoders_match_record_struct(self):
+        for message in parse_fit_file("large_file.fit"):
+            if message.message_definition.global_message_number == GlobalMessageDecl.record:
+                values = message.unpack()
+                field_definitions = message.message_definition.field_definitions
+                for i, field_definition in enumerate(field_definitions):
+                    value = message.get(field_definition.field_definition_number)
+                    self.assertTrue(value is None or value == values[i])
+                break
+
+    def test_missing_field_is_none(self):
+        for message in parse_fit_file("large_file.fit"):
+            if message.message_definition.global_message_number == GlobalMessageDecl.record:
+                self.assertIsNone(message.get(RecordDecl.ball_speed))
+                self.assertIsNotNone(message.get_as_datetime(RecordDecl.time_stamp))
+                break
+
+    def test_zero_copy_modes_match_stream(self):
+        filename = "large_file.fit"
+        expected = [message.message_data for message in parse_fit_file(filename)]
+
+        mapped = [message.message_data for message in parse_fit_file(filename, use_mmap = True)]
+        self.assertEqual(mapped, expected)
+
+        with open(filename, "rb") as stream:
+            buffer = bytearray(stream.read())
+        in_memory = list(parse_fit_buffer(buffer))
+        self.assertEqual([message.message_data for message in in_memory], expected)
+        self.assertIs(in_memory[0].buffer.obj, buffer)
+
+    def test_mmap_is_closed(self):
+        filename = "large_file.fit"
+        mappings = []
+        original = mmap.mmap
+
+        class RecordingMap(original):
+            def __new__(cls, *args, **kwargs):
+                mapping = original.__new__(cls, *args, **kwargs)
+                mappings.append(mapping)
+                return mapping
+
+        mmap.mmap = RecordingMap
+        try:
+            # Parsed to the end and closed early, with the Message reused
+            for message in parse_fit_file(filename, use_mmap = True, reuse = True):
+                message.get(RecordDecl.power)
+            messages = parse_fit_file(filename, use_mmap = True, reuse = True)
+            next(messages)
+            messages.close()
+
+            # Messages that are still held keep the mapping open
+            held = list(parse_fit_file(filename, use_mmap = True, messages = [GlobalMessageDecl.lap]))
+        finally:
+            mmap.mmap = original
+
+        self.assertEqual([mapping.closed for mapping in mappings], [True, True, False])
+        self.assertIsNotNone(held[0].get(253))
+
+    def test_validate_crc(self):
+        filename = "large_file.fit"
+        self.assertEqual(len(list(parse_fit_file(filename, validate_crc = True))), 18720)
+        self.assertEqual(len(list(parse_fit_file(filename, validate_crc = True, use_mmap = True))), 18720)
+
+        with open(filename, "rb") as stream:
+            buffer = bytearray(stream.read())
+        buffer[1000] ^= 0x01
+        with self.assertRaises(ValueError):
+            list(parse_fit_buffer(buffer, validate_crc = True))
+
+    def test_compressed_timestamp_headers(self):
+        messages = list(parse_fit_buffer(build_compressed_timestamp_file(), validate_crc = True))
+        self.assertEqual([message.get(RecordDecl.heart_rate) for message in messages], list(range(120, 126)))
+        self.assertEqual([message.get(RecordDecl.time_stamp) for message in messages], compressed_timestamp_expected)
+
+    def test_message_and_field_filters(self):
+        filename = "large_file.fit"
+        all_messages = list(parse_fit_file(filename))
+
+        for use_mmap in [False, True]:
+            laps = list(parse_fit_file(filename, use_mmap = use_mmap, messages = [GlobalMessageDecl.lap, GlobalMessageDecl.session]))
+            expected = [message.message_data for message in all_messages
+                        if message.message_definition.global_message_number in [GlobalMessageDecl.lap, GlobalMessageDecl.session]]
+            self.assertEqual([message.message_data for message in laps], expected)
+
+            with_balance = list(parse_fit_file(filename, use_mmap = use_mmap, fields = [RecordDecl.left_right_balance]))
+            expected = [message.message_data for message in all_messages
+                        if RecordDecl.left_right_balance in message.message_definition.field_decoders]
+            self.assertEqual([message.message_data for message in with_balance], expected)
+
+        self.assertEqual(len(list(parse_fit_file(filename, validate_crc = True, messages = [GlobalMessageDecl.lap]))), 1)
+
+    def test_time_range_filter(self):
+        data = build_compressed_timestamp_file()
+        start = compressed_timestamp_base + 4
+        end = compressed_timestamp_base + 101
+
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "compressed.fit")
+            with open(filename, "wb") as stream:
+                stream.write(data)
+
+            for messages in [parse_fit_buffer(data, start = start, end = end),
+                             parse_fit_file(filename, start = start, end = end),
+                             parse_fit_file(filename, messages = [GlobalMessageDecl.record], start = start, end = end)]:
+                self.assertEqual([message.get(RecordDecl.heart_rate) for message in messages], [122, 123, 124])
+
+        # Naive datetimes are UTC, whatever the local time zone
+        first = next(parse_fit_file("large_file.fit", messages = [GlobalMessageDecl.record]))
+        with local_time_zone("America/New_York"):
+            for start_time in [datetime(2014, 6, 29, 12, 29, 19), datetime(2014, 6, 29, 12, 29, 19, tzinfo = timezone.utc)]:
+                records = list(parse_fit_file("large_file.fit", start = start_time,
+                                              end = first.get(RecordDecl.time_stamp) + 10))
+                self.assertEqual([message.get(RecordDecl.time_stamp) - first.get(RecordDecl.time_stamp)
+                                  for message in records
+                                  if message.message_definition.global_message_number == GlobalMessageDecl.record],
+                                 list(range(10)))
+
+    def test_mixed_endian_and_base_types(self):
+        messages = list(parse_fit_buffer(build_mixed_endian_file()))
+        self.assertEqual([message.message_definition.global_message_number for message in messages], [250] * 3)
+        self.assertEqual([message.message_definition.architecture for message in messages], [0, 1, 0])
+
+        self.assertEqual([message.get(253) - mixed_endian_base for message in messages], [0, 1, 2])
+        self.assertEqual([message.get(0) for message in messages], [513, 513, None])
+        self.assertEqual([message.get(1) for message in messages], [(1, None), (7, 8, 9), None])
+        self.assertEqual([message.get(2) for message in messages], [1.25, 2.5, None])
+        self.assertEqual([message.get(3) for message in messages], ["abc", "\u00e9t\u00e9", None])
+        self.assertEqual([message.get(4) for message in messages], [-5, -6, None])
+        self.assertEqual(messages[1].unpack()[0], mixed_endian_base + 1)
+
+    def test_reused_message(self):
+        filename = "large_file.fit"
+        expected = [(message.message_definition.global_message_number, message.get(RecordDecl.time_stamp))
+                    for message in parse_fit_file(filename)]
+
+        for use_mmap in [False, True]:
+            actual = []
+            first = None
+            for message in parse_fit_file(filename, use_mmap = use_mmap, reuse = True):
+                first = first or message
+                self.assertIs(message, first)
+                actual.append((message.message_definition.global_message_number, message.get(RecordDecl.time_stamp)))
+            self.assertEqual(actual, expected)
+
+        # Messages are slotted
+        self.assertFalse(hasattr(first, "__dict__"))
+
+    def test_parse_stats(self):
+        filename = "large_file.fit"
+        all_messages = list(parse_fit_file(filename))
+
+        stats = ParseStats()
+        laps = list(parse_fit_file(filename, validate_crc = True, messages = [GlobalMessageDecl.lap], stats = stats))
+        result = stats.as_dict()
+
+        self.assertEqual(result["messages"]["lap"]["count"], len(laps))
+        self.assertEqual(sum(totals["count"] for totals in result["skipped"].values()), len(all_messages) - len(laps))
+        self.assertEqual(result["bytes_decoded"], sum(message.message_definition.size for message in laps))
+        self.assertEqual(result["bytes_decoded"] + result["bytes_skipped"],
+                         sum(message.message_definition.size for message in all_messages))
+        self.assertEqual(result["phases"]["record"]["count"], len(laps))
+        self.assertEqual(result["phases"]["crc"]["count"], 1)
+        self.assertEqual(sum(result["definitions"].values()), result["phases"]["definition"]["count"])
+
+    def test_push_parser_matches_parse_fit_file(self):
+        filename = "large_file.fit"
+        expected = [message.message_data for message in parse_fit_file(filename)]
+        with open(filename, "rb") as stream:
+            data = stream.read()
+
+        # Chunk sizes that split every kind of header, definition and record,
+        # and one chunk with the whole file
+        for chunk_size in [1, 5, 333, len(data)]:
+            parser = FitPushParser(validate_crc = True)
+            actual = []
+            for position in range(0, len(data), chunk_size):
+                actual.extend(message.message_data for message in parser.feed(bytearray(data[position:position + chunk_size])))
+            parser.close()
+            self.assertEqual(actual, expected)
+
+        parser = FitPushParser()
+        parser.feed(data[:len(data) // 2])
+        with self.assertRaises(ValueError):
+            parser.close()
+
+    def test_push_parser_tails_file_being_written(self):
+        # A file that is still being written has no data size in its header
+        data = bytearray(build_compressed_timestamp_file())
+        data[4:8] = bytes(4)
+        data[-2:] = struct.pack("<H", crc16(data[:-2]))
+
+        parser = FitPushParser(validate_crc = True)
+        self.assertEqual(parser.feed(data[:5]), [])
+        timestamps = [message.get(RecordDecl.time_stamp) for message in parser.feed(data[5:-4])]
+        timestamps += [message.get(RecordDecl.time_stamp) for message in parser.feed(data[-4:])]
+        parser.close()
+        self.assertEqual(timestamps, compressed_timestamp_expected)
+
+    def test_developer_fields(self):
+        data = build_developer_data_file()
+        for messages in [parse_fit_buffer(data, validate_crc = True, messages = [GlobalMessageDecl.record]),
+                         FitPushParser().feed(data)]:
+            records = [message for message in messages
+                       if message.message_definition.global_message_number == GlobalMessageDecl.record]
+
+            self.assertEqual([message.get(RecordDecl.power) for message in records], [250, 260])
+            self.assertEqual([message.get("Form Power") for message in records], [60, None])
+            self.assertEqual([message.get("core_temperature") for message in records], [3712, 3725])
+            self.assertEqual([message.get("developer_0_5") for message in records], [b"xyz", b"xyz"])
+            self.assertEqual([message.get_converted("core_temperature") for message in records], [37.12, 37.25])
+            self.assertEqual(records[0].unpack(), (developer_data_base, 250, 60, 3712, b"xyz"))
+
+            message_definition = records[0].message_definition
+            self.assertEqual(message_definition.size, 13)
+            self.assertEqual(message_definition.MessageDefinitionSize(), 5 + 2 * 3 + 1 + 3 * 3)
+            self.assertEqual(message_definition.developer_profiles["Form Power"].units, "watts")
+
+        # Byte by byte, definitions with developer fields are only parsed once complete
+        parser = FitPushParser(validate_crc = True)
+        records = []
+        for position in range(len(data)):
+            records.extend(parser.feed(data[position:position + 1]))
+        parser.close()
+        self.assertEqual([message.get("core_temperature") for message in records[-2:]], [3712, 3725])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,458 @@
+# Encoder that writes DataFrames back out as a .fit file
+#
+# write_fit is the inverse of parse_fit_as_dataframe with "*" columns: every
+# DataFrame becomes one MessageDefinition, built from the dtypes of its
+# columns, followed by its data messages. The data messages are not packed
+# one by one. Each column is assigned into a NumPy structured array whose
+# layout is that of the definition, and the whole array is written with a
+# single tobytes() call, so writing runs at about the speed of reading.
+#
+# Timestamps can optionally be written as compressed timestamp headers. Rows
+# within 31 seconds of the previous row then drop their time_stamp field and
+# carry the low 5 bits of the timestamp in their header instead. Rows that
+# cannot be compressed keep a full time_stamp under a second definition, and
+# both kinds are interleaved with a boolean mask over the packed bytes.
+#
+# Columns that are not fields of the profile are written as developer
+# fields. A DataFrame does not keep the field_description messages they were
+# read with, so the writer generates its own: one developer_data_id message
+# per developer data index and one field_description per column, named after
+# the column and typed after its dtype. Values are written as they are, with
+# a scale of 1 and no units.
+
+import io
+import os
+import re
+import struct
+import numpy as np
+import pandas as pd
+from crc import Crc16
+from fit_parser import DeveloperDataIdDecl, FieldDescriptionDecl, FieldType, GlobalMessageDecl, MessageDefinition, \
+    _base_types, developer_data_messages, timestamp_field_number
+from fit_parser_dataframe import _field_decls, _fit_epoch_offset
+
+default_protocol_version = 0x20
+default_profile_version = 2132
+
+# The FIT type that each NumPy dtype is written as. Booleans are written as
+# enums. 64 bit integers are narrowed to 32 bits when their values fit, as
+# the profile has no 64 bit integer types.
+
+_field_types = {
+    np.dtype(np.int8): FieldType.int8,
+    np.dtype(np.uint8): FieldType.uint8,
+    np.dtype(np.int16): FieldType.int16,
+    np.dtype(np.uint16): FieldType.uint16,
+    np.dtype(np.int32): FieldType.int32,
+    np.dtype(np.uint32): FieldType.uint32,
+    np.dtype(np.float32): FieldType.float32,
+    np.dtype(np.float64): FieldType.float64,
+    }
+
+_narrowed_types = {
+    np.dtype(np.int64): np.dtype(np.int32),
+    np.dtype(np.uint64): np.dtype(np.uint32),
+    np.dtype(np.float16): np.dtype(np.float32),
+    }
+
+_max_field_size = 255
+
+# Developer fields that were read without a description are named after
+# their developer data index and field number, and are written back there
+
+_developer_field_pattern = re.compile(r"developer_(\d+)_(\d+)$")
+
+def write_fit(path_or_buffer, frames_by_message, compressed_timestamps = False,
+              protocol_version = default_protocol_version, profile_version = default_profile_version):
+    """Write DataFrames as the messages of a .fit file.
+
+    Parameters
+    ----------
+    path_or_buffer: str or file-like object
+        Path of the .fit file to write, or a binary stream with a write method
+    frames_by_message: dict[GlobalMessageDecl, pandas.DataFrame]
+        The rows of each global message, in the order they are written. Columns are named as by
+        parse_fit_as_dataframe: by field declaration (e.g. "power" or RecordDecl.power), or
+        "field_<n>" for fields without one. A DatetimeIndex or datetime64 column is written as a
+        FIT timestamp; the index is written as field 253 (time_stamp). Missing values are written
+        as the invalid value of the field type. Columns of Python strings are written as strings,
+        bytes objects as byte arrays and per-row arrays as array fields. Object columns without
+        any value are left out. Any other column name is written as a developer field of that
+        name, or at its developer data index and field number for names like "developer_0_5".
+        Developer fields are described by generated developer_data_id and field_description
+        messages, which replace the frames of those messages if there are any.
+    compressed_timestamps: bool
+        Write the time stamps of rows that follow the previous row by less than 32 seconds as
+        compressed timestamp headers, which saves 4 bytes per row. Default is False.
+    protocol_version: int
+        Protocol version written in the file header. Default is 2.0.
+    profile_version: int
+        Profile version written in the file header. Default is 21.32.
+
+    Returns
+    -------
+    int
+        The size of the .fit file in bytes
+
+    Examples
+    --------
+    >>> frames = {message: parse_fit_as_dataframe('fit_file.fit', '*', message = message) \
+                  for message in [GlobalMessageDecl.file_id, GlobalMessageDecl.record]}
+    >>> frames[GlobalMessageDecl.record] = frames[GlobalMessageDecl.record].iloc[::5]
+    >>> write_fit('downsampled.fit', frames, compressed_timestamps = True)
+    """
+
+    frames = [(int(global_message_number), len(frame)) + _encode_columns(int(global_message_number), frame)
+              for global_message_number, frame in frames_by_message.items()]
+    developer_fields = _developer_fields(frames)
+
+    blocks = []
+    is_described = len(developer_fields) == 0
+    for global_message_number, row_count, columns, developer_columns in frames:
+        if len(developer_fields) > 0 and global_message_number in developer_data_messages:
+            continue
+        if len(developer_columns) > 0 and not is_described:
+            for message_frame in _developer_data_frames(developer_fields):
+                blocks.extend(_encode_frame(*message_frame, compressed_timestamps = False))
+            is_described = True
+        developer_columns = [(developer_fields[name][:2], encoded) for name, encoded in developer_columns]
+        blocks.extend(_encode_frame(global_message_number, row_count, columns, developer_columns, compressed_timestamps))
+    data_size = sum(len(block) for block in blocks)
+
+    header = struct.pack("<BBhI4s", 14, protocol_version, profile_version, data_size, b".FIT")
+    crc = Crc16()
+    crc.update(header)
+    header += struct.pack("<H", crc.digest())
+
+    crc = Crc16()
+    if isinstance(path_or_buffer, (str, bytes, os.PathLike)):
+        with io.open(path_or_buffer, "wb") as stream:
+            _write_blocks(stream, crc, [header] + blocks)
+    else:
+        _write_blocks(path_or_buffer, crc, [header] + blocks)
+    return len(header) + data_size + 2
+
+def _write_blocks(stream, crc, blocks):
+    for block in blocks:
+        crc.update(block)
+        stream.write(block)
+    stream.write(struct.pack("<H", crc.digest()))
+
+# Encode the columns of one DataFrame. Returns the (field_number, encoded)
+# pairs of its native fields and the (name, encoded) pairs of its developer
+# fields.
+
+def _encode_columns(global_message_number, frame):
+    columns = []
+    developer_columns = []
+    if isinstance(frame.index, pd.DatetimeIndex):
+        columns.append((timestamp_field_number, _to_fit_timestamps(frame.index)))
+    for name, column in frame.items():
+        field_number = _field_number(name, global_message_number)
+        encoded = _encode_column(name, column)
+        if encoded is None:
+            continue
+        if field_number is None:
+            developer_columns.append((name, encoded))
+        else:
+            columns.append((field_number, encoded))
+
+    field_numbers = [field_number for field_number, _ in columns]
+    if len(set(field_numbers)) != len(field_numbers):
+        raise ValueError("message %d has duplicate fields" % global_message_number)
+    if len(columns) > 255 or len(developer_columns) > 255:
+        raise ValueError("message %d has more than 255 fields" % global_message_number)
+    return columns, developer_columns
+
+# Assign a (developer_data_index, field_number, field_type) to the developer
+# columns of all frames. Columns named like "developer_0_5" keep their index
+# and number; the others are numbered in order under index 0.
+
+def _developer_fields(frames):
+    field_types = {}
+    for _, _, _, developer_columns in frames:
+        for name, (_, _, field_type) in developer_columns:
+            if field_types.setdefault(name, field_type) != field_type:
+                raise ValueError("developer field %r has different types in different messages" % name)
+
+    developer_fields = {}
+    for name, field_type in field_types.items():
+        match = _developer_field_pattern.match(name)
+        if match is not None:
+            key = (int(match.group(1)), int(match.group(2)))
+            if max(key) > 255:
+                raise ValueError("developer field %r is out of range" % name)
+            developer_fields[name] = key + (field_type,)
+
+    taken = set(field_number for developer_data_index, field_number, _ in developer_fields.values()
+                if developer_data_index == 0)
+    free = (field_number for field_number in range(256) if field_number not in taken)
+    for name, field_type in field_types.items():
+        if name not in developer_fields:
+            field_number = next(free, None)
+            if field_number is None:
+                raise ValueError("more than 256 developer fields")
+            developer_fields[name] = (0, field_number, field_type)
+    return developer_fields
+
+# The developer_data_id and field_description messages that describe the
+# developer fields, as (global_message_number, row_count, columns,
+# developer_columns) tuples for _encode_frame. Fields named after their index
+# and number are described without a name, so that they read back the same.
+
+def _developer_data_frames(developer_fields):
+    developer_data_indexes = sorted(set(key[0] for key in developer_fields.values()))
+    developers = pd.DataFrame({
+        DeveloperDataIdDecl.developer_data_index: np.array(developer_data_indexes, dtype = np.uint8),
+        })
+
+    keys = list(developer_fields.values())
+    descriptions = pd.DataFrame({
+        FieldDescriptionDecl.developer_data_index: np.array([key[0] for key in keys], dtype = np.uint8),
+        FieldDescriptionDecl.field_definition_number: np.array([key[1] for key in keys], dtype = np.uint8),
+        FieldDescriptionDecl.fit_base_type_id: np.array([key[2] for key in keys], dtype = np.uint8),
+        FieldDescriptionDecl.field_name: pd.array([None if _developer_field_pattern.match(name) else name
+                                                   for name in developer_fields], dtype = "string"),
+        })
+
+    return [(global_message_number, len(frame)) + _encode_columns(global_message_number, frame)
+            for global_message_number, frame in [(int(GlobalMessageDecl.developer_data_id), developers),
+                                                 (int(GlobalMessageDecl.field_description), descriptions)]]
+
+# Encode the definition and data messages of one DataFrame. Returns the
+# blocks of bytes to write. Local message type 0 holds the full definition;
+# with compressed timestamps, local message type 1 holds the definition
+# without the time_stamp field. Developer columns are keyed on their
+# (developer_data_index, field_number).
+
+def _encode_frame(global_message_number, row_count, columns, developer_columns, compressed_timestamps):
+    definition_bytes = _definition_bytes(0, global_message_number, columns, developer_columns)
+    records = _pack(_message_definition(definition_bytes), columns + developer_columns, row_count)
+    records['header'] = 0
+    blocks = [definition_bytes]
+
+    timestamps = dict(columns).get(timestamp_field_number)
+    if not compressed_timestamps or timestamps is None or row_count == 0:
+        blocks.append(records.tobytes())
+        return blocks
+
+    # A row can be compressed when it and the previous row have a valid time
+    # stamp and it follows the previous row by 0 to 31 seconds. The parser
+    # advances its last timestamp with every compressed header, so every
+    # row only needs to be close to the one before it.
+    values, invalid, _ = timestamps
+    valid = values != invalid
+    deltas = np.diff(values.astype(np.int64))
+    is_compressed = np.zeros(len(values), dtype = np.bool_)
+    is_compressed[1:] = valid[1:] & valid[:-1] & (deltas >= 0) & (deltas < 32)
+
+    compressed_columns = [column for column in columns if column[0] != timestamp_field_number]
+    compressed_bytes = _definition_bytes(1, global_message_number, compressed_columns, developer_columns)
+    blocks.append(compressed_bytes)
+    records['header'] = np.where(is_compressed, 0x80 | (1 << 5) | (values & 0x1f), 0)
+
+    # Drop the time stamp bytes of the compressed rows; row-major boolean
+    # indexing keeps the remaining bytes of all rows in order
+    raw = records.view(np.uint8).reshape(len(records), records.dtype.itemsize)
+    offset = records.dtype.fields[_column_name(timestamp_field_number)][1]
+    is_timestamp_byte = np.zeros(records.dtype.itemsize, dtype = np.bool_)
+    is_timestamp_byte[offset:offset + 4] = True
+    keep = ~(is_compressed[:, np.newaxis] & is_timestamp_byte[np.newaxis, :])
+    blocks.append(raw[keep].tobytes())
+    return blocks
+
+# The field number of a column: the value of a field declaration, the
+# number in "field_<n>", or the name of a declaration of the message. Other
+# names are developer fields, which have no field number.
+
+def _field_number(name, global_message_number):
+    if isinstance(name, str):
+        field_decl = _field_decls.get(global_message_number)
+        if name.startswith("field_") and name[len("field_"):].isdigit():
+            field_number = int(name[len("field_"):])
+        elif field_decl is not None and name in field_decl.__members__:
+            field_number = int(field_decl[name])
+        else:
+            return None
+    elif isinstance(name, int):
+        field_number = int(name)
+    else:
+        raise ValueError("column %r of message %d is not a known field" % (name, global_message_number))
+    if not 0 <= field_number <= 255:
+        raise ValueError("column %r of message %d is out of range" % (name, global_message_number))
+    return field_number
+
+# The name of a field in the packed records, keyed on its field number or,
+# for developer fields, on its (developer_data_index, field_number)
+
+def _column_name(key):
+    if isinstance(key, tuple):
+        return "d%d_%d" % key
+    return "f%d" % key
+
+# Convert a column into a (values, invalid, field_type) tuple, where values
+# is a NumPy array with the invalid value in place of missing values. Array
+# fields are 2-D. Returns None for object columns without any value.
+
+def _encode_column(name, column):
+    dtype = column.dtype
+
+    if isinstance(dtype, pd.DatetimeTZDtype) or dtype.kind == 'M':
+        return _to_fit_timestamps(column)
+
+    if isinstance(dtype, pd.StringDtype):
+        return _encode_strings(name, column)
+
+    if isinstance(dtype, pd.api.extensions.ExtensionDtype):
+        if not hasattr(dtype, "numpy_dtype"):
+            raise ValueError("column %r has unsupported dtype %s" % (name, dtype))
+        values = column.to_numpy(dtype = dtype.numpy_dtype, na_value = 0)
+        return _encode_numbers(name, values, column.isna().to_numpy())
+
+    if dtype.kind == 'O':
+        present = column[column.notna()]
+        if len(present) == 0:
+            return None
+        value = present.iloc[0]
+        if isinstance(value, str):
+            return _encode_strings(name, column)
+        if isinstance(value, (bytes, bytearray)):
+            return _encode_bytes(name, column)
+        return _encode_arrays(name, column)
+
+    values = column.to_numpy()
+    return _encode_numbers(name, values, np.isnan(values) if dtype.kind == 'f' else None)
+
+def _encode_numbers(name, values, missing):
+    if values.dtype == np.bool_:
+        values = values.astype(np.uint8)
+        dtype = values.dtype
+        field_type = FieldType.enum
+    else:
+        dtype = _narrowed_types.get(values.dtype, values.dtype)
+        field_type = _field_types.get(dtype)
+    if field_type is None:
+        raise ValueError("column %r has unsupported dtype %s" % (name, values.dtype))
+
+    if dtype != values.dtype:
+        if dtype.kind in 'iu':
+            present = values if missing is None else values[~missing]
+            limits = np.iinfo(dtype)
+            if len(present) > 0 and (present.min() < limits.min or present.max() > limits.max):
+                raise ValueError("column %r does not fit in %s" % (name, dtype))
+        values = values.astype(dtype)
+
+    invalid = _invalid_value(field_type, dtype)
+    if missing is not None and missing.any():
+        values = values.copy()
+        values[missing] = invalid
+    return values, invalid, field_type
+
+# Floats are invalid as an all ones bit pattern, which is a NaN but not the
+# NaN that NumPy produces, so it is assigned through an integer view
+
+def _invalid_value(field_type, dtype):
+    invalid = _base_types[field_type][1]
+    if dtype.kind == 'f':
+        return np.array([invalid], dtype = 'u%d' % dtype.itemsize).view(dtype)[0]
+    return dtype.type(invalid)
+
+def _encode_strings(name, column):
+    missing = column.isna().to_numpy()
+    strings = column.to_numpy(dtype = object, na_value = "")
+    encoded = np.char.encode(strings.astype(str), 'utf-8')
+
+    # Strings are NUL terminated
+    size = encoded.dtype.itemsize + 1
+    if size > _max_field_size:
+        raise ValueError("column %r has strings longer than %d bytes" % (name, _max_field_size - 1))
+    encoded = encoded.astype('S%d' % size)
+    encoded[missing] = b''
+    return encoded, b'', FieldType.string
+
+def _encode_bytes(name, column):
+    missing = column.isna().to_numpy()
+    present = column[~missing]
+    size = len(present.iloc[0])
+    if any(len(value) != size for value in present):
+        raise ValueError("column %r has byte arrays of different lengths" % name)
+    if size == 0 or size > _max_field_size:
+        raise ValueError("column %r has byte arrays of unsupported length %d" % (name, size))
+
+    values = np.full(len(column), b'\xff' * size, dtype = 'V%d' % size)
+    values[~missing] = [bytes(value) for value in present]
+    return values, None, FieldType.byte_array
+
+def _encode_arrays(name, column):
+    missing = column.isna().to_numpy()
+    present = [np.asarray(value) for value in column[~missing]]
+    shapes = set(value.shape for value in present)
+    if len(shapes) != 1 or len(next(iter(shapes))) != 1:
+        raise ValueError("column %r has arrays of different lengths" % name)
+
+    stacked = np.stack(present)
+    nested_missing = np.isnan(stacked) if stacked.dtype.kind == 'f' else None
+    values, invalid, field_type = _encode_numbers(name, stacked, nested_missing)
+    if values.dtype.itemsize * values.shape[1] > _max_field_size:
+        raise ValueError("column %r has arrays longer than %d bytes" % (name, _max_field_size))
+
+    full = np.full((len(column), values.shape[1]), invalid, dtype = values.dtype)
+    full[~missing] = values
+    return full, invalid, field_type
+
+# Convert datetime64 values into raw FIT timestamps. NaT is invalid.
+
+def _to_fit_timestamps(column):
+    values = pd.DatetimeIndex(column)
+    if values.tz is not None:
+        values = values.tz_convert('UTC').tz_localize(None)
+    missing = values.isna()
+    seconds = values.values.astype('datetime64[s]').astype(np.int64) - _fit_epoch_offset
+    timestamps = np.where(missing, 0xffffffff, seconds).astype(np.uint32)
+    return timestamps, np.uint32(0xffffffff), FieldType.uint32
+
+# Build the bytes of a definition message for encoded columns. Developer
+# fields follow the native fields, with bit 5 of the header set.
+
+def _definition_bytes(local_message_type, global_message_number, columns, developer_columns):
+    header = 0x40 | local_message_type | (0x20 if len(developer_columns) > 0 else 0)
+    definition = struct.pack("<BBBHB", header, 0, 0, global_message_number, len(columns))
+    for field_number, (values, _, field_type) in columns:
+        definition += struct.pack("<BBB", field_number, _field_size(values), field_type)
+    if len(developer_columns) > 0:
+        definition += struct.pack("<B", len(developer_columns))
+        for (developer_data_index, field_number), (values, _, _) in developer_columns:
+            definition += struct.pack("<BBB", field_number, _field_size(values), developer_data_index)
+    return definition
+
+def _field_size(values):
+    return values.dtype.itemsize * (values.shape[1] if values.ndim == 2 else 1)
+
+# Read a definition back with the parser, so that the packed layout is the
+# one that the parser compiles for it
+
+def _message_definition(definition_bytes):
+    stream = io.BytesIO(definition_bytes)
+    header = stream.read(1)[0]
+    return MessageDefinition(header, stream)
+
+# Pack the columns into a structured array with one row per data message: a
+# header byte followed by the fields at the offsets of the definition
+
+def _pack(message_definition, columns, row_count):
+    names = ['header']
+    formats = ['u1']
+    offsets = [0]
+    field_definitions = message_definition.field_definitions + (message_definition.developer_field_definitions or [])
+    for field_definition, (key, (values, _, _)) in zip(field_definitions, columns):
+        names.append(_column_name(key))
+        formats.append((values.dtype.newbyteorder('<'), values.shape[1:]) if values.ndim == 2 else
+                       values.dtype.newbyteorder('<') if values.dtype.kind in 'iuf' else values.dtype)
+        offsets.append(1 + field_definition.field_offset)
+
+    dtype = np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                      'itemsize': 1 + message_definition.size})
+    records = np.zeros(row_count, dtype = dtype)
+    for key, (values, _, _) in columns:
+        records[_column_name(key)] = values
+    return records
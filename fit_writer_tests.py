@@ -0,0 +1,119 @@
+# FIT writer tests
+
+import io
+import os
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+from fit_parser import GlobalMessageDecl, RecordDecl, parse_fit_buffer, parse_fit_file
+from fit_parser_columns import parse_fit_columns
+from fit_parser_dataframe import parse_fit_as_dataframe
+from fit_parser_tests import build_developer_data_file
+from fit_writer import write_fit
+
+class FitWriterTestMethods(unittest.TestCase):
+
+    def setUp(self):
+        handle, self.filename = tempfile.mkstemp(suffix = ".fit")
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def test_round_trip(self):
+        filename = "large_file.fit"
+        frames = {message: parse_fit_as_dataframe(filename, "*", message = message) for message in parse_fit_columns(filename)}
+
+        for compressed_timestamps in [False, True]:
+            size = write_fit(self.filename, frames, compressed_timestamps = compressed_timestamps)
+            self.assertEqual(size, os.path.getsize(self.filename))
+
+            list(parse_fit_file(self.filename, validate_crc = True))
+            for message, frame in frames.items():
+                pd.testing.assert_frame_equal(parse_fit_as_dataframe(self.filename, "*", message = message), frame)
+
+    def test_round_trip_messages(self):
+        filename = "large_file.fit"
+        fields = [RecordDecl.time_stamp, RecordDecl.power, RecordDecl.heart_rate, RecordDecl.speed, RecordDecl.position_lat]
+        frame = parse_fit_as_dataframe(filename, "*")
+        write_fit(self.filename, {GlobalMessageDecl.record: frame}, compressed_timestamps = True)
+
+        def records(path):
+            return [tuple(message.get(field) for field in fields) for message in parse_fit_file(path)
+                    if message.message_definition.global_message_number == GlobalMessageDecl.record]
+
+        self.assertEqual(records(self.filename), records(filename))
+
+    def test_compressed_timestamps(self):
+        times = pd.to_datetime([0, 1, 2, 40, 41, 41, 70], unit = "s", origin = "2020-01-01", utc = True)
+        frame = pd.DataFrame({"power": np.arange(7, dtype = np.uint16)},
+                             index = pd.DatetimeIndex(times, name = RecordDecl.time_stamp.name))
+        buffer = io.BytesIO()
+        write_fit(buffer, {GlobalMessageDecl.record: frame}, compressed_timestamps = True)
+        full = io.BytesIO()
+        write_fit(full, {GlobalMessageDecl.record: frame})
+
+        messages = list(parse_fit_buffer(buffer.getvalue(), validate_crc = True))
+        compressed = [(message.header & 0x80) != 0 for message in messages]
+        self.assertEqual(compressed, [False, True, True, False, True, True, True])
+        # Five rows save their 4 byte time stamp; the second definition costs 9 bytes
+        self.assertEqual(len(full.getvalue()) - len(buffer.getvalue()), 5 * 4 - 9)
+
+        expected = [message.get(RecordDecl.time_stamp) for message in parse_fit_buffer(full.getvalue())]
+        self.assertEqual([message.get(RecordDecl.time_stamp) for message in messages], expected)
+
+    def test_column_types(self):
+        frame = pd.DataFrame({
+            "power": pd.array([100, None, 300], dtype = "UInt16"),
+            "heart_rate": np.array([120, 130, 140], dtype = np.int64),
+            "speed": [1.5, np.nan, 2.5],
+            "field_200": [True, False, True],
+            "field_201": pd.array(["a", None, "ünïcode"], dtype = "string"),
+            "field_202": [b"\x01\x02", None, b"\x03\x04"],
+            "field_203": [np.array([1, 2], dtype = np.uint8), None, np.array([3, 4], dtype = np.uint8)],
+            "field_204": [None, None, None],
+            })
+        write_fit(self.filename, {GlobalMessageDecl.record: frame})
+
+        actual = parse_fit_as_dataframe(self.filename, "*")
+        self.assertEqual(list(actual.columns), ["heart_rate", "speed", "power", "field_200", "field_201", "field_202", "field_203"])
+        self.assertEqual(str(actual["heart_rate"].dtype), "Int32")
+        self.assertEqual(actual["power"].tolist(), [100, pd.NA, 300])
+        self.assertTrue(np.isnan(actual["speed"][1]))
+        self.assertEqual(actual["field_200"].tolist(), [1, 0, 1])
+        self.assertEqual(actual["field_201"].tolist(), ["a", pd.NA, "ünïcode"])
+        self.assertEqual(actual["field_202"].tolist(), [b"\x01\x02", None, b"\x03\x04"])
+        self.assertEqual(actual["field_203"][2].tolist(), [3, 4])
+        self.assertTrue(np.isnan(actual["field_203"][1]).all())
+
+    def test_round_trip_developer_fields(self):
+        with open(self.filename, "wb") as stream:
+            stream.write(build_developer_data_file())
+        frames = {message: parse_fit_as_dataframe(self.filename, "*", message = message)
+                  for message in parse_fit_columns(self.filename)}
+        record = frames[GlobalMessageDecl.record]
+        self.assertEqual(list(record.columns), ["power", "Form Power", "core_temperature", "developer_0_5"])
+
+        for compressed_timestamps in [False, True]:
+            write_fit(self.filename, frames, compressed_timestamps = compressed_timestamps)
+            pd.testing.assert_frame_equal(parse_fit_as_dataframe(self.filename, "*"), record)
+
+        # Developer fields are typed after their dtype and keep their names across messages
+        frame = pd.DataFrame({"power": np.array([1, 2], dtype = np.uint16), "Form Power": [0.5, np.nan]})
+        laps = pd.DataFrame({"Form Power": [1.5]})
+        write_fit(self.filename, {GlobalMessageDecl.record: frame, GlobalMessageDecl.lap: laps})
+        pd.testing.assert_frame_equal(parse_fit_as_dataframe(self.filename, "*"), frame, check_dtype = False)
+        self.assertEqual(parse_fit_as_dataframe(self.filename, "*", message = GlobalMessageDecl.lap)["Form Power"].tolist(), [1.5])
+
+        with self.assertRaises(ValueError):
+            write_fit(io.BytesIO(), {GlobalMessageDecl.record: frame, GlobalMessageDecl.lap: pd.DataFrame({"Form Power": ["a"]})})
+
+    def test_invalid_columns(self):
+        with self.assertRaises(ValueError):
+            write_fit(io.BytesIO(), {GlobalMessageDecl.record: pd.DataFrame({"field_256": [1]})})
+        with self.assertRaises(ValueError):
+            write_fit(io.BytesIO(), {GlobalMessageDecl.record: pd.DataFrame({"power": [1 << 40]})})
+
+if __name__ == '__main__':
+    unittest.main()